@@ -61,10 +61,10 @@ def get_lens(ds_code, tok, split, include_completions=False):
         cache = {}
         loaded = False
 
-    for completions in tqdm(ds.values(), desc=f"Tokenizing {ds_code}"):
-        for pair in completions["pairs"]:
-            chosen = completions["responses"][pair[0]]
-            rejected = completions["responses"][pair[1]]
+    for _, responses, pairs, _, _ in tqdm(ds, desc=f"Tokenizing {ds_code}"):
+        for pair in pairs:
+            chosen = responses[pair[0]]
+            rejected = responses[pair[1]]
             info = {
                 f"Preferred length": min(get_len(chosen, tok, cache=cache), maxlen),
                 f"Dispreferred length": min(get_len(rejected, tok, cache=cache), maxlen),
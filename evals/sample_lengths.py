@@ -12,7 +12,7 @@ from all_datasets import get_len
 
 def parse(s, legacy=False):
     try:
-        s = s.replace(".json", "")
+        s = s.replace(".jsonl", "").replace(".json", "")
         if legacy:
             model, ds, _mod, alpha, _beta, beta = s.split("_")[0].split("-")
             step = int(s.split("_")[-1].replace(".json", "").replace("step-", ""))
@@ -42,7 +42,11 @@ def get_sample_lens(sample_dir, sample_path, tokenizer, legacy=False):
     with open(os.path.join(sample_dir, sample_path), "r") as f:
         *_, alpha, beta, step = parse(os.path.basename(sample_path), legacy=legacy)
         name = f"DPO (α={alpha}, β={beta})" if beta != 0 else "SFT"
-        for v in json.load(f).values():
+        if sample_path.endswith(".jsonl"):
+            samples = [json.loads(line)["sample"] for line in f if line.strip()]
+        else:
+            samples = json.load(f).values()
+        for v in samples:
             v = v[v.rfind(kword) + len(kword) + 1:]
             ds.append({
                 "len": get_len(v, tokenizer, cache=cache),
@@ -178,7 +182,7 @@ if __name__ == "__main__":
     if args.dataset:
         sample_paths = list(
             filter(
-                lambda p: args.dataset in p and p.endswith(".json") and parse(p, args.legacy),
+                lambda p: args.dataset in p and p.endswith((".json", ".jsonl")) and parse(p, args.legacy),
                 sample_paths
             )
         )
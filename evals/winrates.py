@@ -65,7 +65,7 @@ def load_shp():
 
 def load_samples(sample_dir, to_process=None):
     """
-    Get samples from directory and list of json files.
+    Get samples from directory and list of json/jsonl files.
     Returns a dict with keys corresponding to model names, and values
     corresponding to dict of prompt: response pairs.
     """
@@ -75,7 +75,16 @@ def load_samples(sample_dir, to_process=None):
     sampled = defaultdict(dict)
     kword = "Assistant:"
     for f in to_process:
-        if f.endswith(".json"):
+        if f.endswith(".jsonl"):
+            with open(os.path.join(sample_dir, f), "r") as fi:
+                for line in fi:
+                    if not line.strip():
+                        continue
+                    row = json.loads(line)
+                    v = row["sample"]
+                    response = v[v.rfind(kword) + len(kword) + 1:]
+                    sampled[f[:-len(".jsonl")]][row["prompt"]] = response
+        elif f.endswith(".json"):
             with open(os.path.join(sample_dir, f), "r") as fi:
                 tmp = json.load(fi)
                 for prompt, v in tmp.items():
@@ -9,11 +9,24 @@ from torch.nn.utils.rnn import pad_sequence
 from collections import defaultdict
 import tqdm
 import random
+import hashlib
+import shutil
+import copy
+import functools
+import itertools
+import multiprocessing
 from bs4 import BeautifulSoup, NavigableString
+from omegaconf import OmegaConf
 import numpy as np
-from typing import Dict, List, Optional, Iterator, Callable, Union, Tuple
+from typing import Any, Dict, List, Optional, Iterable, Iterator, Callable, Union, Tuple, Set
 
 LOCAL_PATH = "data/"
+TOKENIZED_CACHE_VERSION = 2
+# bump to rebuild the cleaned StackExchange datasets cached by get_se
+SE_CACHE_VERSION = 1
+BATCHES_CACHE_VERSION = 1
+# how many prompts to tokenize together (see tokenize_prompts)
+TOKENIZATION_CHUNK_SIZE = 64
 
 
 def extract_anthropic_prompt(prompt_and_response):
@@ -48,11 +61,184 @@ def strip_html_tags(html_string):
     return text
 
 
-def get_se(split, silent=False, cache_dir: str = None) -> Dict[str, Dict[str, Union[List[Tuple[int, int]], List[str], str]]]:
-    """Load the StackExchange dataset from Huggingface, and return a dict of prompts and responses. See get_hh for the format.
+def encode_strings(texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Encode strings as a flat uint8 array of their utf-8 bytes and an int64 array of offsets, so string i is bytes offsets[i]:offsets[i + 1]."""
+    encoded = [text.encode('utf-8') for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def save_arrays(arrays: Dict[str, np.ndarray], path: str):
+    """Save arrays to a directory of .npy files; the directory is written atomically, so concurrent jobs never see a partial cache."""
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    os.makedirs(tmp_path, exist_ok=True)
+    for k, v in arrays.items():
+        np.save(os.path.join(tmp_path, f'{k}.npy'), v)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:  # another job wrote the same cache first
+        shutil.rmtree(tmp_path)
+
+
+def load_arrays(path: str) -> Dict[str, np.ndarray]:
+    """Memory-map the arrays written by save_arrays."""
+    return {f[:-len('.npy')]: np.load(os.path.join(path, f), mmap_mode='r') for f in os.listdir(path) if f.endswith('.npy')}
+
+
+class PreferenceData:
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        """The prompts, responses, preference pairs and sft targets of a dataset split, stored as flat numpy arrays with offsets.
+
+           The responses of prompt i are response_offsets[i]:response_offsets[i + 1], and its pairs are pair_offsets[i]:pair_offsets[i + 1].
+             Pairs (an (n_pairs, 2) array) and sft targets hold indices into the responses of their prompt. Texts are stored as utf-8
+             bytes with offsets (see encode_strings), so a loaded dataset is a handful of arrays rather than a dict and lists per prompt.
+             Loaders build it with a PreferenceDataBuilder.
+        """
+        self.arrays = arrays
+
+    def __len__(self):
+        return len(self.arrays['response_offsets']) - 1
+
+    @property
+    def n_pairs(self) -> int:
+        return len(self.arrays['pairs'])
+
+    def _text(self, key: str, idx: int) -> str:
+        offsets = self.arrays[f'{key}_offsets']
+        return self.arrays[key][offsets[idx]:offsets[idx + 1]].tobytes().decode('utf-8')
+
+    def prompt(self, idx: int) -> str:
+        return self._text('prompt_text', idx)
+
+    def responses(self, idx: int) -> List[str]:
+        offsets = self.arrays['response_offsets']
+        return [self._text('response_text', response_idx) for response_idx in range(offsets[idx], offsets[idx + 1])]
+
+    def pairs(self, idx: int) -> List[Tuple[int, int]]:
+        offsets = self.arrays['pair_offsets']
+        return [(int(i), int(j)) for i, j in self.arrays['pairs'][offsets[idx]:offsets[idx + 1]]]
+
+    def sft_target(self, idx: int) -> str:
+        return self._text('response_text', self.arrays['response_offsets'][idx] + self.arrays['sft_target'][idx])
+
+    def __getitem__(self, idx: int) -> Tuple[str, List[str], List[Tuple[int, int]], str, int]:
+        """Return the (prompt, responses, pairs, sft_target, pair_offset) of the idx-th prompt, where pair_offset is the index of its first
+           pair among all pairs of the dataset (the example_id of that pair, see get_batch_elements)."""
+        responses = self.responses(idx)
+        sft_target = responses[self.arrays['sft_target'][idx]]
+        return self.prompt(idx), responses, self.pairs(idx), sft_target, int(self.arrays['pair_offsets'][idx])
+
+    def __iter__(self) -> Iterator[Tuple[str, List[str], List[Tuple[int, int]], str, int]]:
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def save(self, path: str):
+        save_arrays(self.arrays, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'PreferenceData':
+        """Memory-map a dataset written by save."""
+        return cls(load_arrays(path))
+
+
+def get_best_response(responses: List[str], scores: List[float]) -> str:
+    """Return the highest scoring response; a response that appears more than once counts with the score of its first appearance."""
+    return max(responses, key=lambda x: scores[responses.index(x)])
+
+
+class PreferenceDataBuilder:
+    def __init__(self):
+        """Collect the rows of a dataset as flat lists, grouping them by prompt (in order of first appearance), and build a PreferenceData."""
+        self.prompt_idxs = {}
+        self.prompts = []
+        self.n_responses = []
+        self.sft_targets = []
+        self.response_prompts = []
+        self.responses = []
+        self.scores = []
+        self.pair_prompts = []
+        self.pairs = []
+
+    def add(self, prompt: str, responses: List[str], pairs: List[Tuple[int, int]], sft_target: Optional[str] = None, scores: Optional[List[float]] = None):
+        """Add responses and preference pairs (indices into the given responses) to a prompt.
+
+           If given, sft_target (one of the responses) becomes the prompt's sft target; a prompt that never gets one
+             uses its highest scoring response instead, so scores must then be given for all of its responses.
+        """
+        idx = self.prompt_idxs.get(prompt)
+        if idx is None:
+            idx = self.prompt_idxs[prompt] = len(self.prompts)
+            self.prompts.append(prompt)
+            self.n_responses.append(0)
+            self.sft_targets.append(-1)
+        n_responses = self.n_responses[idx]
+
+        self.response_prompts.extend([idx] * len(responses))
+        self.responses.extend(responses)
+        self.scores.extend(scores if scores is not None else [np.nan] * len(responses))
+        for i, j in pairs:
+            self.pair_prompts.append(idx)
+            self.pairs.append((n_responses + i, n_responses + j))
+        if sft_target is not None:
+            self.sft_targets[idx] = n_responses + responses.index(sft_target)
+        self.n_responses[idx] += len(responses)
+
+    def build(self) -> PreferenceData:
+        response_order = np.argsort(np.array(self.response_prompts, dtype=np.int64), kind='stable')
+        pair_order = np.argsort(np.array(self.pair_prompts, dtype=np.int64), kind='stable')
+        response_offsets = np.concatenate([[0], np.cumsum(self.n_responses, dtype=np.int64)]).astype(np.int64)
+        pair_counts = np.bincount(np.array(self.pair_prompts, dtype=np.int64), minlength=len(self.prompts))
+        pair_offsets = np.concatenate([[0], np.cumsum(pair_counts)]).astype(np.int64)
+        responses = [self.responses[response_idx] for response_idx in response_order]
+        scores = np.array(self.scores, dtype=np.float64)[response_order]
+
+        sft_targets = np.array(self.sft_targets, dtype=np.int64)
+        for idx in np.flatnonzero(sft_targets == -1):
+            start, end = response_offsets[idx], response_offsets[idx + 1]
+            if end == start or np.isnan(scores[start:end]).any():
+                raise ValueError(f"No sft_target or scores for prompt {self.prompts[idx]!r}")
+            sft_targets[idx] = responses[start:end].index(get_best_response(responses[start:end], scores[start:end].tolist()))
+
+        arrays = {'response_offsets': response_offsets, 'pair_offsets': pair_offsets, 'sft_target': sft_targets,
+                  'pairs': np.array(self.pairs, dtype=np.int32).reshape(-1, 2)[pair_order]}
+        arrays['prompt_text'], arrays['prompt_text_offsets'] = encode_strings(self.prompts)
+        arrays['response_text'], arrays['response_text_offsets'] = encode_strings(responses)
+        return PreferenceData(arrays)
+
+
+def strip_se_html(row: Dict) -> Dict:
+    """Strip the HTML tags of a StackExchange question and its answers (see strip_html_tags)."""
+    row['question'] = strip_html_tags(row['question'])
+    for a in row['answers']:
+        a['text'] = strip_html_tags(a['text'])
+    return row
+
+
+def split_se_row(row: Dict) -> Tuple[str, List[str], List[Tuple[int, int]], List[float]]:
+    """Return the prompt, responses, pairs (every two answers, the higher scoring one chosen) and scores of a StackExchange row stripped by strip_se_html."""
+    prompt = '\n\nHuman: ' + row['question'] + '\n\nAssistant:'
+    responses = [' ' + a['text'] for a in row['answers']]
+    scores = [a['pm_score'] for a in row['answers']]
+
+    pairs = []
+    for i in range(len(responses)):
+        for j in range(i + 1, len(responses)):
+            pairs.append((i, j) if scores[i] > scores[j] else (j, i))
+    return prompt, responses, pairs, scores
+
+
+def get_se(split, silent=False, cache_dir: str = None) -> PreferenceData:
+    """Load the StackExchange dataset from Huggingface, and return its prompts and responses. See get_hh for the format.
     
        We strip the HTML tags from the responses (except for <code> tags), and we add necessary newlines.
+       Stripping is slow, so the cleaned dataset (with its pairs) is saved in cache_dir the first time, and memory-mapped after that.
     """
+    path = os.path.join(cache_dir or datasets.config.HF_DATASETS_CACHE, f'preference_data_se_{split}_v{SE_CACHE_VERSION}')
+    if os.path.exists(path):
+        print(f'Loading cleaned SE dataset ({split} split) from {path}')
+        return PreferenceData.load(path)
+
     print(f'Loading SE dataset ({split} split) from Huggingface...')
     dataset = datasets.load_dataset('HuggingFaceH4/stack-exchange-preferences', cache_dir=cache_dir)['train']
     print('done')
@@ -62,32 +248,39 @@ def get_se(split, silent=False, cache_dir: str = None) -> Dict[str, Dict[str, Un
     dataset = dataset.select(range(int(len(dataset) * 0.01))) if split == 'test' else dataset.select(
         range(int(len(dataset) * 0.01), len(dataset)))
 
-    def strip_html(x):
-        x['question'] = strip_html_tags(x['question'])
-        for a in x['answers']:
-            a['text'] = strip_html_tags(a['text'])
-        return x
+    dataset = dataset.map(strip_se_html, num_proc=os.cpu_count())
 
-    dataset = dataset.map(strip_html, num_proc=64)
+    # a question that appears more than once keeps its first position, but takes the answers of its last row
+    last_rows = {}
+    for row_idx, question in enumerate(dataset['question']):
+        last_rows[question] = row_idx
+    if len(last_rows) < len(dataset):
+        dataset = dataset.select(list(last_rows.values()))
 
-    data = defaultdict(dict)
+    data = PreferenceDataBuilder()
     for row in tqdm.tqdm(dataset, desc='Processing SE', disable=silent):
-        prompt = '\n\nHuman: ' + row['question'] + '\n\nAssistant:'
-        responses = [' ' + a['text'] for a in row['answers']]
-        scores = [a['pm_score'] for a in row['answers']]
+        prompt, responses, pairs, scores = split_se_row(row)
+        data.add(prompt, responses, pairs, scores=scores)
 
-        pairs = []
-        for i in range(len(responses)):
-            for j in range(i + 1, len(responses)):
-                pairs.append((i, j) if scores[i] > scores[j] else (j, i))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data.build().save(path)
+    print(f'Cached cleaned SE dataset ({split} split) to {path}')
+    return PreferenceData.load(path)
 
-        data[prompt]['responses'] = responses
-        data[prompt]['pairs'] = pairs
-        data[prompt]['sft_target'] = max(responses, key=lambda x: scores[responses.index(x)])
+def split_shp_row(row: Dict) -> Optional[Tuple[str, List[str], List[Tuple[int, int]], List[float]]]:
+    """Return the prompt, responses, pair and scores of an SHP row, or None if its score ratio is below 2."""
+    prompt = '\n\nHuman: ' + row['history'] + '\n\nAssistant:'
+    responses = [' ' + row['human_ref_A'], ' ' + row['human_ref_B']]
+    scores = [row['score_A'], row['score_B']]
+    score_ratio = max(scores[0] / scores[1], scores[1] / scores[0])
+    if score_ratio < 2:
+        return None
+
+    # according to https://huggingface.co/datasets/stanfordnlp/SHP
+    return prompt, responses, [(0, 1) if row['labels'] == 1 else (1, 0)], scores
 
-    return data
 
-def get_shp(split: str, silent: bool = False, cache_dir: str = None) -> Dict[str, Dict[str, Union[List[Tuple[int, int]], List[str], str]]]:
+def get_shp(split: str, silent: bool = False, cache_dir: str = None) -> PreferenceData:
     """Load the Stanford Human Preferences dataset from Huggingface and convert it to the necessary format. See hh for the format.
 
        We filter preference pairs to only keep pairs where the score ratio is at least 2.
@@ -97,32 +290,18 @@ def get_shp(split: str, silent: bool = False, cache_dir: str = None) -> Dict[str
     dataset = datasets.load_dataset('stanfordnlp/SHP', split=split, cache_dir=cache_dir)
     print('done')
 
-    data = defaultdict(lambda: defaultdict(list))
+    data = PreferenceDataBuilder()
     for row in tqdm.tqdm(dataset, desc='Processing SHP', disable=silent):
-        prompt = '\n\nHuman: ' + row['history'] + '\n\nAssistant:'
-        responses = [' ' + row['human_ref_A'], ' ' + row['human_ref_B']]
-        scores = [row['score_A'], row['score_B']]
-        if prompt in data:
-            n_responses = len(data[prompt]['responses'])
-        else:
-            n_responses = 0
-        score_ratio = max(scores[0] / scores[1], scores[1] / scores[0])
-        if score_ratio < 2:
+        split_row = split_shp_row(row)
+        if split_row is None:
             continue
+        prompt, responses, pairs, scores = split_row
+        data.add(prompt, responses, pairs, scores=scores)
 
-        # according to https://huggingface.co/datasets/stanfordnlp/SHP
-        data[prompt]['pairs'].append((n_responses, n_responses + 1) if row['labels'] == 1 else (n_responses + 1, n_responses))
-        data[prompt]['responses'].extend(responses)
-        data[prompt]['scores'].extend(scores)
-
-    for prompt in data:
-        data[prompt]['sft_target'] = max(data[prompt]['responses'], key=lambda x: data[prompt]['scores'][data[prompt]['responses'].index(x)])
-        del data[prompt]['scores']
-
-    return data
+    return data.build()
 
 
-def get_webgpt(split: str, silent: bool = False, cache_dir: str = None) -> Dict[str, Dict[str, Union[List[Tuple[int, int]], List[str], str]]]:
+def get_webgpt(split: str, silent: bool = False, cache_dir: str = None) -> PreferenceData:
     print(f'Loading WebGPT dataset ({split}) from Huggingface...')
     split = "train[0%:90%]" if split == "train" else "train[90%:]"
     dataset = datasets.load_dataset("openai/webgpt_comparisons", split=split, cache_dir=cache_dir)
@@ -136,19 +315,15 @@ def get_webgpt(split: str, silent: bool = False, cache_dir: str = None) -> Dict[
             chosen, rejected = rejected, chosen
         return prompt, chosen, rejected
 
-    data = defaultdict(lambda: defaultdict(list))
+    data = PreferenceDataBuilder()
     for row in tqdm.tqdm(dataset, desc='Processing WebGPT', disable=silent):
         prompt, chosen, rejected = split_prompt_and_responses(row)
-        responses = [chosen, rejected]
-        n_responses = len(data[prompt]['responses'])
-        data[prompt]['pairs'].append((n_responses, n_responses + 1))
-        data[prompt]['responses'].extend(responses)
-        data[prompt]['sft_target'] = chosen
+        data.add(prompt, [chosen, rejected], [(0, 1)], sft_target=chosen)
 
-    return data
+    return data.build()
 
 
-def get_rlcd(split: str, silent: bool = False, cache_dir: str = None) -> Dict[str, Dict[str, Union[List[Tuple[int, int]], List[str], str]]]:
+def get_rlcd(split: str, silent: bool = False, cache_dir: str = None) -> PreferenceData:
     if split == "test":
         split = "validation"
         # only "train", "validation" available
@@ -164,19 +339,15 @@ def get_rlcd(split: str, silent: bool = False, cache_dir: str = None) -> Dict[st
             chosen, rejected = rejected, chosen
         return prompt, chosen, rejected
 
-    data = defaultdict(lambda: defaultdict(list))
+    data = PreferenceDataBuilder()
     for row in tqdm.tqdm(dataset, desc='Processing RLCD', disable=silent):
         prompt, chosen, rejected = split_prompt_and_responses(row)
-        responses = [chosen, rejected]
-        n_responses = len(data[prompt]['responses'])
-        data[prompt]['pairs'].append((n_responses, n_responses + 1))
-        data[prompt]['responses'].extend(responses)
-        data[prompt]['sft_target'] = chosen
+        data.add(prompt, [chosen, rejected], [(0, 1)], sft_target=chosen)
 
-    return data 
+    return data.build() 
 
 
-def get_alpaca(split: str, silent: bool = False, cache_dir: str = None) -> Dict[str, Dict[str, Union[List[Tuple[int, int]], List[str], str]]]:
+def get_alpaca(split: str, silent: bool = False, cache_dir: str = None) -> PreferenceData:
     """Load the AlpacaFarm dataset."""
     print(f'Loading AlpacaFarm dataset (split=all, ignoring arg) locally...')
     datapath = os.path.join(LOCAL_PATH, "farm/alpaca_human_preference.json")
@@ -191,41 +362,35 @@ def get_alpaca(split: str, silent: bool = False, cache_dir: str = None) -> Dict[
             chosen, rejected = rejected, chosen
         return prompt, chosen, rejected
 
-    data = defaultdict(lambda: defaultdict(list))
+    data = PreferenceDataBuilder()
     for row in tqdm.tqdm(dataset, desc='Processing Alpaca', disable=silent):
         prompt, chosen, rejected = split_prompt_and_responses(row)
-        responses = [chosen, rejected]
-        n_responses = len(data[prompt]['responses'])
-        data[prompt]['pairs'].append((n_responses, n_responses + 1))
-        data[prompt]['responses'].extend(responses)
-        data[prompt]['sft_target'] = chosen
+        data.add(prompt, [chosen, rejected], [(0, 1)], sft_target=chosen)
 
-    return data
+    return data.build()
 
 
-def get_stack(split: str, silent: bool = False, cache_dir: str = None) -> Dict[str, Dict[str, Union[List[Tuple[int, int]], List[str], str]]]:
+def split_stack_row(row: Dict) -> Tuple[str, str, str]:
+    """Return the prompt, chosen and rejected response of a row of the paired StackExchange dataset."""
+    prompt = row["question"]
+    chosen, rejected = row["response_j"], row["response_k"]
+    return prompt, chosen, rejected
+
+
+def get_stack(split: str, silent: bool = False, cache_dir: str = None) -> PreferenceData:
     print(f'Loading SE stack dataset (split={split}) from huggingface...')
     dataset = datasets.load_dataset("lvwerra/stack-exchange-paired", split=split, cache_dir=cache_dir)
     dataset = dataset.select(range(100000))  # see https://github.com/huggingface/trl
     print('done')
 
-    def split_prompt_and_responses(row):
-        prompt = row["question"]
-        chosen, rejected = row["response_j"], row["response_k"]
-        return prompt, chosen, rejected
-
-    data = defaultdict(lambda: defaultdict(list))
+    data = PreferenceDataBuilder()
     for row in tqdm.tqdm(dataset, desc='Processing Stack', disable=silent):
-        prompt, chosen, rejected = split_prompt_and_responses(row)
-        responses = [chosen, rejected]
-        n_responses = len(data[prompt]['responses'])
-        data[prompt]['pairs'].append((n_responses, n_responses + 1))
-        data[prompt]['responses'].extend(responses)
-        data[prompt]['sft_target'] = chosen
+        prompt, chosen, rejected = split_stack_row(row)
+        data.add(prompt, [chosen, rejected], [(0, 1)], sft_target=chosen)
 
-    return data
+    return data.build()
 
-def get_tldr(split: str, silent: bool = False, cache_dir: str = None) -> Dict[str, Dict[str, Union[List[Tuple[int, int]], List[str], str]]]:
+def get_tldr(split: str, silent: bool = False, cache_dir: str = None) -> PreferenceData:
     datapath = os.path.join(LOCAL_PATH, "tldr/comparisons")
 
     print(f"Loading TLDR dataset from {datapath} with '{split}' split, locally...")
@@ -258,55 +423,42 @@ def get_tldr(split: str, silent: bool = False, cache_dir: str = None) -> Dict[st
         chosen, rejected = row["chosen"], row["rejected"]
         return prompt, chosen, rejected
 
-    data = defaultdict(lambda: defaultdict(list))
+    data = PreferenceDataBuilder()
     for row in tqdm.tqdm(tldr, desc='Processing TLDR', disable=silent):
         prompt, chosen, rejected = split_prompt_and_responses(row)
-        responses = [chosen, rejected]
-        n_responses = len(data[prompt]['responses'])
-        data[prompt]['pairs'].append((n_responses, n_responses + 1))
-        data[prompt]['responses'].extend(responses)
-        data[prompt]['sft_target'] = chosen
+        data.add(prompt, [chosen, rejected], [(0, 1)], sft_target=chosen)
+
+    return data.build()
 
-    return data
 
+def split_ultrafeedback_row(ex: Dict) -> Tuple[str, str, str]:
+    """Return the prompt, chosen and rejected response of an UltraFeedback row."""
+    prompt = ex["prompt"]
+    chosen = ex["chosen"][1]["content"]
+    rejected = ex["rejected"][1]["content"]
+    return prompt, chosen, rejected
 
-def get_ultrafeedback(split: str, silent: bool = False, cache_dir: str = None) -> Dict[str, Dict[str, Union[List[Tuple[int, int]], List[str], str]]]:
+
+def get_ultrafeedback(split: str, silent: bool = False, cache_dir: str = None) -> PreferenceData:
     print(f'Loading UltraFeedback dataset ({split} split) from Huggingface...')
     split = "train_prefs" if split == "train" else "test_prefs"
     dataset = datasets.load_dataset("HuggingFaceH4/ultrafeedback_binarized", split=split, cache_dir=cache_dir)
 
-    def split_prompt_and_responses(ex):
-        prompt = ex["prompt"]
-        chosen = ex["chosen"][1]["content"]
-        rejected = ex["rejected"][1]["content"]
-        return prompt, chosen, rejected
-
-    data = defaultdict(lambda: defaultdict(list))
+    data = PreferenceDataBuilder()
     for row in tqdm.tqdm(dataset, desc='Processing Ultrafeedback (prefs)', disable=silent):
-        prompt, chosen, rejected = split_prompt_and_responses(row)
-        responses = [chosen, rejected]
-        n_responses = len(data[prompt]['responses'])
-        data[prompt]['pairs'].append((n_responses, n_responses + 1))
-        data[prompt]['responses'].extend(responses)
-        data[prompt]['sft_target'] = chosen
+        prompt, chosen, rejected = split_ultrafeedback_row(row)
+        data.add(prompt, [chosen, rejected], [(0, 1)], sft_target=chosen)
 
-    return data
+    return data.build()
 
 
-def get_hh(split: str, silent: bool = False, cache_dir: str = None) -> Dict[str, Dict[str, Union[List[Tuple[int, int]], List[str], str]]]:
+def get_hh(split: str, silent: bool = False, cache_dir: str = None) -> PreferenceData:
     """Load the Anthropic Helpful-Harmless dataset from Huggingface and convert it to the necessary format.
     
-       The dataset is converted to a dictionary with the following structure:
-       {
-           'prompt1': {
-               'responses': List[str],
-               'pairs': List[Tuple[int, int]],
-               'sft_target': str
-           },
-           'prompt2': {
-               ...
-           },
-       }
+       The dataset is converted to a PreferenceData, which holds for each prompt:
+           responses: List[str]
+           pairs: List[Tuple[int, int]] (indices of the chosen and rejected responses)
+           sft_target: str
 
        Prompts should be structured as follows:
          \n\nHuman: <prompt>\n\nAssistant:
@@ -324,19 +476,15 @@ def get_hh(split: str, silent: bool = False, cache_dir: str = None) -> Dict[str,
         rejected_response = ex['rejected'][len(prompt):]
         return prompt, chosen_response, rejected_response
 
-    data = defaultdict(lambda: defaultdict(list))
+    data = PreferenceDataBuilder()
     for row in tqdm.tqdm(dataset, desc='Processing HH', disable=silent):
         prompt, chosen, rejected = split_prompt_and_responses(row)
-        responses = [chosen, rejected]
-        n_responses = len(data[prompt]['responses'])
-        data[prompt]['pairs'].append((n_responses, n_responses + 1))
-        data[prompt]['responses'].extend(responses)
-        data[prompt]['sft_target'] = chosen
+        data.add(prompt, [chosen, rejected], [(0, 1)], sft_target=chosen)
 
-    return data
+    return data.build()
 
 
-def get_local_sampled(name: str, silent: bool, cache_dir: str = None):
+def get_local_sampled(name: str, silent: bool, cache_dir: str = None) -> PreferenceData:
 
     def trim(prompt, response):
         for i in range(len(prompt)):
@@ -347,29 +495,34 @@ def get_local_sampled(name: str, silent: bool, cache_dir: str = None):
 
     print(f"loading from local dataset {name}, ignoring cache_dir")
     with open(name, "r") as f:
-        dataset = json.load(f)
+        if name.endswith(".jsonl"):
+            # written by BasicTrainer.sample, one {"prompt": ..., "sample": ...} per line
+            dataset = {}
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    dataset[row["prompt"]] = row["sample"]
+        else:
+            dataset = json.load(f)
 
-    data = defaultdict(lambda: defaultdict(list))
+    data = PreferenceDataBuilder()
     for prompt in tqdm.tqdm(dataset, desc=f'Processing {name}', disable=silent):
         # sampled dataset looks like {prompt: sampled response}, so there is no "rejected"
-        # response. We set chosen = rejected = sampled as a dummy, b/c likely the only
-        # thing we're doing with this dataset is computing rewards.
+        # response. We pair the sample with itself, which get_batch_elements turns into a
+        # single-response element, b/c likely the only thing we're doing with this dataset
+        # is computing rewards.
         v = dataset[prompt]
         if isinstance(v, list):
             v = v[0]  # only take one sample if there are multiple
         response = trim(prompt, v)
         if prompt in response:
             print("found prompt in response, this is slightly strange but may be ok. check manually")
-        responses = [response, response]
-        n_responses = len(data[prompt]['responses'])
-        data[prompt]['pairs'].append((n_responses, n_responses + 1))
-        data[prompt]['responses'].extend(responses)
-        data[prompt]['sft_target'] = response
+        data.add(prompt, [response], [(0, 0)], sft_target=response)
 
-    return data
+    return data.build()
 
 
-def get_dataset(name: str, split: str, silent: bool = False, cache_dir: str = None):
+def get_dataset(name: str, split: str, silent: bool = False, cache_dir: str = None) -> PreferenceData:
     """Load the given dataset by name. Supported by default are 'shp', 'hh', and 'se'."""
     if name == 'shp':
         data = get_shp(split, silent=silent, cache_dir=cache_dir)
@@ -394,12 +547,145 @@ def get_dataset(name: str, split: str, silent: bool = False, cache_dir: str = No
     else:
         raise ValueError(f"Unknown dataset '{name}'")
 
-    assert set(list(data.values())[0].keys()) == {'responses', 'pairs', 'sft_target'}, \
-        f"Unexpected keys in dataset: {list(list(data.values())[0].keys())}"
+    assert isinstance(data, PreferenceData), f"Unexpected dataset type: {type(data)}"
 
     return data
 
 
+def get_se_test_rows(n_rows: int) -> Set[int]:
+    """Return the indices of the SE rows that get_se holds out as its test split: the first 1% of the permutation Dataset.shuffle(seed=42)
+       applies to the n_rows rows."""
+    permutation = np.random.default_rng(42).permutation(n_rows)
+    return set(permutation[:int(n_rows * 0.01)].tolist())
+
+
+def get_streaming_dataset(name: str, split: str, cache_dir: str = None) -> Iterator[Tuple[str, List[str], List[Tuple[int, int]], str]]:
+    """Read the (prompt, responses, pairs, sft_target) rows of the given dataset lazily from Huggingface, without downloading all of it.
+
+       Supported for 'shp', 'se', 'ultrafeedback' and 'stack'. Unlike get_dataset, rows are not grouped by prompt (a prompt with several
+         rows appears once per row, with the sft_target of that row). The SE splits hold the same rows as those of get_se (see get_se_test_rows).
+    """
+    if name == 'shp':
+        for row in datasets.load_dataset('stanfordnlp/SHP', split=split, cache_dir=cache_dir, streaming=True):
+            split_row = split_shp_row(row)
+            if split_row is not None:
+                prompt, responses, pairs, scores = split_row
+                yield prompt, responses, pairs, get_best_response(responses, scores)
+    elif name == 'se':
+        builder = datasets.load_dataset_builder('HuggingFaceH4/stack-exchange-preferences', cache_dir=cache_dir)
+        n_rows = builder.info.splits['train'].num_examples if builder.info.splits else None
+        if not n_rows:
+            raise ValueError("Can't stream the SE dataset: its number of rows (needed to reproduce the split of get_se) is unknown")
+        test_rows = get_se_test_rows(n_rows)
+        dataset = datasets.load_dataset('HuggingFaceH4/stack-exchange-preferences', split='train', cache_dir=cache_dir, streaming=True)
+        for row_idx, row in enumerate(dataset):
+            if (row_idx in test_rows) == (split == 'test'):
+                prompt, responses, pairs, scores = split_se_row(strip_se_html(row))
+                yield prompt, responses, pairs, get_best_response(responses, scores)
+    elif name == 'ultrafeedback':
+        split = "train_prefs" if split == "train" else "test_prefs"
+        for row in datasets.load_dataset("HuggingFaceH4/ultrafeedback_binarized", split=split, cache_dir=cache_dir, streaming=True):
+            prompt, chosen, rejected = split_ultrafeedback_row(row)
+            yield prompt, [chosen, rejected], [(0, 1)], chosen
+    elif name == 'stack':
+        for row in datasets.load_dataset("lvwerra/stack-exchange-paired", split=split, cache_dir=cache_dir, streaming=True).take(100000):
+            prompt, chosen, rejected = split_stack_row(row)
+            yield prompt, [chosen, rejected], [(0, 1)], chosen
+    else:
+        raise ValueError(f"Streaming is not supported for dataset '{name}'")
+
+
+def shuffle_buffered(iterable: Iterable, buffer_size: int, rng: random.Random) -> Iterator:
+    """Shuffle an iterable approximately, holding at most buffer_size items: each item read replaces a random item of the buffer, which is yielded."""
+    buffer = []
+    for item in iterable:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        idx = rng.randrange(buffer_size)
+        yield buffer[idx]
+        buffer[idx] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+class StringHashSet:
+    def __init__(self, capacity: int = 1024):
+        """A set of strings that only keeps a 64-bit hash of each, in an open-addressing numpy table with linear probing (0 marks an empty slot).
+
+           Membership is exact unless two different strings have the same hash: among n strings, the probability of any collision is
+             at most n^2 / 2^64 (about 5e-6 for 10 million strings), and a colliding string is then wrongly reported as present.
+             The table doubles whenever it is half full, so it takes 16 to 32 bytes per string, however long the strings are.
+        """
+        assert capacity > 0 and capacity & (capacity - 1) == 0, "capacity must be a power of 2"
+        self.table = np.zeros(capacity, dtype=np.uint64)
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    @staticmethod
+    def _hash(text: str) -> int:
+        return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+
+    def _find(self, h: int) -> Tuple[int, bool]:
+        """Return the slot of hash h (or the empty slot where it would go), and whether h is in the table."""
+        mask = len(self.table) - 1
+        slot = h & mask
+        while True:
+            value = int(self.table[slot])
+            if value == 0 or value == h:
+                return slot, value == h
+            slot = (slot + 1) & mask
+
+    def __contains__(self, text: str) -> bool:
+        return self._find(self._hash(text))[1]
+
+    def add(self, text: str) -> bool:
+        """Add text to the set, and return whether it was already in it."""
+        h = self._hash(text)
+        slot, found = self._find(h)
+        if found:
+            return True
+        self.table[slot] = h
+        self.n += 1
+        if 2 * self.n > len(self.table):
+            hashes = self.table[self.table != 0].tolist()
+            self.table = np.zeros(2 * len(self.table), dtype=np.uint64)
+            for h in hashes:
+                self.table[self._find(h)[0]] = h
+        return False
+
+
+def get_cache_path(cache_dir: str, kind: str, name: str, split: str, tokenizer, **kwargs) -> str:
+    """Return the path of a cached artifact (e.g., reference log probs) for a dataset split.
+
+       The file name is keyed by the dataset name, split, tokenizer, and any extra kwargs (e.g., max_length),
+         so changing any of them results in a different path.
+    """
+    if os.path.exists(name):  # local datasets may be rewritten, so also key on the file's size and modification time
+        kwargs = dict(kwargs, source=(os.path.getsize(name), os.path.getmtime(name)))
+    key = json.dumps(dict(name=name, split=split, tokenizer=tokenizer.name_or_path, **kwargs), sort_keys=True)
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{kind}_{os.path.basename(name)}_{split}_{digest}")
+
+
+def get_reference_logps_path(reference_logps_dir: str, name: str, split: str, tokenizer, max_length: int, max_prompt_length: int,
+                             reference_archive: Optional[str] = None) -> str:
+    """Return the path of the precomputed reference log probs for a dataset split.
+
+       The file holds a float32 array of shape (n_pairs, 2) with the reference log probs of the chosen and
+         rejected responses of each preference pair, indexed by the pair's example_id (see get_batch_iterator).
+       It is also keyed by reference_archive, the archive of the reference weights (None for the pretrained weights), and by the
+         archive's size and modification time, so log probs of other reference weights are never read in its place.
+    """
+    reference = reference_archive
+    if reference_archive is not None and os.path.exists(reference_archive):
+        reference = (os.path.abspath(reference_archive), os.path.getsize(reference_archive), os.path.getmtime(reference_archive))
+    return get_cache_path(reference_logps_dir, 'reference_logps', name, split, tokenizer,
+                          max_length=max_length, max_prompt_length=max_prompt_length, reference=reference) + '.npy'
+
+
 def get_collate_fn(tokenizer) -> Callable[[List[Dict]], Dict[str, Union[List, torch.Tensor]]]:
     """Returns a collate function for the given tokenizer.
     
@@ -429,6 +715,8 @@ def get_collate_fn(tokenizer) -> Callable[[List[Dict]], Dict[str, Union[List, to
                     padded_batch[k] = padded_batch[k].flip(dims=[1])
             elif k.endswith("_len"):
                 padded_batch[k] = torch.LongTensor([ex[k] for ex in batch])
+            elif k.endswith("_logps"):
+                padded_batch[k] = torch.FloatTensor([ex[k] for ex in batch])
             else:
                 padded_batch[k] = [ex[k] for ex in batch]
 
@@ -447,65 +735,708 @@ def tokenize_batch_element(prompt: str, chosen: str, rejected: str, truncation_m
          the sum of the length of the prompt and the chosen/rejected response, with -100 for the
          prompt tokens.
     """
-    chosen_tokens = tokenizer(chosen, add_special_tokens=False)
-    rejected_tokens = tokenizer(rejected, add_special_tokens=False)
-    prompt_tokens = tokenizer(prompt, add_special_tokens=False)
+    chosen_tokens = tokenizer(chosen, add_special_tokens=False)['input_ids']
+    rejected_tokens = tokenizer(rejected, add_special_tokens=False)['input_ids']
+    prompt_tokens = tokenizer(prompt, add_special_tokens=False)['input_ids']
 
-    assert tokenizer.eos_token_id not in prompt_tokens['input_ids'], f"Prompt contains EOS token: {prompt}"
-    assert tokenizer.eos_token_id not in chosen_tokens['input_ids'], f"Chosen response contains EOS token: {chosen}"
-    assert tokenizer.eos_token_id not in rejected_tokens['input_ids'], f"Rejected response contains EOS token: {rejected}"
+    return truncate_batch_element(prompt, chosen, rejected, prompt_tokens, chosen_tokens, rejected_tokens, truncation_mode, tokenizer.eos_token_id,
+                                  max_length, max_prompt_length)
 
-    chosen_tokens['input_ids'].append(tokenizer.eos_token_id)
-    chosen_tokens['attention_mask'].append(1)
 
-    rejected_tokens['input_ids'].append(tokenizer.eos_token_id)
-    rejected_tokens['attention_mask'].append(1)
+def truncate_batch_element(prompt: str, chosen: str, rejected: str, prompt_tokens: List[int], chosen_tokens: List[int], rejected_tokens: List[int],
+                           truncation_mode: str, eos_token_id: int, max_length: int, max_prompt_length: int) -> Dict:
+    """Build a batch element from the (untruncated, without EOS) token ids of the prompt and responses, as in tokenize_batch_element.
+
+       The token id lists are not modified, so they can be shared between the elements of a prompt.
+    """
+    assert eos_token_id not in prompt_tokens, f"Prompt contains EOS token: {prompt}"
+    assert eos_token_id not in chosen_tokens, f"Chosen response contains EOS token: {chosen}"
+    assert eos_token_id not in rejected_tokens, f"Rejected response contains EOS token: {rejected}"
 
-    longer_response_length = max(len(chosen_tokens['input_ids']), len(rejected_tokens['input_ids']))
+    chosen_tokens = chosen_tokens + [eos_token_id]
+    rejected_tokens = rejected_tokens + [eos_token_id]
+
+    longer_response_length = max(len(chosen_tokens), len(rejected_tokens))
 
     # if combined sequence is too long, truncate the prompt
-    if len(prompt_tokens['input_ids']) + longer_response_length > max_length:
+    if len(prompt_tokens) + longer_response_length > max_length:
         if truncation_mode == 'keep_start':
-            prompt_tokens = {k: v[:max_prompt_length] for k, v in prompt_tokens.items()}
+            prompt_tokens = prompt_tokens[:max_prompt_length]
         elif truncation_mode == 'keep_end':
-            prompt_tokens = {k: v[-max_prompt_length:] for k, v in prompt_tokens.items()}
+            prompt_tokens = prompt_tokens[-max_prompt_length:]
         else:
             raise ValueError(f'Unknown truncation mode: {truncation_mode}')
 
     # if that's still too long, truncate the response
-    batch = {"chosen_len_real": len(chosen_tokens['input_ids']),
-             "rejected_len_real": len(rejected_tokens['input_ids'])}
+    chosen_len_real, rejected_len_real = len(chosen_tokens), len(rejected_tokens)
+    if len(prompt_tokens) + longer_response_length > max_length:
+        chosen_tokens = chosen_tokens[:max_length - max_prompt_length]
+        rejected_tokens = rejected_tokens[:max_length - max_prompt_length]
 
-    if len(prompt_tokens['input_ids']) + longer_response_length > max_length:
-        chosen_tokens = {k: v[:max_length - max_prompt_length] for k, v in chosen_tokens.items()}
-        rejected_tokens = {k: v[:max_length - max_prompt_length] for k, v in rejected_tokens.items()}
+    return build_batch_element(prompt, chosen, rejected, list(prompt_tokens), chosen_tokens, rejected_tokens, chosen_len_real, rejected_len_real)
 
-    # Create labels
-    chosen_sequence_tokens = {k: prompt_tokens[k] + chosen_tokens[k] for k in chosen_tokens}
-    rejected_sequence_tokens = {k: prompt_tokens[k] + rejected_tokens[k] for k in rejected_tokens}
-    chosen_sequence_tokens['labels'] = chosen_sequence_tokens['input_ids'][:]
-    chosen_sequence_tokens['labels'][:len(prompt_tokens['input_ids'])] = [-100] * len(prompt_tokens['input_ids'])
-    rejected_sequence_tokens['labels'] = rejected_sequence_tokens['input_ids'][:]
-    rejected_sequence_tokens['labels'][:len(prompt_tokens['input_ids'])] = [-100] * len(prompt_tokens['input_ids'])
+
+def build_batch_element(prompt: str, chosen: str, rejected: str, prompt_tokens: List[int], chosen_tokens: List[int], rejected_tokens: List[int],
+                        chosen_len_real: int, rejected_len_real: int) -> Dict:
+    """Build a batch element from already truncated prompt and response token ids (see tokenize_batch_element).
+
+       chosen_len_real and rejected_len_real are the lengths of the responses before truncation.
+    """
+    batch = {"chosen_len_real": chosen_len_real,
+             "rejected_len_real": rejected_len_real}
 
     batch['prompt'] = prompt
     batch['chosen'] = prompt + chosen
     batch['rejected'] = prompt + rejected
     batch['chosen_response_only'] = chosen
     batch['rejected_response_only'] = rejected
-    batch['chosen_len'] = len(chosen_tokens['input_ids'])
-    batch['rejected_len'] = len(rejected_tokens['input_ids'])
-    batch['prompt_len'] = len(prompt_tokens['input_ids'])
+    batch['chosen_len'] = len(chosen_tokens)
+    batch['rejected_len'] = len(rejected_tokens)
+    batch['prompt_len'] = len(prompt_tokens)
 
-    for k, toks in {'chosen': chosen_sequence_tokens, 'rejected': rejected_sequence_tokens, 'prompt': prompt_tokens}.items():
-        for type_key, tokens in toks.items():
-            if type_key == 'token_type_ids':
-                continue
-            batch[f'{k}_{type_key}'] = tokens
+    # Create labels
+    for k, tokens in {'chosen': chosen_tokens, 'rejected': rejected_tokens}.items():
+        batch[f'{k}_input_ids'] = prompt_tokens + tokens
+        batch[f'{k}_attention_mask'] = [1] * (len(prompt_tokens) + len(tokens))
+        batch[f'{k}_labels'] = [-100] * len(prompt_tokens) + tokens
+    batch['prompt_input_ids'] = prompt_tokens
+    batch['prompt_attention_mask'] = [1] * len(prompt_tokens)
 
     return batch
 
 
+def tokenize_texts(prompts: List[Tuple[str, List[str], List[Tuple[int, int]], str, int]], tokenizer,
+                   sft_mode: bool) -> Tuple[List[List[Tuple[str, str, bool]]], Dict[str, List[int]]]:
+    """Return the (chosen, rejected, single_response) texts of the batch elements of each of a chunk of prompts, and the token ids of
+       each unique prompt and response among them, tokenized in a single (batched) call to the tokenizer."""
+    to_tokenize = []
+    for prompt, responses, pairs, sft_target, _ in prompts:
+        to_tokenize.append([(sft_target, sft_target, True)] if sft_mode else [(responses[i], responses[j], i == j) for i, j in pairs])
+
+    texts = list(dict.fromkeys(text for (prompt, *_), elements in zip(prompts, to_tokenize)
+                               for text in [prompt] + [response for chosen, rejected, _ in elements for response in (chosen, rejected)]))
+    token_ids = dict(zip(texts, tokenizer(texts, add_special_tokens=False)['input_ids'])) if texts else {}
+    return to_tokenize, token_ids
+
+
+def tokenize_prompts(prompts: List[Tuple[str, List[str], List[Tuple[int, int]], str, int]], truncation_mode: str, tokenizer, max_length: int,
+                     max_prompt_length: int, sft_mode: bool) -> List[List[Tuple[int, Dict]]]:
+    """Tokenize the batch elements of a chunk of prompts, each given as a (prompt, responses, pairs, sft_target, pair_offset) tuple.
+
+       Returns a list of (example_id, batch element) tuples per prompt (see get_batch_elements). Each unique prompt and response
+         in the chunk is tokenized only once, in a single (batched) call to the tokenizer; truncation is then done on the token ids.
+    """
+    to_tokenize, token_ids = tokenize_texts(prompts, tokenizer, sft_mode)
+    results = []
+    for (prompt, _, _, _, pair_offset), elements in zip(prompts, to_tokenize):
+        prompt_results = []
+        for pair_idx, (chosen, rejected, single_response) in enumerate(elements):
+            try:
+                batch_element = truncate_batch_element(prompt, chosen, rejected, token_ids[prompt], token_ids[chosen], token_ids[rejected], truncation_mode,
+                                                       tokenizer.eos_token_id, max_length, max_prompt_length)
+            except AssertionError:
+                print("failed to load 1 sample")
+                continue
+            if single_response:
+                batch_element = {k: v for k, v in batch_element.items() if 'rejected' not in k}
+            prompt_results.append((pair_offset + pair_idx, batch_element))
+        results.append(prompt_results)
+    return results
+
+
+def get_batch_elements(prompt: str, responses: List[str], pairs: List[Tuple[int, int]], sft_target: str, truncation_mode: str, tokenizer,
+                       max_length: int, max_prompt_length: int, sft_mode: bool, pair_offset: int = 0) -> Iterator[Tuple[int, Dict]]:
+    """Tokenize the batch elements of a single prompt, yielding (example_id, batch element) tuples.
+
+       In sft mode, there is a single element for the sft_target (without the rejected keys); otherwise there is
+         one element per preference pair, whose example_id is pair_offset plus the index of the pair. A pair of a
+         response with itself (e.g., from get_local_sampled) has no rejected response, so its element only has the
+         chosen keys, as in sft mode. Elements that fail to tokenize (e.g., because they contain the EOS token) are skipped.
+    """
+    yield from tokenize_prompts([(prompt, responses, pairs, sft_target, pair_offset)], truncation_mode, tokenizer, max_length, max_prompt_length, sft_mode)[0]
+
+
+def tokenize_data_prompts(data: PreferenceData, idxs: List[int], truncation_mode: str, tokenizer, max_length: int, max_prompt_length: int,
+                          sft_mode: bool) -> List[List[Tuple[int, Dict]]]:
+    """Tokenize the batch elements of the given prompts of a dataset returned by get_dataset (see tokenize_prompts)."""
+    return tokenize_prompts([data[idx] for idx in idxs], truncation_mode, tokenizer, max_length, max_prompt_length, sft_mode)
+
+
+def get_example_ids(prompts: List[Tuple[str, List[str], List[Tuple[int, int]], str, int]], tokenizer, sft_mode: bool) -> List[List[int]]:
+    """Return the example ids of the batch elements that tokenize_prompts would return for a chunk of prompts, without building the elements.
+
+       The texts are tokenized as in tokenize_prompts, and an element fails to tokenize when the token ids of its prompt or one of its
+         responses contain the EOS token id (see truncate_batch_element).
+    """
+    to_tokenize, token_ids = tokenize_texts(prompts, tokenizer, sft_mode)
+    example_ids = []
+    for (prompt, _, _, _, pair_offset), elements in zip(prompts, to_tokenize):
+        example_ids.append([pair_offset + pair_idx for pair_idx, (chosen, rejected, _) in enumerate(elements)
+                            if not any(tokenizer.eos_token_id in token_ids[text] for text in (prompt, chosen, rejected))])
+    return example_ids
+
+
+def get_data_example_ids(data: PreferenceData, idxs: List[int], tokenizer, sft_mode: bool) -> List[List[int]]:
+    """Return the example ids of the batch elements of the given prompts of a dataset returned by get_dataset (see get_example_ids)."""
+    return get_example_ids([data[idx] for idx in idxs], tokenizer, sft_mode)
+
+
+class TokenizedDataset:
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        """The tokenized batch elements of a dataset split, stored as flat numpy arrays with offsets.
+
+           Elements are grouped by prompt, in the order of get_dataset. Token ids and texts are stored flat, with
+             an offsets array per key (e.g., chosen_ids[chosen_ids_offsets[i]:chosen_ids_offsets[i + 1]] are the
+             truncated chosen token ids of element i), so a saved dataset can be memory-mapped instead of re-tokenized.
+        """
+        self.arrays = arrays
+        self.single_response = 'rejected_ids' not in arrays
+
+    def __len__(self):
+        return len(self.arrays['group_offsets']) - 1
+
+    def _slice(self, key: str, idx: int) -> np.ndarray:
+        offsets = self.arrays[f'{key}_offsets']
+        return self.arrays[key][offsets[idx]:offsets[idx + 1]]
+
+    def _text(self, key: str, idx: int) -> str:
+        return self._slice(key, idx).tobytes().decode('utf-8')
+
+    def get_elements(self, idx: int) -> Iterator[Tuple[int, Dict]]:
+        """Yield the (example_id, batch element) tuples of the idx-th prompt, as get_batch_elements would."""
+        prompt = self._text('prompt_text', idx)
+        for element_idx in range(self.arrays['group_offsets'][idx], self.arrays['group_offsets'][idx + 1]):
+            chosen, chosen_tokens = self._text('chosen_text', element_idx), self._slice('chosen_ids', element_idx).tolist()
+            if self.single_response:
+                rejected, rejected_tokens = chosen, chosen_tokens
+            else:
+                rejected, rejected_tokens = self._text('rejected_text', element_idx), self._slice('rejected_ids', element_idx).tolist()
+
+            batch_element = build_batch_element(prompt, chosen, rejected, self._slice('prompt_ids', element_idx).tolist(), chosen_tokens, rejected_tokens,
+                                                int(self.arrays['chosen_len_real'][element_idx]), int(self.arrays['rejected_len_real'][element_idx]))
+            if self.single_response:
+                batch_element = {k: v for k, v in batch_element.items() if 'rejected' not in k}
+            yield int(self.arrays['example_id'][element_idx]), batch_element
+
+    def get_chunk_elements(self, idxs: List[int]) -> List[List[Tuple[int, Dict]]]:
+        """Return the (example_id, batch element) tuples of each of the given prompts, as tokenize_prompts would."""
+        return [list(self.get_elements(idx)) for idx in idxs]
+
+    def get_chunk_prompts(self, idxs: List[int]) -> List[str]:
+        return [self._text('prompt_text', idx) for idx in idxs]
+
+    def get_chunk_example_ids(self, idxs: List[int]) -> List[List[int]]:
+        """Return the example ids of the elements of each of the given prompts, without building the elements."""
+        group_offsets = self.arrays['group_offsets']
+        return [self.arrays['example_id'][group_offsets[idx]:group_offsets[idx + 1]].tolist() for idx in idxs]
+
+    @classmethod
+    def build(cls, data: PreferenceData, truncation_mode: str, tokenizer, max_length: int, max_prompt_length: int, sft_mode: bool,
+              silent: bool = False) -> 'TokenizedDataset':
+        """Tokenize every batch element of a dataset returned by get_dataset."""
+        single_response = sft_mode or bool(np.all(data.arrays['pairs'][:, 0] == data.arrays['pairs'][:, 1]))
+        ragged_keys = ['prompt_text', 'prompt_ids', 'chosen_ids', 'chosen_text'] + ([] if single_response else ['rejected_ids', 'rejected_text'])
+        ragged = {k: [] for k in ragged_keys}
+        flat = {k: [] for k in ['example_id', 'chosen_len_real', 'rejected_len_real']}
+        group_offsets = [0]
+
+        encode = lambda text: np.frombuffer(text.encode('utf-8'), dtype=np.uint8)
+        for start in tqdm.tqdm(range(0, len(data), TOKENIZATION_CHUNK_SIZE), desc='Tokenizing', disable=silent):
+            chunk = [data[idx] for idx in range(start, min(start + TOKENIZATION_CHUNK_SIZE, len(data)))]
+            for (prompt, *_), elements in zip(chunk, tokenize_prompts(chunk, truncation_mode, tokenizer, max_length, max_prompt_length, sft_mode)):
+                ragged['prompt_text'].append(encode(prompt))
+                for example_id, batch_element in elements:
+                    flat['example_id'].append(example_id)
+                    ragged['prompt_ids'].append(np.array(batch_element['prompt_input_ids'], dtype=np.int32))
+                    for k in ['chosen'] if single_response else ['chosen', 'rejected']:
+                        ragged[f'{k}_ids'].append(np.array(batch_element[f'{k}_labels'][batch_element['prompt_len']:], dtype=np.int32))
+                        ragged[f'{k}_text'].append(encode(batch_element[f'{k}_response_only']))
+                    flat['chosen_len_real'].append(batch_element['chosen_len_real'])
+                    flat['rejected_len_real'].append(batch_element['chosen_len_real' if single_response else 'rejected_len_real'])
+                group_offsets.append(len(flat['example_id']))
+
+        arrays = {'group_offsets': np.array(group_offsets, dtype=np.int64)}
+        for k, v in flat.items():
+            arrays[k] = np.array(v, dtype=np.int64)
+        for k, v in ragged.items():
+            arrays[f'{k}_offsets'] = np.concatenate([[0], np.cumsum([len(x) for x in v], dtype=np.int64)])
+            arrays[k] = np.concatenate(v) if v else np.zeros(0, dtype=np.int32 if k.endswith('_ids') else np.uint8)
+        return cls(arrays)
+
+    def save(self, path: str):
+        save_arrays(self.arrays, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'TokenizedDataset':
+        """Memory-map a dataset written by save."""
+        return cls(load_arrays(path))
+
+
+def get_tokenized_dataset(name: str, split: str, tokenizer, truncation_mode: str, max_length: int, max_prompt_length: int, sft_mode: bool,
+                          seed: int, tokenized_cache_dir: str, silent: bool = False, cache_dir: str = None) -> TokenizedDataset:
+    """Load the tokenized dataset from tokenized_cache_dir, tokenizing and caching it first if needed.
+
+       The seed is part of the cache key because some loaders (e.g., webgpt) break ties randomly.
+    """
+    path = get_cache_path(tokenized_cache_dir, 'tokenized', name, split, tokenizer, truncation_mode=truncation_mode, max_length=max_length,
+                          max_prompt_length=max_prompt_length, sft_mode=sft_mode, seed=seed, version=TOKENIZED_CACHE_VERSION)
+    if not os.path.exists(path):
+        data = get_dataset(name, split, silent=silent, cache_dir=cache_dir)
+        os.makedirs(tokenized_cache_dir, exist_ok=True)
+        TokenizedDataset.build(data, truncation_mode, tokenizer, max_length, max_prompt_length, sft_mode, silent=silent).save(path)
+        print(f'Cached tokenized {name} ({split} split) to {path}')
+    else:
+        print(f'Loading tokenized {name} ({split} split) from {path}')
+    return TokenizedDataset.load(path)
+
+
+def get_padded_length(batch_element: Dict) -> int:
+    """Return the length a batch element is padded to, i.e. the longer of its chosen and rejected sequences (see concatenated_inputs)."""
+    return max(len(batch_element['chosen_input_ids']), len(batch_element.get('rejected_input_ids', ())))
+
+
+def count_padding(batch: List[Dict]) -> Tuple[int, int]:
+    """Return the number of real (non-padding) tokens in a batch, and the total number of tokens once padded."""
+    if not batch:
+        return 0, 0
+    keys = [k for k in ('chosen_input_ids', 'rejected_input_ids') if k in batch[0]]
+    n_real = sum(len(ex[k]) for ex in batch for k in keys)
+    n_padded = len(keys) * len(batch) * max(get_padded_length(ex) for ex in batch)
+    return n_real, n_padded
+
+
+def get_local_indices(n: int, rank: int, world_size: int, n_microbatches: int = 1) -> List[int]:
+    """Return the indices of the elements of a batch of n elements that belong to the given rank, i.e. the rank's chunk of each
+       of the batch's n_microbatches microbatches, as slicing with slice_and_move_batch_for_device would give it."""
+    microbatch_size = n // n_microbatches
+    chunk_size = microbatch_size // world_size
+    return [microbatch_idx * microbatch_size + rank * chunk_size + idx for microbatch_idx in range(n_microbatches) for idx in range(chunk_size)]
+
+
+def get_chunk_elements(flat_data: List[Tuple[str, Any]], chunk_fns: Dict[str, Callable], chunk: List[int]) -> List[List[Tuple[int, Dict]]]:
+    """Return the (example_id, batch element) tuples of each of the given prompts of flat_data (see PromptSource), tokenizing
+       the prompts of each dataset together with that dataset's chunk function (or whatever else chunk_fns return per prompt)."""
+    idxs_by_name = defaultdict(list)
+    for idx in chunk:
+        idxs_by_name[flat_data[idx][0]].append(idx)
+    elements = {}
+    for name, idxs in idxs_by_name.items():
+        elements.update(zip(idxs, chunk_fns[name]([flat_data[idx][1] for idx in idxs])))
+    return [elements[idx] for idx in chunk]
+
+
+# the PromptSource of the get_batch_iterator that started a tokenization pool; its workers inherit it when they are forked
+_pool_source = None
+
+
+def _get_pool_elements(chunk: List[int]) -> List[List[Tuple[int, Dict]]]:
+    """Tokenize a chunk of prompts of _pool_source, in a tokenization pool worker."""
+    return _pool_source.tokenize(chunk)
+
+
+class PromptSource:
+    def __init__(self, flat_data: List[Tuple[str, Any]], chunk_fns: Dict[str, Callable], id_fns: Dict[str, Callable], prompt_fns: Dict[str, Callable]):
+        """The source stage of get_batch_iterator: prompts that are tokenized into batch elements in chunks.
+
+           flat_data holds a (dataset name, item) tuple per prompt (e.g., the prompt's index in the dataset), where chunk_fns[name] tokenizes the
+             items of a chunk of prompts of that dataset into their (example_id, batch element) tuples, and id_fns[name] and prompt_fns[name]
+             return their example ids and prompts without tokenizing them (see get_chunk_elements).
+        """
+        self.flat_data = flat_data
+        self.chunk_fns = chunk_fns
+        self.id_fns = id_fns
+        self.prompt_fns = prompt_fns
+
+    def __len__(self):
+        return len(self.flat_data)
+
+    def name(self, idx: int) -> str:
+        return self.flat_data[idx][0]
+
+    def tokenize(self, idxs: List[int]) -> List[List[Tuple[int, Dict]]]:
+        return get_chunk_elements(self.flat_data, self.chunk_fns, idxs)
+
+    def example_ids(self, idxs: List[int]) -> List[List[int]]:
+        return get_chunk_elements(self.flat_data, self.id_fns, idxs)
+
+    def prompts(self, idxs: List[int]) -> List[str]:
+        return get_chunk_elements(self.flat_data, self.prompt_fns, idxs)
+
+    def plan_chunk(self, idxs: List[int], prompt_filter: Optional[Callable]) -> Tuple[List[int], Optional[List[List[int]]]]:
+        """Return the prompts of a chunk to tokenize, and (with a prompt_filter) the example ids of the elements of each prompt of the chunk."""
+        if prompt_filter is None:
+            return idxs, None
+        example_ids = self.example_ids(idxs)
+        return prompt_filter(idxs, example_ids, self.prompts), example_ids
+
+    def assemble_chunk(self, idxs: List[int], to_tokenize: List[int], example_ids: Optional[List[List[int]]],
+                       tokenized: List[List[Tuple[int, Dict]]]) -> List[List[Tuple[int, Optional[Dict]]]]:
+        """Return the (example_id, batch element) tuples of each prompt of a chunk, given those of the prompts that were tokenized; the
+           elements of the others are (example_id, None)."""
+        if example_ids is None:
+            return tokenized
+        tokenized = dict(zip(to_tokenize, tokenized))
+        elements = []
+        for idx, prompt_ids in zip(idxs, example_ids):
+            if idx not in tokenized:
+                elements.append([(example_id, None) for example_id in prompt_ids])
+                continue
+            # the example ids were found without building the elements (see get_example_ids), and every rank must find the same ones
+            actual_ids = [example_id for example_id, _ in tokenized[idx]]
+            assert actual_ids == prompt_ids, f'prompt {idx} of {self.name(idx)} tokenized into elements {actual_ids}, but get_example_ids predicted {prompt_ids}'
+            elements.append(tokenized[idx])
+        return elements
+
+    def read(self, idxs: List[int], prompt_filter: Optional[Callable] = None, num_proc: Optional[int] = None) -> Iterator[Tuple[str, List[Tuple[int, Optional[Dict]]]]]:
+        """Yield the name and (example_id, batch element) tuples of each of the given prompts, tokenizing them in chunks of TOKENIZATION_CHUNK_SIZE
+           prompts (in a pool of num_proc processes, if given, so the elements are the same as without it).
+
+           If prompt_filter (the filter stage, e.g. a Deduplicator) is given, prompt_filter(chunk, example_ids, get_prompts) returns the prompts of
+             each chunk to tokenize, given the example ids of each prompt's elements; the elements of the others are yielded as (example_id, None).
+        """
+        chunks = [idxs[i:i + TOKENIZATION_CHUNK_SIZE] for i in range(0, len(idxs), TOKENIZATION_CHUNK_SIZE)]
+        if not num_proc:
+            for chunk in chunks:
+                to_tokenize, example_ids = self.plan_chunk(chunk, prompt_filter)
+                for idx, elements in zip(chunk, self.assemble_chunk(chunk, to_tokenize, example_ids, self.tokenize(to_tokenize))):
+                    yield self.name(idx), elements
+            return
+
+        global _pool_source
+        _pool_source = self
+        windows = [chunks[i:i + num_proc * 4] for i in range(0, len(chunks), num_proc * 4)]
+        # tokenize the next window while the current one is consumed, so at most two windows are held in memory
+        with multiprocessing.get_context('fork').Pool(num_proc) as pool:
+            def get_window(window):
+                plans = [self.plan_chunk(chunk, prompt_filter) for chunk in window]
+                return plans, pool.map_async(_get_pool_elements, [to_tokenize for to_tokenize, _ in plans], chunksize=1)
+
+            pending = get_window(windows[0]) if windows else None
+            for window_idx, window in enumerate(windows):
+                plans, results = pending[0], pending[1].get()
+                if window_idx + 1 < len(windows):
+                    pending = get_window(windows[window_idx + 1])
+                for chunk, (to_tokenize, example_ids), chunk_elements in zip(window, plans, results):
+                    for idx, elements in zip(chunk, self.assemble_chunk(chunk, to_tokenize, example_ids, chunk_elements)):
+                        yield self.name(idx), elements
+
+
+def get_prompt_source(names: List[str], tokenizer, split: str, max_length: int, max_prompt_length: int, sft_mode: bool, seed: int,
+                      silent: bool = False, cache_dir: Optional[str] = None, tokenized_cache_dir: Optional[str] = None) -> PromptSource:
+    """Return the PromptSource of the prompts of the given datasets, in the order of names and then of get_dataset (or, with
+       tokenized_cache_dir, of their tokenized datasets, see get_tokenized_dataset)."""
+    flat_data = []
+    chunk_fns, id_fns, prompt_fns = {}, {}, {}
+    for name in names:
+        truncation_mode = 'keep_end'# if name == 'hh' or name == 'tldr' else 'keep_start'
+        if tokenized_cache_dir is not None:
+            tokenized = get_tokenized_dataset(name, split, tokenizer, truncation_mode, max_length, max_prompt_length, sft_mode, seed,
+                                              tokenized_cache_dir, silent=silent, cache_dir=cache_dir)
+            chunk_fns[name] = tokenized.get_chunk_elements
+            id_fns[name] = tokenized.get_chunk_example_ids
+            prompt_fns[name] = tokenized.get_chunk_prompts
+            flat_data.extend((name, idx) for idx in range(len(tokenized)))
+            continue
+
+        data = get_dataset(name, split, silent=silent, cache_dir=cache_dir)
+        chunk_fns[name] = functools.partial(tokenize_data_prompts, data, truncation_mode=truncation_mode, tokenizer=tokenizer, max_length=max_length,
+                                            max_prompt_length=max_prompt_length, sft_mode=sft_mode)
+        id_fns[name] = functools.partial(get_data_example_ids, data, tokenizer=tokenizer, sft_mode=sft_mode)
+        prompt_fns[name] = lambda idxs, data=data: [data.prompt(idx) for idx in idxs]
+        flat_data.extend((name, idx) for idx in range(len(data)))
+    return PromptSource(flat_data, chunk_fns, id_fns, prompt_fns)
+
+
+class StreamSource:
+    def __init__(self, names: List[str], tokenizer, split: str, max_length: int, max_prompt_length: int, sft_mode: bool,
+                 cache_dir: Optional[str] = None, shuffle_buffer_size: int = 10000):
+        """The source stage of a streaming get_batch_iterator: the rows of the given datasets, read with get_streaming_dataset, taking a row
+           of each dataset in turn. Each chunk of rows is read as a PromptSource over the rows themselves."""
+        self.names = names
+        self.split = split
+        self.cache_dir = cache_dir
+        self.shuffle_buffer_size = shuffle_buffer_size
+        truncation_mode = 'keep_end'
+        self.chunk_fns = dict.fromkeys(names, functools.partial(tokenize_prompts, truncation_mode=truncation_mode, tokenizer=tokenizer,
+                                                                max_length=max_length, max_prompt_length=max_prompt_length, sft_mode=sft_mode))
+        self.id_fns = dict.fromkeys(names, functools.partial(get_example_ids, tokenizer=tokenizer, sft_mode=sft_mode))
+        self.prompt_fns = dict.fromkeys(names, lambda rows: [row[0] for row in rows])
+
+    def iter_rows(self) -> Iterator[Tuple[str, Tuple[str, List[str], List[Tuple[int, int]], str, int]]]:
+        """Yield the name and (prompt, responses, pairs, sft_target, pair_offset) tuple of each row, taking a row of each dataset in turn."""
+        pair_offsets = dict.fromkeys(self.names, 0)
+        streams = [(name, get_streaming_dataset(name, self.split, cache_dir=self.cache_dir)) for name in self.names]
+        while streams:
+            remaining = []
+            for name, rows in streams:
+                row = next(rows, None)
+                if row is not None:
+                    yield name, (*row, pair_offsets[name])
+                    pair_offsets[name] += len(row[2])
+                    remaining.append((name, rows))
+            streams = remaining
+
+    def read(self, rng: Optional[random.Random], start: int = 0, restore: List[int] = (),
+             prompt_filter: Optional[Callable] = None) -> Iterator[Tuple[int, str, List[Tuple[int, Optional[Dict]]]]]:
+        """Yield the position, name and (example_id, batch element) tuples of the rows, shuffled with a buffer of shuffle_buffer_size rows
+           by rng (if given). The rows before start are skipped, except for those at the positions in restore, which are read first.
+           prompt_filter is applied to each chunk of rows as in PromptSource.read."""
+        rows = self.iter_rows() if rng is None else shuffle_buffered(self.iter_rows(), self.shuffle_buffer_size, rng)
+        restore = set(restore)
+        restored_rows = [(position, row) for position, row in enumerate(itertools.islice(rows, start)) if position in restore]
+        rows = enumerate(rows, start)
+        if start in restore:  # the row at start was partly read, so it is both restored and read again
+            row = next(rows, None)
+            if row is not None:
+                restored_rows.append(row)
+                rows = itertools.chain([row], rows)
+        rows = itertools.chain(restored_rows, rows)
+        while True:
+            chunk = list(itertools.islice(rows, TOKENIZATION_CHUNK_SIZE))
+            if not chunk:
+                return
+            chunk_source = PromptSource([row for _, row in chunk], self.chunk_fns, self.id_fns, self.prompt_fns)
+            for (position, _), (name, elements) in zip(chunk, chunk_source.read(list(range(len(chunk))), prompt_filter)):
+                yield position, name, elements
+
+
+class EpochOrder:
+    def __init__(self, n_prompts: int, seed: int, shuffle: bool = True):
+        """The shuffle stage of get_batch_iterator: the epoch, and the order in which its prompts are read.
+
+           Each epoch (if shuffling) draws the next of a sequence of permutation seeds drawn from seed, and shuffles the order of the
+             previous epoch with it. Streaming iterators have no order (n_prompts=0), and shuffle their rows with the epoch's seed instead.
+        """
+        with TemporarilySeededRandom(seed):
+            self.permutation_seeds = iter(np.random.randint(0, 2**32, size=1000000))
+        self.shuffle = shuffle
+        self.order = list(range(n_prompts))
+        self.epoch = 0
+        self.seed = None
+
+    def start(self):
+        """Start epoch self.epoch: draw its permutation seed (None if not shuffling), and shuffle the order with it."""
+        self.seed = int(next(self.permutation_seeds)) if self.shuffle else None
+        if self.seed is not None:
+            with TemporarilySeededRandom(self.seed):
+                random.shuffle(self.order)
+
+    def finish(self):
+        self.epoch += 1
+
+    def skip_to(self, epoch: int):
+        """Replay the permutations of the epochs before the given one, so the next to start is that epoch."""
+        for _ in range(epoch):
+            self.start()
+            self.finish()
+
+
+class Deduplicator:
+    def __init__(self):
+        """The filter stage of a deduplicating get_batch_iterator: only the first element of the first occurrence of each prompt (in any
+           dataset or epoch) is kept. Prompts are checked before they are tokenized, against a StringHashSet of the prompts seen so far."""
+        self.seen = StringHashSet()
+        self.skipped = 0
+
+    def __call__(self, idxs: List[int], example_ids: List[List[int]], get_prompts: Callable[[List[int]], List[str]]) -> List[int]:
+        """Return the prompts of a chunk to tokenize: those with an element that were not seen before."""
+        return [idx for idx, prompt, prompt_ids in zip(idxs, get_prompts(idxs), example_ids) if prompt_ids and not self.seen.add(prompt)]
+
+    def keep(self, element_idx: int, batch_element: Optional[Dict]) -> bool:
+        """Return whether to keep an element (the first of a prompt that was tokenized), counting the others as skipped."""
+        if batch_element is None or element_idx > 0:
+            self.skipped += 1
+            return False
+        return True
+
+
+class LocalPromptFilter:
+    def __init__(self, batch_size: int, rank: int, world_size: int, n_microbatches: int = 1, element_idx: int = 0):
+        """The filter stage of lazy reading (see get_batch_iterator): only the prompts with an element in this rank's part of a batch
+           are tokenized. element_idx is the index among the epoch's elements of the first element of the next prompt."""
+        self.batch_size = batch_size
+        self.local_batch_idxs = set(get_local_indices(batch_size, rank, world_size, n_microbatches))
+        self.element_idx = element_idx
+
+    def __call__(self, idxs: List[int], example_ids: List[List[int]], get_prompts: Callable[[List[int]], List[str]]) -> List[int]:
+        """Return the prompts of a chunk to tokenize: those with an element in this rank's part of a batch."""
+        to_tokenize = []
+        for idx, prompt_ids in zip(idxs, example_ids):
+            if any((self.element_idx + i) % self.batch_size in self.local_batch_idxs for i in range(len(prompt_ids))):
+                to_tokenize.append(idx)
+            self.element_idx += len(prompt_ids)
+        return to_tokenize
+
+
+class ReadPosition:
+    def __init__(self, position: int = 0, element: int = 0, element_index: int = 0):
+        """How far an epoch has been read: the next element to read, as (position in the epoch's order, index among the elements of that
+           prompt), and its index among the epoch's elements. Also keeps the (position, index) of each element that was read but not yet
+           batched, keyed by (dataset, example_id), which is how the iterator state refers to those elements."""
+        self.next = (position, element)
+        self.n_read = element_index
+        self.unbatched = {}
+
+    def read(self, position: int, element_idx: int, n_elements: int) -> bool:
+        """Move past an element of the prompt at position (which has n_elements elements), or return False if it was read before resuming."""
+        if (position, element_idx) < self.next:
+            return False
+        self.next = (position, element_idx + 1) if element_idx + 1 < n_elements else (position + 1, 0)
+        self.n_read += 1
+        return True
+
+    def add(self, element: Dict, position: int, element_idx: int):
+        self.unbatched[(element['dataset'], element['example_id'])] = (position, element_idx)
+
+    def remove(self, element: Dict):
+        del self.unbatched[(element['dataset'], element['example_id'])]
+
+    def ids(self, elements: List[Dict]) -> List[Tuple[int, int]]:
+        return [self.unbatched[(element['dataset'], element['example_id'])] for element in elements]
+
+
+class Batcher:
+    def __init__(self, batch_size: int, sft_mode: bool = False, shuffle: bool = True, seed: int = 0, length_bucket_batches: Optional[int] = None,
+                 max_tokens_per_batch: Optional[int] = None, batch_size_multiple: int = 1):
+        """The batch stage of get_batch_iterator: collects elements into a pool, which is split into batches (see split) once it holds
+           length_bucket_batches * batch_size elements or, with max_tokens_per_batch, length_bucket_batches * max_tokens_per_batch tokens.
+
+           When bucketing, the batches of each pool are shuffled with rng, whose state is part of the iterator state.
+        """
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.length_bucket_batches = length_bucket_batches
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.batch_size_multiple = batch_size_multiple
+        self.n_sequences = 1 if sft_mode else 2
+        self.pool_size = batch_size * (length_bucket_batches or 1)
+        if max_tokens_per_batch is not None:
+            self.pool_max_tokens = max_tokens_per_batch * (length_bucket_batches or 1)
+        self.rng = random.Random(seed)
+        self.pool = []
+        self.pool_tokens = 0
+        self.has_rejected = None
+
+    def add(self, element: Dict) -> bool:
+        """Add an element (or, with lazy reading, a placeholder holding only its dataset and example_id) to the pool, and return whether the pool is full."""
+        self.pool.append(element)
+        if 'prompt' in element:
+            self.check(element)
+            self.pool_tokens += self.n_sequences * get_padded_length(element)
+        if self.max_tokens_per_batch is None:
+            return len(self.pool) >= self.pool_size
+        return self.pool_tokens > self.pool_max_tokens
+
+    def check(self, element: Dict):
+        """Check that the elements batched together all have rejected responses, or none of them do."""
+        if self.has_rejected is None:
+            self.has_rejected = 'rejected_input_ids' in element
+        elif ('rejected_input_ids' in element) != self.has_rejected:
+            raise ValueError(f"Cannot mix datasets with and without rejected responses ('{element['dataset']}' {'has no' if self.has_rejected else 'has'} rejected responses)")
+
+    def restore(self, pool: List[Dict]):
+        """Start over from the given pool (e.g., the elements of a resumed iterator that were read but not yet batched)."""
+        for element in pool:
+            self.check(element)
+        self.set_pool(list(pool))
+
+    def set_pool(self, pool: List[Dict]):
+        self.pool = pool
+        self.pool_tokens = self.n_sequences * sum(get_padded_length(element) for element in pool if 'prompt' in element)
+
+    def split(self) -> List[List[Dict]]:
+        """Split the pool into full batches, which are returned, and the leftover elements, which stay in the pool; if bucketing,
+           elements of similar length are grouped together."""
+        elements = self.pool
+        if self.length_bucket_batches is not None:
+            elements = sorted(elements, key=get_padded_length)
+        if self.max_tokens_per_batch is None:
+            n_full = len(elements) // self.batch_size * self.batch_size
+            batches = [elements[i:i + self.batch_size] for i in range(0, n_full, self.batch_size)]
+        else:
+            # close a batch once the next element would push it over the token budget
+            batches, n_full, longest = [], 0, 0
+            for idx, element in enumerate(elements):
+                longest = max(longest, get_padded_length(element))
+                n_batch = idx + 1 - n_full
+                if self.n_sequences * n_batch * longest > self.max_tokens_per_batch and n_batch > self.batch_size_multiple:
+                    end = n_full + (n_batch - 1) // self.batch_size_multiple * self.batch_size_multiple
+                    batches.append(elements[n_full:end])
+                    n_full = end
+                    longest = max(get_padded_length(e) for e in elements[n_full:idx + 1])
+        if self.length_bucket_batches is not None and self.shuffle:
+            self.rng.shuffle(batches)
+        self.set_pool(elements[n_full:])
+        return batches
+
+
+class Sharder:
+    def __init__(self, rank: int = 0, world_size: int = 1, n_microbatches: int = 1):
+        """The shard stage of get_batch_iterator: takes this rank's part of each global batch (see get_local_indices), counting the
+           examples of the global batches and the real and padded tokens of the local ones."""
+        self.rank = rank
+        self.world_size = world_size
+        self.n_microbatches = n_microbatches
+        self.example_idx = 0
+        self.n_real_tokens, self.n_padded_tokens = 0, 0
+
+    def __call__(self, batch: List[Dict]) -> List[Dict]:
+        self.example_idx += len(batch)
+        if self.world_size > 1:
+            batch = [batch[idx] for idx in get_local_indices(len(batch), self.rank, self.world_size, self.n_microbatches)]
+        n_real, n_padded = count_padding(batch)
+        self.n_real_tokens, self.n_padded_tokens = self.n_real_tokens + n_real, self.n_padded_tokens + n_padded
+        return batch
+
+    def padding_fraction(self) -> float:
+        return 1 - self.n_real_tokens / self.n_padded_tokens if self.n_padded_tokens else 0.0
+
+
+def load_reference_logps(names: List[str], split: str, tokenizer, max_length: int, max_prompt_length: int, reference_logps_dir: str,
+                         reference_archive: Optional[str] = None) -> Dict[str, np.ndarray]:
+    """Return the precomputed reference log probs of each dataset (see get_reference_logps_path), memory-mapped."""
+    reference_logps = {}
+    for name in names:
+        path = get_reference_logps_path(reference_logps_dir, name, split, tokenizer, max_length, max_prompt_length, reference_archive)
+        if not os.path.exists(path):
+            reference = reference_archive or 'the pretrained weights'
+            raise FileNotFoundError(f"No reference log probs for '{name}' ({split} split) with reference {reference} at {path}; "
+                                    "run with precompute_reference_logps=true (and the same sft_archive/model.archive) first")
+        reference_logps[name] = np.load(path, mmap_mode='r')
+        print(f'Loaded reference log probs for {name} ({split} split) from {path}')
+    return reference_logps
+
+
+def prepare_element(name: str, example_id: int, batch_element: Dict, reference_logps: Dict[str, np.ndarray]) -> Dict:
+    """Add the dataset, example_id and (if given) reference log probs to a batch element."""
+    batch_element['dataset'] = name
+    batch_element['example_id'] = example_id
+    if name in reference_logps:
+        batch_element['reference_chosen_logps'], batch_element['reference_rejected_logps'] = reference_logps[name][example_id].tolist()
+    return batch_element
+
+
+def batch_epoch(epoch_elements: Iterator[Tuple[int, str, List[Tuple[int, Optional[Dict]]]]], position: ReadPosition, batcher: Batcher,
+                deduplicator: Optional[Deduplicator], reference_logps: Dict[str, np.ndarray]) -> Iterator[List[List[Dict]]]:
+    """Add the (position, name, elements) of each prompt of an epoch to the batcher from position.next on, yielding the full batches
+       whenever the pool is full, and those of the last pool of the epoch at the end (the leftover elements stay in batcher.pool)."""
+    for prompt_position, name, elements in epoch_elements:
+        for element_idx, (example_id, batch_element) in enumerate(elements):
+            if not position.read(prompt_position, element_idx, len(elements)):  # already read before resuming
+                continue
+            if deduplicator is not None and not deduplicator.keep(element_idx, batch_element):
+                continue
+            if batch_element is None:  # read lazily, and not tokenized
+                batch_element = {'dataset': name, 'example_id': example_id}
+            else:
+                batch_element = prepare_element(name, example_id, batch_element, reference_logps)
+            position.add(batch_element, prompt_position, element_idx)
+            if batcher.add(batch_element):
+                yield batcher.split()
+    # when bucketing, the last pool of the epoch may still contain full batches
+    yield batcher.split()
+
+
 def get_batch_iterator(names: List[str],
                        tokenizer,
                        split: str = 'train',
@@ -519,9 +1450,27 @@ def get_batch_iterator(names: List[str],
                        seed:int = 0,
                        silent: bool = False,
                        deduplicate: bool = False,
-                       cache_dir: Optional[str] = None) -> Iterator[Dict]:
+                       cache_dir: Optional[str] = None,
+                       reference_logps_dir: Optional[str] = None,
+                       reference_archive: Optional[str] = None,
+                       tokenized_cache_dir: Optional[str] = None,
+                       length_bucket_batches: Optional[int] = None,
+                       max_tokens_per_batch: Optional[int] = None,
+                       batch_size_multiple: int = 1,
+                       num_proc: Optional[int] = None,
+                       drop_last: bool = True,
+                       stream: bool = False,
+                       shuffle_buffer_size: int = 10000,
+                       state: Optional[Dict] = None,
+                       rank: int = 0,
+                       world_size: int = 1,
+                       n_microbatches: int = 1) -> Iterator[Dict]:
     """Get an iterator over batches of data. Stops after n_epochs or n_examples, whichever comes first.
 
+    The prompts go through these stages, each of which keeps its own state: source (a PromptSource, or a StreamSource when streaming)
+      -> shuffle (EpochOrder) -> filter (a Deduplicator, or a LocalPromptFilter with lazy reading) -> batch (Batcher, with a ReadPosition
+      recording where the elements not yet batched came from) -> shard (Sharder).
+
     Args:
         names: Names of datasets to use.
         tokenizer: Tokenizer to use.
@@ -535,90 +1484,244 @@ def get_batch_iterator(names: List[str],
         n_examples: Number of examples to run for. This or n_epochs must be specified.
         seed: Random seed.
         silent: Whether to silence the progress bar(s).
-        deduplicate: If true, do not include duplicate prompts.
+        deduplicate: If true, do not include duplicate prompts: only the first element of the first occurrence of each prompt (in any dataset or epoch)
+          is used. Prompts are checked before they are tokenized, against a StringHashSet of the prompts read so far, so duplicates are not tokenized.
         cache_dir: Directory to cache the datasets in.
+        reference_logps_dir: If given, attach the precomputed reference log probs in this directory (see get_reference_logps_path) to each batch.
+        reference_archive: With reference_logps_dir, the archive of the reference weights the log probs were computed with (None for the pretrained weights).
+        tokenized_cache_dir: If given, cache the tokenized datasets in this directory (see get_tokenized_dataset), and load them from there in later calls.
+        length_bucket_batches: If given, batch together elements of similar length to reduce padding: pools of length_bucket_batches * batch_size
+          consecutive elements are sorted by length and split into batches, and the order of these batches is then shuffled (deterministically given the seed).
+        max_tokens_per_batch: If given, ignore batch_size and instead fill each batch with as many elements as fit in this many tokens once padded
+          (counting both the chosen and rejected sequences), so batches of short elements hold more examples. Combined with length_bucket_batches,
+          pools of length_bucket_batches * max_tokens_per_batch tokens are bucketed.
+        batch_size_multiple: With max_tokens_per_batch, the number of elements in each batch is a multiple of this (e.g., gradient_accumulation_steps * world_size,
+          so that batches split evenly into microbatches); a batch may exceed the token budget if batch_size_multiple elements do not fit in it.
+        num_proc: If given, tokenize in a pool of this many processes, in chunks of consecutive prompts, so the batches are the same as without it.
+          Not needed with tokenized_cache_dir, where the datasets are only tokenized once.
+        drop_last: If false, also yield the last, incomplete batch of the final epoch.
+        stream: If true, read the datasets lazily with get_streaming_dataset instead of loading them first, so batches are produced while later
+          rows are still being read, and memory does not grow with the size of the datasets. The datasets are interleaved row by row, and
+          shuffled with a buffer of shuffle_buffer_size rows, so the batches differ from those without streaming. num_proc is not used, and
+          tokenized_cache_dir and reference_logps_dir are not supported (their example ids refer to the order of get_dataset).
+        shuffle_buffer_size: With stream, the number of rows to shuffle among.
+        state: If given, a dict that is updated before each batch is yielded to describe the iterator's position after that batch (the epoch,
+          its permutation seed, the next prompt to read, and the elements read but not yet batched); it can be saved, and passed to a new
+          iterator with the same arguments, which then continues right after that batch. Only the prompts of the elements not yet batched
+          are tokenized again (or, when streaming, the rows before the position are read again). A deduplicating iterator cannot be
+          resumed, since the prompts it has seen are not part of the state.
+        rank: With world_size > 1, the rank of this process; each batch then only holds this rank's part of the global batch (the rank's chunk
+          of each of the batch's n_microbatches microbatches, see get_local_indices), while the global batches are the same on every rank and
+          the same as with world_size=1. Unless bucketing, batching by tokens, deduplicating, streaming, or keeping the last batch, only the
+          prompts with an element in this rank's part of a batch are built into elements; the elements of the others are found from their
+          token ids, or from tokenized_cache_dir (see get_data_example_ids).
+        world_size: The number of processes the batches are split across.
+        n_microbatches: The number of microbatches each batch is split into (e.g., gradient_accumulation_steps).
     """
     assert n_epochs is not None or n_examples is not None, "Must specify either n_epochs or n_examples"
+    if stream and (tokenized_cache_dir is not None or reference_logps_dir is not None):
+        raise ValueError("Streaming datasets is not supported with tokenized_cache_dir or reference_logps_dir")
+    if deduplicate and state:
+        raise ValueError("Cannot resume a deduplicating iterator (the prompts it has seen are not in its state)")
     if silent:
         datasets.logging.disable_progress_bar()
         datasets.logging.set_verbosity_error()
-   
+
     print("deduplicate:", deduplicate)
     with TemporarilySeededRandom(seed):
-        permutation_seeds = iter(np.random.randint(0, 2**32, size=1000000))
-        flat_data = []
-        for name in names:
-            truncation_mode = 'keep_end'# if name == 'hh' or name == 'tldr' else 'keep_start'
-            for prompt, data in get_dataset(name, split, silent=silent, cache_dir=cache_dir).items():
-                flat_data.append((prompt, data['responses'], data['pairs'], data['sft_target'], truncation_mode))
+        if stream:  # rows are read and tokenized in chunks as the epochs go
+            source = StreamSource(names, tokenizer, split, max_length, max_prompt_length, sft_mode, cache_dir=cache_dir, shuffle_buffer_size=shuffle_buffer_size)
+        else:
+            source = get_prompt_source(names, tokenizer, split, max_length, max_prompt_length, sft_mode, seed, silent=silent, cache_dir=cache_dir,
+                                       tokenized_cache_dir=tokenized_cache_dir)
+    reference_logps = {}
+    if reference_logps_dir is not None and not sft_mode:
+        reference_logps = load_reference_logps(names, split, tokenizer, max_length, max_prompt_length, reference_logps_dir, reference_archive)
 
     collate_fn = get_collate_fn(tokenizer)
-
-    epoch_idx = 0
-    example_idx = 0
-    done = False
-    used = set()
-    skipped = 0
-    while True:
-        if n_epochs is not None and epoch_idx >= n_epochs:
+    epochs = EpochOrder(0 if stream else len(source), seed, shuffle)
+    deduplicator = Deduplicator() if deduplicate else None
+    batcher = Batcher(batch_size, sft_mode, shuffle, seed, length_bucket_batches, max_tokens_per_batch, batch_size_multiple)
+    sharder = Sharder(rank, world_size, n_microbatches)
+    # with lazy reading, batch composition only depends on the number of elements of each prompt, so the prompts whose elements all
+    #   belong to other ranks need not be tokenized; their elements are kept as placeholders holding only the dataset and example_id
+    lazy = world_size > 1 and length_bucket_batches is None and max_tokens_per_batch is None and not deduplicate and not stream and drop_last
+    finished = lambda: n_examples is not None and sharder.example_idx >= n_examples
+    n_skipped = lambda: deduplicator.skipped if deduplicate else 0
+
+    def get_state(position: ReadPosition, pending: List[List[Dict]], leftover: List[Dict]) -> Dict:
+        return {'epoch': epochs.epoch, 'seed': epochs.seed, 'n_prompts': len(epochs.order), 'position': position.next[0], 'element': position.next[1],
+                'element_index': position.n_read, 'pending': [position.ids(batch) for batch in pending], 'leftover': position.ids(leftover),
+                'bucket_rng': batcher.rng.getstate(), 'example_idx': sharder.example_idx, 'skipped': n_skipped(),
+                'n_real_tokens': sharder.n_real_tokens, 'n_padded_tokens': sharder.n_padded_tokens}
+
+    def emit(position: ReadPosition, batches: List[List[Dict]], leftover: List[Dict]) -> Iterator[Dict]:
+        """Yield the given global batches, each as this rank's part of it, collated, updating state to after it (with the later batches and leftover still to batch)."""
+        for batch_idx, batch in enumerate(batches):
+            if finished():
+                return
+            for batch_element in batch:
+                position.remove(batch_element)
+            batch = sharder(batch)
+            if state is not None:
+                state.update(get_state(position, batches[batch_idx + 1:], leftover))
+            yield collate_fn(batch)
+            if finished() and not silent:
+                print(f'Finished generating {n_examples} examples on {split} split, skipped {n_skipped()}, padding fraction {sharder.padding_fraction():.3f}')
+
+    resume_state = dict(state) if state else None
+    if resume_state is not None:
+        if resume_state['n_prompts'] != len(epochs.order):
+            raise ValueError(f"Cannot resume from an iterator state over {resume_state['n_prompts']} prompts with {len(epochs.order)} prompts")
+        sharder.example_idx = resume_state['example_idx']
+        sharder.n_real_tokens, sharder.n_padded_tokens = resume_state['n_real_tokens'], resume_state['n_padded_tokens']
+        version, internal_state, gauss_next = resume_state['bucket_rng']
+        batcher.rng.setstate((version, tuple(internal_state), gauss_next))
+        epochs.skip_to(resume_state['epoch'])
+
+    while not finished():
+        if n_epochs is not None and epochs.epoch >= n_epochs:
             if not silent:
-                print(f'Finished generating {n_epochs} epochs on {split} split, skipped = {skipped}')
+                print(f'Finished generating {n_epochs} epochs on {split} split, skipped = {n_skipped()}, padding fraction {sharder.padding_fraction():.3f}')
             break
-        if shuffle:
-            with TemporarilySeededRandom(next(permutation_seeds)):
-                random.shuffle(flat_data)
+        epochs.start()
+        if resume_state is not None and resume_state['seed'] != epochs.seed:
+            raise ValueError(f"Cannot resume from an iterator state with permutation seed {resume_state['seed']} (expected {epochs.seed}); was the seed changed?")
+
+        # when resuming, tokenize again the prompts of the elements that were read but not yet batched, then continue from where the state was
+        position = ReadPosition()
+        restore_ids, restore_positions = [], []
+        if resume_state is not None:
+            position = ReadPosition(resume_state['position'], resume_state['element'], resume_state['element_index'])
+            restore_ids = [tuple(element_id) for batch in resume_state['pending'] + [resume_state['leftover']] for element_id in batch]
+            restore_positions = sorted(set(prompt_position for prompt_position, _ in restore_ids))
+        if stream:
+            epoch_elements = source.read(random.Random(epochs.seed) if shuffle else None, position.next[0], restore_positions, deduplicator)
+        else:
+            # the restored prompts are always tokenized; with lazy reading, of the others only those with an element of this rank are
+            prompt_filter = deduplicator
+            if lazy:
+                prompt_filter = LocalPromptFilter(batch_size, rank, world_size, n_microbatches, element_idx=position.n_read - position.next[1])
+            positions = restore_positions + list(range(position.next[0], len(epochs.order)))
+            idxs = [epochs.order[prompt_position] for prompt_position in positions]
+            elements = itertools.chain(source.read(idxs[:len(restore_positions)], num_proc=num_proc),
+                                       source.read(idxs[len(restore_positions):], prompt_filter, num_proc=num_proc))
+            epoch_elements = ((prompt_position, name, prompt_elements) for prompt_position, (name, prompt_elements) in zip(positions, elements))
+
+        batcher.restore([])
+        if resume_state is not None:
+            restored = {}
+            for prompt_position, name, prompt_elements in itertools.islice(epoch_elements, len(restore_positions)):
+                for element_idx, (example_id, batch_element) in enumerate(prompt_elements):
+                    restored[(prompt_position, element_idx)] = prepare_element(name, example_id, batch_element, reference_logps)
+            for element_id in restore_ids:
+                position.add(restored[element_id], *element_id)
+            pending = [[restored[tuple(element_id)] for element_id in batch_ids] for batch_ids in resume_state['pending']]
+            batcher.restore([restored[tuple(element_id)] for element_id in resume_state['leftover']])
+            resume_state = None
+            yield from emit(position, pending, batcher.pool)
+            if finished():
+                break
 
-        batch = []
-        for prompt, responses, pairs, sft_target, truncation_mode in flat_data:
-            if done:
+        for batches in batch_epoch(epoch_elements, position, batcher, deduplicator, reference_logps):
+            yield from emit(position, batches, batcher.pool)
+            if finished():
                 break
-            if sft_mode:
-                try:
-                    batch_element = tokenize_batch_element(prompt, sft_target, sft_target, truncation_mode, tokenizer, max_length, max_prompt_length)
-                except AssertionError:
-                    print("failed to load 1 sample")
-                    continue
-                batch_element = {k: v for k, v in batch_element.items() if 'rejected' not in k}
-                if deduplicate and batch_element["prompt"] in used:
-                    skipped += 1
-                    continue
-                used.add(batch_element["prompt"])
-                batch.append(batch_element)
-                example_idx += 1
-                if len(batch) == batch_size:
-                    yield collate_fn(batch)
-                    if n_examples is not None and example_idx >= n_examples:
-                        if not silent:
-                            print(f'Finished generating {n_examples} examples on {split} split, skipped {skipped}')
-                        done = True
-
-                    batch = []
-            else:
-                for p in pairs:
-                    if done:
-                        break
-                    try:
-                        batch_element = tokenize_batch_element(prompt, responses[p[0]], responses[p[1]], truncation_mode, tokenizer, max_length, max_prompt_length)
-                    except AssertionError:
-                        print("failed to load 1 sample")
-                        continue
-                    if deduplicate and batch_element["prompt"] in used:
-                        skipped += 1
-                        continue
-                    used.add(batch_element["prompt"])
-                    batch.append(batch_element)
-                    example_idx += 1
-                    if len(batch) == batch_size:
-                        yield collate_fn(batch)
-                        if n_examples is not None and example_idx >= n_examples:
-                            if not silent:
-                                print(f'FINISHED {n_examples} EXAMPLES on {split} split, skipped {skipped}')
-                            done = True
-                        batch = []
-        if done:
+        if finished():
             break
 
-        epoch_idx += 1
+        epochs.finish()
+        if not drop_last and batcher.pool and n_epochs is not None and epochs.epoch >= n_epochs:
+            yield from emit(position, [batcher.pool], [])
+
+
+class LazyBatches:
+    def __init__(self, iterator_kwargs: Dict, cache_dir: Optional[str] = None):
+        """The batches of get_batch_iterator(**iterator_kwargs), built only as far as they are used, and kept for later iterations.
+
+           If cache_dir is given, each batch is saved there (with the iterator's state after it) the first time it is built, keyed by
+             iterator_kwargs, so later LazyBatches with the same arguments load the saved batches instead of tokenizing and collating them;
+             if they need more batches than were saved, the iterator continues from the state of the last saved one (or, if deduplicating,
+             starts over and skips the saved batches). Batches are not cached with reference_logps_dir, whose log probs may be computed again.
+        """
+        self.iterator_kwargs = iterator_kwargs
+        self.cache_path = None
+        if cache_dir is not None and iterator_kwargs.get('reference_logps_dir') is None:
+            ignored = ('tokenizer', 'split', 'silent', 'cache_dir', 'tokenized_cache_dir', 'num_proc', 'state')
+            # as plain containers (e.g., names may be a ListConfig of config.datasets), so the key can be serialized
+            key = {k: OmegaConf.to_container(v) if OmegaConf.is_config(v) else v for k, v in iterator_kwargs.items() if k not in ignored}
+            names = iterator_kwargs['names']
+            key['sources'] = {name: (os.path.getsize(name), os.path.getmtime(name)) for name in names if os.path.exists(name)}
+            self.cache_path = get_cache_path(cache_dir, 'batches', '+'.join(os.path.basename(name) for name in names), iterator_kwargs.get('split', 'train'),
+                                             iterator_kwargs['tokenizer'], version=BATCHES_CACHE_VERSION, **key)
+            os.makedirs(self.cache_path, exist_ok=True)
+        self.batches = []
+        self.iterator = None
+        self.state = {}
+        self.exhausted = False
+
+    def _load(self, idx: int) -> bool:
+        """Load the idx-th batch from the cache, if it was saved; once the cache ends, mark the batches as exhausted."""
+        path = os.path.join(self.cache_path, f'{idx}.pt')
+        if os.path.exists(path):
+            saved = torch.load(path)
+            self.batches.append(saved['batch'])
+            self.state = saved['state']
+            return True
+        end_path = os.path.join(self.cache_path, 'end.pt')
+        if os.path.exists(end_path):
+            self.exhausted = idx >= torch.load(end_path)['n_batches']
+        return False
+
+    def _save(self, name: str, obj: Any):
+        """Save obj to the cache with torch.save, atomically (ranks and concurrent jobs write the same batches)."""
+        tmp_path = os.path.join(self.cache_path, f'{name}.tmp{os.getpid()}')
+        torch.save(obj, tmp_path)
+        os.replace(tmp_path, os.path.join(self.cache_path, name))
+
+    def _build_next(self) -> bool:
+        """Append the next batch to self.batches, and return whether there was one."""
+        idx = len(self.batches)
+        if self.cache_path is not None and self.iterator is None and (self._load(idx) or self.exhausted):
+            return not self.exhausted
+        if self.iterator is None:
+            n_loaded = 0
+            if self.batches and self.iterator_kwargs.get('deduplicate'):
+                # the prompts seen by deduplication are not in the iterator's state, so read them again
+                self.state, n_loaded = {}, len(self.batches)
+            self.iterator = get_batch_iterator(**self.iterator_kwargs, state=self.state)
+            for _ in range(n_loaded):
+                next(self.iterator)
+        batch = next(self.iterator, None)
+        if batch is None:
+            self.exhausted = True
+            if self.cache_path is not None:
+                self._save('end.pt', {'n_batches': idx})
+            return False
+        self.batches.append(batch)
+        if self.cache_path is not None:
+            self._save(f'{idx}.pt', {'batch': batch, 'state': copy.deepcopy(self.state)})
+        return True
+
+    def __iter__(self) -> Iterator[Dict]:
+        idx = 0
+        while idx < len(self.batches) or (not self.exhausted and self._build_next()):
+            yield self.batches[idx]
+            idx += 1
+
+    def __getitem__(self, item: Union[int, slice]) -> Union[Dict, List[Dict]]:
+        if isinstance(item, slice):
+            return list(itertools.islice(self, item.start, item.stop, item.step))
+        batch = next(itertools.islice(self, item, None), None)
+        if batch is None:
+            raise IndexError(f'batch index {item} out of range')
+        return batch
+
+    def __len__(self):
+        """The number of batches; this builds all of them."""
+        for _ in self:
+            pass
+        return len(self.batches)
 
 
 def strings_match_up_to_spaces(str_a: str, str_b: str) -> bool:
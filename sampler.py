@@ -21,38 +21,38 @@ def is_sft(path):
     )
 
 
-def get_sample_path(sample_dir, archive, ckpt_dir, ds, do_sample, sampling_params, use_sampling_params):
+def get_loss_params(archive_dir, archive):
+    """Returns the beta and alpha of the run archive in archive_dir (0 for SFT runs)."""
     try:
-        with open(os.path.join(args.archive_dir, archive, "config.yaml"), "r") as f:
+        with open(os.path.join(archive_dir, archive, "config.yaml"), "r") as f:
             config = yaml.load(f, Loader=yaml.FullLoader)
 
         if config['loss']['name'] == "dpo":
-            beta, alpha = config['loss']['beta'], config['loss']['alpha']
-        else:
-            beta, alpha = 0.0, 0.0
+            return config['loss']['beta'], config['loss']['alpha']
+        return 0.0, 0.0
 
     except FileNotFoundError:
         print(f"no config.yaml, assuming sft... ", end="")
-        beta, alpha = 0.0, 0.0
+        return 0.0, 0.0
+
+
+def get_sampling_params_suffix(sampling_params):
+    """Returns the part of a sample file name that encodes its sampling params."""
+    return "".join(f"__{pname}{pvalue}" for pname, pvalue in sampling_params.items())
 
-    if args.beta is not None and args.beta != beta:
-        if beta != 0 or (not args.rewards and not args.rewards_on_samples):
-            return None, None, None
-    elif args.alpha is not None and args.alpha != alpha:
-        return None, None, None
 
-    model = args.model
+def get_sample_path(sample_dir, model, ds, beta, alpha, ckpt_dir, do_sample, sampling_params, use_sampling_params):
+    """Returns the path of the samples (or rewards, if not do_sample) of checkpoint ckpt_dir of a run."""
     ckpt_dir = ckpt_dir.replace("step-", "")
     sample_type = "rewards" if not do_sample else "samples"
-    ext = "csv" if not do_sample else "json"
+    ext = "csv" if not do_sample else "jsonl"
 
     path_template = f"{model}__{ds}__b{beta}__a{alpha}__s{ckpt_dir}__{sample_type}"
     if use_sampling_params:
-        for pname, pvalue in sampling_params.items():
-            path_template += f"__{pname}{pvalue}"
+        path_template += get_sampling_params_suffix(sampling_params)
     path_template += f".{ext}"
 
-    return os.path.join(args.sample_dir, path_template), beta, alpha
+    return os.path.join(sample_dir, path_template)
 
 
 if __name__ == "__main__":
@@ -294,19 +294,24 @@ if __name__ == "__main__":
             ind = [min(int(round(f * len(archive_dirs))), len(archive_dirs) - 1) for f in fractions]
             archive_dirs = [archive_dirs[i] for i in ind]
 
+        beta, alpha = get_loss_params(args.archive_dir, fdir)
+        if args.beta is not None and args.beta != beta:
+            if beta != 0 or (not args.rewards and not args.rewards_on_samples):
+                print(f"alpha/beta value mismatch")
+                continue
+        elif args.alpha is not None and args.alpha != alpha:
+            print(f"alpha/beta value mismatch")
+            continue
+
         ckpt_samples_info = []
         do_sample = not args.rewards
        
-        continue_ = False
         for ckpt_dir in archive_dirs:
-            ckpt_sample_path, beta, alpha = get_sample_path(
-                sample_dir, fdir, ckpt_dir, args.dataset,
+            ckpt_sample_path = get_sample_path(
+                args.sample_dir, args.model, args.dataset, beta, alpha, ckpt_dir,
                 do_sample=do_sample, sampling_params=sampling_params,
                 use_sampling_params=args.use_sampling_params
             )
-            if ckpt_sample_path is None:
-                continue_ = True
-                break
 
             dataset = args.dataset
 
@@ -314,8 +319,8 @@ if __name__ == "__main__":
                 ckpt_sample_path = os.path.abspath(os.path.realpath(ckpt_sample_path))
                 dataset = ckpt_sample_path
                 ds_id = f"{args.dataset}_local_samples"
-                ckpt_sample_path, beta, alpha = get_sample_path(
-                    sample_dir, fdir, ckpt_dir, ds_id,
+                ckpt_sample_path = get_sample_path(
+                    args.sample_dir, args.model, ds_id, beta, alpha, ckpt_dir,
                     do_sample=False,
                     sampling_params=sampling_params,
                     use_sampling_params=args.use_sampling_params
@@ -329,10 +334,6 @@ if __name__ == "__main__":
             ckpt_samples_info.append((ckpt_dir, ckpt_sample_path, dataset, beta, alpha))
             n_to_sample += 1
 
-        if continue_:
-            print(f"alpha/beta value mismatch")
-            continue
-
         print(f"found {len(ckpt_samples_info)} after filtering")
         if len(ckpt_samples_info) != 0:
             collected.append((ckpt_samples_info, fdir))
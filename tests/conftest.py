@@ -0,0 +1,99 @@
+import os
+import sys
+import random
+import zlib
+
+import pytest
+import torch
+import transformers
+from hydra import compose, initialize_config_dir
+from tokenizers import Tokenizer, models, trainers as tokenizer_trainers, pre_tokenizers, decoders
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import preference_datasets
+import trainers
+import utils
+
+# the version in requirements.txt, whose models only take 2D attention masks and return past_key_values as tuples
+PINNED_TRANSFORMERS = transformers.__version__ == '4.29.2'
+pinned_transformers_only = pytest.mark.skipif(not PINNED_TRANSFORMERS, reason='checks the behavior of the pinned transformers==4.29.2')
+
+WORDS = ("the a cat dog sat on mat human assistant why how what is are you me tell story about code python "
+         "fast slow big small red blue green very much more less").split()
+
+
+@pytest.fixture(scope='session')
+def tokenizer(tmp_path_factory):
+    """A small byte-level BPE tokenizer, trained locally so the tests need no downloads."""
+    tokenizer = Tokenizer(models.BPE(unk_token='<unk>'))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = tokenizer_trainers.BpeTrainer(vocab_size=400, special_tokens=['<|endoftext|>', '<unk>'], initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    rng = random.Random(0)
+    tokenizer.train_from_iterator([' '.join(rng.choice(WORDS) for _ in range(30)) + '\n\nHuman: x\n\nAssistant:' for _ in range(2000)], trainer)
+    path = str(tmp_path_factory.mktemp('tokenizer'))
+    transformers.PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token='<|endoftext|>', unk_token='<unk>').save_pretrained(path)
+    tokenizer = transformers.PreTrainedTokenizerFast.from_pretrained(path)
+    tokenizer.pad_token_id = tokenizer.eos_token_id
+    return tokenizer
+
+
+def make_model(seed: int = 0) -> transformers.PreTrainedModel:
+    """A tiny GPT-NeoX model over the test tokenizer's vocabulary."""
+    torch.manual_seed(seed)
+    config = transformers.GPTNeoXConfig(vocab_size=400, hidden_size=32, num_hidden_layers=2, num_attention_heads=4, intermediate_size=64,
+                                        max_position_embeddings=1024)
+    model = transformers.GPTNeoXForCausalLM(config)
+    model.eval()
+    return model
+
+
+def sentence(rng: random.Random, min_words: int, max_words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+
+def make_dataset(name: str, split: str, n_prompts: int = 40) -> preference_datasets.PreferenceData:
+    """A random preference dataset with 1-3 pairs per prompt; datasets named 'overlap*' share their first half of prompts."""
+    rng = random.Random(zlib.crc32(f'{name}{split}'.encode()))
+    shared_rng = random.Random(zlib.crc32(f'overlap{split}'.encode()))
+    data = preference_datasets.PreferenceDataBuilder()
+    for idx in range(n_prompts):
+        prompt_rng = shared_rng if name.startswith('overlap') and idx < n_prompts // 2 else rng
+        prompt = '\n\nHuman: ' + sentence(prompt_rng, 2, 60) + f' {idx}\n\nAssistant:'
+        responses, pairs = [], []
+        for _ in range(rng.randint(1, 3)):
+            pairs.append((len(responses), len(responses) + 1))
+            responses.extend([' ' + sentence(rng, 1, 80), ' ' + sentence(rng, 1, 80)])
+        data.add(prompt, responses, pairs, sft_target=responses[0])
+    return data.build()
+
+
+@pytest.fixture(autouse=True)
+def fake_datasets(monkeypatch):
+    """Serve make_dataset instead of downloading datasets."""
+    monkeypatch.setattr(preference_datasets, 'get_dataset', lambda name, split, silent=False, cache_dir=None: make_dataset(name, split))
+
+
+@pytest.fixture
+def make_config(tmp_path):
+    """Compose the Hydra config of train.py (with the given overrides), as a run would see it."""
+    def make_config(*overrides: str):
+        with initialize_config_dir(config_dir=os.path.join(REPO_DIR, 'config'), version_base=None):
+            return compose(config_name='config', overrides=[
+                f'local_run_dir={tmp_path}/run', f'local_dirs=[{tmp_path}/cache]', 'datasets=[a,b]', 'trainer=BasicTrainer', 'wandb.enabled=false',
+                'max_length=64', 'max_prompt_length=32', 'eval_batch_size=4', 'n_eval_examples=8', *overrides])
+    return make_config
+
+
+@pytest.fixture
+def make_trainer(monkeypatch, tokenizer):
+    """Build a BasicTrainer on the CPU, with the test tokenizer."""
+    monkeypatch.setattr(transformers.AutoTokenizer, 'from_pretrained', lambda *args, **kwargs: tokenizer)
+    monkeypatch.setattr(trainers, 'slice_and_move_batch_for_device',
+                        lambda batch, rank, world_size, device: utils.slice_and_move_batch_for_device(batch, rank, world_size, 'cpu'))
+
+    def make_trainer(config, policy, reference_model=None, **kwargs):
+        return trainers.BasicTrainer(policy, config, config.seed, config.local_run_dir, reference_model=reference_model, **kwargs)
+    return make_trainer
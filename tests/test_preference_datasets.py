@@ -0,0 +1,202 @@
+import itertools
+
+import datasets
+import pytest
+import torch
+
+import preference_datasets
+from conftest import make_dataset
+from preference_datasets import get_batch_iterator, get_local_indices, get_prompt_source, LazyBatches, EpochOrder, Deduplicator, LocalPromptFilter, \
+    ReadPosition, Batcher, Sharder, get_se_test_rows
+
+
+def assert_same_batches(batches_a, batches_b):
+    assert len(batches_a) == len(batches_b)
+    for batch_a, batch_b in zip(batches_a, batches_b):
+        assert batch_a.keys() == batch_b.keys()
+        for k in batch_a:
+            if isinstance(batch_a[k], torch.Tensor):
+                assert torch.equal(batch_a[k], batch_b[k]), k
+            else:
+                assert batch_a[k] == batch_b[k], k
+
+
+def test_lazy_batches_deduplicate_with_partial_cache(tokenizer, tmp_path):
+    kwargs = dict(names=['overlap_a', 'overlap_b'], tokenizer=tokenizer, split='test', batch_size=4, n_epochs=1, max_length=64,
+                  max_prompt_length=32, deduplicate=True, silent=True)
+    expected = list(LazyBatches(kwargs))
+    prompts = [prompt for batch in expected for prompt in batch['prompt']]
+    assert len(prompts) == len(set(prompts)) == 60
+
+    # cache only the first few batches, then build the rest on top of them
+    list(itertools.islice(LazyBatches(kwargs, cache_dir=str(tmp_path)), 3))
+    assert_same_batches(list(LazyBatches(kwargs, cache_dir=str(tmp_path))), expected)
+
+
+def test_deduplicating_iterator_cannot_resume(tokenizer):
+    kwargs = dict(names=['a'], tokenizer=tokenizer, batch_size=4, n_epochs=1, deduplicate=True, silent=True)
+    state = {}
+    next(get_batch_iterator(**kwargs, state=state))
+    with pytest.raises(ValueError):
+        next(get_batch_iterator(**kwargs, state=state))
+
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'length_bucket_batches': 2},
+    {'max_tokens_per_batch': 400, 'batch_size_multiple': 2},
+    {'rank': 1, 'world_size': 2, 'n_microbatches': 2},
+], ids=['plain', 'bucketed', 'token_budget', 'sharded'])
+def test_resume_across_epochs(tokenizer, options):
+    kwargs = dict(names=['a', 'b'], tokenizer=tokenizer, batch_size=4, n_epochs=3, max_length=64, max_prompt_length=32, silent=True, seed=1, **options)
+    batches, states = [], []
+    state = {}
+    for batch in get_batch_iterator(**kwargs, state=state):
+        batches.append(batch)
+        states.append(dict(state))
+    epochs = [state['epoch'] for state in states]
+    assert max(epochs) == 2
+    # resume from the last batch of each epoch, the first of the next, and one in the middle of an epoch after the first
+    last_of_epoch = [idx for idx in range(len(states) - 1) if epochs[idx + 1] != epochs[idx] or states[idx + 1]['position'] < states[idx]['position']]
+    assert last_of_epoch
+    for idx in sorted(set(last_of_epoch + [idx + 1 for idx in last_of_epoch] + [(last_of_epoch[0] + len(states)) // 2])):
+        assert_same_batches(list(get_batch_iterator(**kwargs, state=dict(states[idx]))), batches[idx + 1:])
+
+
+def with_eos_responses(name, split, silent=False, cache_dir=None):
+    """make_dataset, with the EOS text in every fifth response, so those pairs fail to tokenize."""
+    data = make_dataset(name, split)
+    builder = preference_datasets.PreferenceDataBuilder()
+    for idx in range(len(data)):
+        prompt, responses, pairs, _, _ = data[idx]
+        responses = [response + '<|endoftext|>' if (idx + i) % 5 == 0 else response for i, response in enumerate(responses)]
+        builder.add(prompt, responses, pairs, sft_target=responses[0])
+    return builder.build()
+
+
+def test_sharded_batches_with_failed_elements(tokenizer, monkeypatch):
+    monkeypatch.setattr(preference_datasets, 'get_dataset', with_eos_responses)
+    kwargs = dict(names=['a', 'b'], tokenizer=tokenizer, batch_size=4, n_epochs=1, max_length=64, max_prompt_length=32, silent=True)
+    batches = list(get_batch_iterator(**kwargs))
+    for rank in range(2):
+        local_idxs = get_local_indices(4, rank, 2, n_microbatches=2)
+        local_batches = list(get_batch_iterator(**kwargs, rank=rank, world_size=2, n_microbatches=2))
+        assert [batch['example_id'] for batch in local_batches] == [[batch['example_id'][idx] for idx in local_idxs] for batch in batches]
+
+
+@pytest.mark.parametrize('options', [{'rank': 1, 'world_size': 2}, {'deduplicate': True}], ids=['lazy', 'deduplicate'])
+def test_example_ids_checked_against_tokenization(tokenizer, monkeypatch, options):
+    # predict that the first element of each prompt fails to tokenize, though it does not
+    get_example_ids = preference_datasets.get_example_ids
+    monkeypatch.setattr(preference_datasets, 'get_example_ids', lambda *args, **kwargs: [ids[1:] for ids in get_example_ids(*args, **kwargs)])
+    with pytest.raises(AssertionError, match='get_example_ids predicted'):
+        list(get_batch_iterator(names=['a'], tokenizer=tokenizer, batch_size=4, n_epochs=1, silent=True, **options))
+
+
+def make_element(example_id, length, dataset='a'):
+    return {'prompt': f'prompt {example_id}', 'chosen_input_ids': [1] * length, 'rejected_input_ids': [2] * (length // 2),
+            'dataset': dataset, 'example_id': example_id}
+
+
+def test_epoch_order_skip_to():
+    epochs = EpochOrder(20, seed=5)
+    orders = []
+    for _ in range(3):
+        epochs.start()
+        orders.append((list(epochs.order), epochs.seed))
+        epochs.finish()
+    assert len(set(tuple(order) for order, _ in orders)) == 3
+    resumed = EpochOrder(20, seed=5)
+    resumed.skip_to(2)
+    resumed.start()
+    assert (resumed.epoch, resumed.order, resumed.seed) == (2, *orders[2])
+
+    unshuffled = EpochOrder(20, seed=5, shuffle=False)
+    unshuffled.start()
+    assert unshuffled.order == list(range(20)) and unshuffled.seed is None
+
+
+def test_batcher():
+    batcher = Batcher(batch_size=4)
+    assert [batcher.add(make_element(idx, 3)) for idx in range(4)] == [False, False, False, True]
+    assert [[e['example_id'] for e in batch] for batch in batcher.split()] == [[0, 1, 2, 3]] and batcher.pool == []
+
+    # bucketed: the pool is sorted by length, and its batches shuffled
+    batcher = Batcher(batch_size=2, length_bucket_batches=3, seed=1)
+    lengths = [5, 1, 6, 2, 4, 3]
+    full = [batcher.add(make_element(idx, length)) for idx, length in enumerate(lengths)]
+    assert full == [False] * 5 + [True]
+    batches = batcher.split()
+    assert sorted([lengths[e['example_id']] for e in batch] for batch in batches) == [[1, 2], [3, 4], [5, 6]]
+
+    # a token budget (counting the chosen and rejected sequences, padded to the longer), in multiples of batch_size_multiple
+    batcher = Batcher(batch_size=1, max_tokens_per_batch=40, batch_size_multiple=2)
+    for idx, length in enumerate([4, 4, 4, 4, 4, 4, 10, 10, 10]):
+        batcher.add(make_element(idx, length))
+    batches = batcher.split()
+    assert [[e['example_id'] for e in batch] for batch in batches] == [[0, 1, 2, 3], [4, 5], [6, 7]]
+    assert [e['example_id'] for e in batcher.pool] == [8] and batcher.pool_tokens == 20
+
+    with pytest.raises(ValueError, match='rejected responses'):
+        batcher.add({k: v for k, v in make_element(9, 3).items() if k != 'rejected_input_ids'})
+
+
+def test_deduplicator():
+    deduplicator = Deduplicator()
+    prompts = ['x', 'y', 'x', 'z', 'y']
+    get_prompts = lambda idxs: [prompts[idx] for idx in idxs]
+    assert deduplicator([0, 1, 2], [[0], [1, 2], [3]], get_prompts) == [0, 1]
+    # prompts without elements are not tokenized, and don't count as seen
+    assert deduplicator([3, 4], [[], [5]], get_prompts) == []
+    assert deduplicator([3], [[6]], get_prompts) == [3]
+    assert [deduplicator.keep(0, {}), deduplicator.keep(1, {}), deduplicator.keep(0, None)] == [True, False, False]
+    assert deduplicator.skipped == 2
+
+
+def test_local_prompt_filter():
+    # rank 1 of 2, with 2 microbatches per batch of 4: the elements at indices 1 and 3 of each batch
+    assert get_local_indices(4, 1, 2, 2) == [1, 3]
+    prompt_filter = LocalPromptFilter(batch_size=4, rank=1, world_size=2, n_microbatches=2)
+    # prompts with the epoch's elements 0, 1-2, none, 3, 4 and 5-6, of which elements 1, 3 and 5 are this rank's
+    assert prompt_filter(list(range(6)), [[0], [1, 2], [], [3], [4], [5, 6]], None) == [1, 3, 5]
+    assert prompt_filter.element_idx == 7
+    resumed = LocalPromptFilter(batch_size=4, rank=1, world_size=2, n_microbatches=2, element_idx=4)
+    assert resumed([4, 5], [[4], [5, 6]], None) == [5]
+
+
+def test_read_position():
+    position = ReadPosition(position=2, element=1, element_index=7)
+    assert [position.read(prompt_position, element_idx, 2) for prompt_position, element_idx in [(1, 0), (2, 0), (2, 1), (3, 0)]] == [False, False, True, True]
+    assert (position.next, position.n_read) == ((3, 1), 9)
+    position.add(make_element(5, 3), 2, 1)
+    position.add(make_element(5, 3, dataset='b'), 3, 0)
+    assert position.ids([make_element(5, 3, dataset='b'), make_element(5, 3)]) == [(3, 0), (2, 1)]
+    position.remove(make_element(5, 3))
+    assert list(position.unbatched) == [('b', 5)]
+
+
+def test_sharder():
+    sharder = Sharder(rank=1, world_size=2, n_microbatches=2)
+    batch = [make_element(idx, 2 + idx) for idx in range(4)]
+    assert [e['example_id'] for e in sharder(batch)] == [1, 3]
+    assert (sharder.example_idx, sharder.n_real_tokens, sharder.n_padded_tokens) == (4, 3 + 1 + 5 + 2, 2 * 2 * 5)
+
+
+@pytest.mark.parametrize('num_proc', [None, 2])
+def test_prompt_source_read(tokenizer, num_proc):
+    source = get_prompt_source(['a', 'b'], tokenizer, 'train', max_length=64, max_prompt_length=32, sft_mode=False, seed=0)
+    idxs = list(range(len(source)))[::-1]
+    elements = list(source.read(idxs, num_proc=num_proc))
+    assert [name for name, _ in elements] == [source.name(idx) for idx in idxs]
+    assert [[example_id for example_id, _ in prompt_elements] for _, prompt_elements in elements] == source.example_ids(idxs)
+
+    # a filter chooses the prompts to tokenize; the elements of the others are yielded without batch elements
+    filtered = list(source.read(idxs, lambda chunk, example_ids, get_prompts: [idx for idx in chunk if idx % 3 == 0], num_proc=num_proc))
+    for idx, (_, prompt_elements), (_, expected) in zip(idxs, filtered, elements):
+        assert prompt_elements == (expected if idx % 3 == 0 else [(example_id, None) for example_id, _ in expected])
+
+
+@pytest.mark.parametrize('n_rows', [99, 1000, 12345])
+def test_se_test_rows_match_get_se_split(n_rows):
+    rows = datasets.Dataset.from_dict({'row': list(range(n_rows))}).shuffle(seed=42)
+    assert get_se_test_rows(n_rows) == set(rows.select(range(int(n_rows * 0.01)))['row'])
@@ -0,0 +1,158 @@
+import json
+import types
+
+import pytest
+import torch
+import torch.nn as nn
+import transformers
+
+from conftest import make_model, pinned_transformers_only
+from trainers import packed_inputs, check_4d_attention_mask, get_sampled_prompts, repair_jsonl
+from train import get_decoding_configs, main
+
+
+def test_eval_batches_cached_with_hydra_config(make_config, make_trainer, tmp_path):
+    config = make_config(f'tokenized_cache_dir={tmp_path}/tokenized')
+    batches = list(make_trainer(config, make_model()).eval_batches)
+    assert len(batches) == 2
+    cached = list(make_trainer(config, make_model()).eval_batches)
+    assert [batch['prompt'] for batch in cached] == [batch['prompt'] for batch in batches]
+    assert all(torch.equal(a['chosen_input_ids'], b['chosen_input_ids']) for a, b in zip(cached, batches))
+
+
+class AttentionSumModel(nn.Module):
+    """A toy model whose logits at each position sum the embeddings of the positions it attends to, applying 2D or 4D masks."""
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        self.embeddings = nn.Embedding(16, 8)
+
+    def get_input_embeddings(self):
+        return self.embeddings
+
+    def forward(self, input_ids, attention_mask, position_ids=None):
+        if attention_mask.dim() == 4:
+            attend = attention_mask[:, 0] == 0
+        else:
+            attend = torch.ones(input_ids.shape[1], input_ids.shape[1], dtype=torch.bool).tril() & attention_mask[:, None, :].bool()
+        return types.SimpleNamespace(logits=attend.float() @ self.embeddings(input_ids))
+
+
+def test_packed_inputs():
+    lengths = [5, 2, 3, 7, 1, 4]
+    width = 8
+    input_ids = torch.randint(1, 100, (len(lengths), width))
+    attention_mask = (torch.arange(width)[None, :] < torch.tensor(lengths)[:, None]).long()
+    labels = input_ids.masked_fill(attention_mask == 0, -100)
+    packed = packed_inputs({'chosen_input_ids': input_ids * attention_mask, 'chosen_attention_mask': attention_mask, 'chosen_labels': labels})
+    assert packed['packed_input_ids'].shape == (3, width)
+
+    for idx, length in enumerate(lengths):
+        row, column = (packed['packed_segment_ids'] == idx).nonzero(as_tuple=True)
+        assert len(set(row.tolist())) == 1 and column.tolist() == list(range(column[0], column[0] + length))
+        assert torch.equal(packed['packed_input_ids'][row, column], input_ids[idx, :length])
+        assert torch.equal(packed['packed_labels'][row, column], torch.cat((torch.tensor([-100]), labels[idx, 1:length])))
+        assert torch.equal(packed['packed_position_ids'][row, column], torch.arange(length))
+
+    segment_ids = packed['packed_segment_ids']
+    causal = torch.ones(width, width, dtype=torch.bool).tril()
+    expected = ((segment_ids[:, :, None] == segment_ids[:, None, :]) & (segment_ids[:, None, :] >= 0) & causal) | torch.eye(width, dtype=torch.bool)
+    assert torch.equal(packed['packed_attention_mask'][:, 0] == 0, expected)
+
+
+def test_check_4d_attention_mask():
+    check_4d_attention_mask(AttentionSumModel())
+
+
+@pinned_transformers_only
+def test_check_4d_attention_mask_rejects_2d_mask_models():
+    with pytest.raises(ValueError, match='4D attention masks'):
+        check_4d_attention_mask(make_model())
+
+
+@pinned_transformers_only
+def test_pack_sft_sequences_rejected_up_front(make_config, make_trainer):
+    with pytest.raises(ValueError, match='4D attention masks'):
+        make_trainer(make_config('loss=sft', 'pack_sft_sequences=true'), make_model())
+
+
+@pinned_transformers_only
+def test_pack_sft_sequences_rejected_before_loading_models(make_config, monkeypatch):
+    monkeypatch.setattr(transformers.AutoModelForCausalLM, 'from_pretrained', lambda *args, **kwargs: pytest.fail('loaded a model'))
+    with pytest.raises(ValueError, match='pack_sft_sequences is experimental'):
+        main(make_config('loss=sft', 'pack_sft_sequences=true'))
+
+
+@pytest.mark.parametrize('response_only_lm_head', [False, True])
+def test_shared_prefix_forward_matches_concatenated_forward(make_config, make_trainer, response_only_lm_head):
+    config = make_config(f'response_only_lm_head={str(response_only_lm_head).lower()}')
+    model = make_model()
+    trainer = make_trainer(config, model)
+    for batch in trainer.eval_batches:
+        with torch.no_grad():
+            expected = trainer.concatenated_forward(model, batch, return_z=True)
+            shared = trainer.shared_prefix_forward(model, batch, return_z=True)
+        for a, b in zip(shared, expected):
+            assert torch.allclose(a, b, rtol=1e-5, atol=1e-4)
+
+
+def test_sample_sweep_matches_separate_runs(make_config, make_trainer, tmp_path):
+    config = make_config('sample_only=true', 'n_eval_model_samples=8', 'max_length=48')
+    config.decoding_sweep = [
+        {'temperature': 0.0},
+        {'temperature': 0.0, 'num_beams': 3},
+        {'temperature': 0.0, 'no_repeat_ngram_size': 2},
+        {'temperature': 0.0, 'num_beams': 2, 'no_repeat_ngram_size': 3},
+        {'temperature': 1.0, 'top_k': 20},
+        {'penalty_alpha': 0.6, 'top_k': 4},
+    ]
+    decoding_configs = get_decoding_configs(config)
+    trainer = make_trainer(config, make_model())
+    sweep_paths = [str(tmp_path / f'sweep{i}.jsonl') for i in range(len(decoding_configs))]
+    assert trainer.sample(sweep_paths, decoding_configs) == [8] * len(decoding_configs)
+    for i, decoding_config in enumerate(decoding_configs):
+        path = str(tmp_path / f'alone{i}.jsonl')
+        trainer.sample([path], [decoding_config])
+        with open(path) as alone, open(sweep_paths[i]) as sweep:
+            assert [json.loads(line) for line in sweep] == [json.loads(line) for line in alone], decoding_config
+
+
+def test_reference_logps_keyed_on_reference_archive(make_config, make_trainer, tmp_path):
+    archives = []
+    for seed in range(2):
+        archives.append(str(tmp_path / f'sft{seed}.pt'))
+        torch.save({'step_idx': 0, 'metrics': {}, 'state': make_model(seed).state_dict()}, archives[-1])
+    options = ['loss=dpo', f'reference_logps_dir={tmp_path}/reference_logps', 'n_examples=8', f'model.archive={archives[0]}']
+    reference_model = make_model(0)
+    trainer = make_trainer(make_config(*options, 'precompute_reference_logps=true'), reference_model, reference_model)
+    trainer.precompute_reference_logps()
+
+    batch = next(iter(make_trainer(make_config(*options), make_model()).eval_batches))
+    with torch.no_grad():
+        expected = trainer.concatenated_forward(reference_model, batch)
+    assert torch.allclose(torch.as_tensor(batch['reference_chosen_logps']), expected[0], atol=1e-4)
+    assert torch.allclose(torch.as_tensor(batch['reference_rejected_logps']), expected[1], atol=1e-4)
+
+    # training against other reference weights (resuming with sft_archive) can't read these log probs
+    with pytest.raises(FileNotFoundError, match='sft1.pt'):
+        next(iter(make_trainer(make_config(*options, f'sft_archive={archives[1]}'), make_model()).eval_batches))
+
+
+def test_repair_torn_samples_file(tmp_path):
+    path = tmp_path / 'samples.jsonl'
+    contents = json.dumps({'prompt': 'a', 'sample': 'x'}) + '\n' + '{"prompt": "b", "sam'
+    path.write_text(contents)
+    assert get_sampled_prompts(str(path)) == {'a'}
+    assert path.read_text() == contents
+    repair_jsonl(str(path))
+    assert path.read_text() == json.dumps({'prompt': 'a', 'sample': 'x'}) + '\n'
+
+
+def test_policy_archives_config_validation(make_config, tmp_path):
+    options = ['sample_only=true', f'policy_archives=[{tmp_path}/run-b0.1-a0/step-1/policy.pt]', f'checkpoints_dir={tmp_path}/checkpoints']
+    with pytest.raises(ValueError, match='dataset_id'):
+        main(make_config(*options))
+    samples = tmp_path / 'samples.jsonl'
+    samples.write_text(json.dumps({'prompt': 'a', 'sample': 'x'}) + '\n')
+    with pytest.raises(ValueError, match='local sample files'):
+        main(make_config(*options, f'datasets=[{samples}]', 'dataset_id=a'))
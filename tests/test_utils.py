@@ -0,0 +1,19 @@
+import pandas as pd
+
+from utils import ResumableCSVWriter
+
+
+def test_resumable_csv_writer_resumes_with_non_json_key(tmp_path):
+    path = str(tmp_path / 'rewards.csv')
+    key = {'datasets': ('hh', 'shp'), 'batch_size': 4}
+    writer = ResumableCSVWriter(path, key)
+    writer.write({'reward': [1.0, 2.0]})
+    writer.write({'reward': [3.0]})
+
+    resumed = ResumableCSVWriter(path, key)
+    assert (resumed.n_chunks, resumed.n_rows) == (2, 3)
+    resumed.write({'reward': [4.0]})
+    assert pd.read_csv(path)['reward'].tolist() == [1.0, 2.0, 3.0, 4.0]
+
+    restarted = ResumableCSVWriter(path, {**key, 'batch_size': 8})
+    assert (restarted.n_chunks, restarted.n_rows) == (0, 0)
@@ -4,39 +4,64 @@ from functools import partial
 import torch.nn as nn
 import transformers
 from utils import get_local_dir, get_local_run_dir, disable_dropout, init_distributed, get_open_port
+from sampler import get_loss_params, get_sample_path, get_sampling_params_suffix
 import os
 import hydra
+from hydra.core.hydra_config import HydraConfig
 import torch.multiprocessing as mp
 from omegaconf import OmegaConf, DictConfig
 import trainers
 import wandb
 import json
 import socket
-from typing import Optional, Set
+from typing import Optional, Set, List, Dict
 import resource
+from packaging import version
 
 
+# the first transformers version with a supported model (Llama) that applies the 4D attention masks of pack_sft_sequences
+PACKING_MIN_TRANSFORMERS = '4.44'
+
 OmegaConf.register_new_resolver("get_local_run_dir", lambda exp_name, local_dirs: get_local_run_dir(exp_name, local_dirs))
 
 def lr(step, config):
     return min(1.0, (step + 1) / (config.warmup_steps + 1))
 
 
+def get_decoding_configs(config: DictConfig) -> List[Dict]:
+    """The decoding configurations to sample with: the sampling params of config, each overridden by an entry of config.decoding_sweep
+       (if set). Values are typed as sampler.py parses them, so file names encoding them match."""
+    types = {'num_beams': int, 'repetition_penalty': float, 'top_k': int, 'penalty_alpha': float, 'temperature': float, 'top_p': float,
+             'no_repeat_ngram_size': int}
+    base = {k: config[k] for k in types}
+    sweep = [{}] if config.decoding_sweep is None else config.decoding_sweep
+    decoding_configs = []
+    for overrides in sweep:
+        unknown = set(overrides) - set(types)
+        if unknown:
+            raise ValueError(f'decoding_sweep entries can only override {list(types)}, got {sorted(unknown)}')
+        decoding_configs.append({k: t(overrides.get(k, base[k])) for k, t in types.items()})
+    return decoding_configs
+
+
 def worker_sample(rank: int, world_size: int, config: DictConfig, policy: nn.Module):
     """Samples from model (only BasicTrainer supported)."""
     config.n_eval_examples = None
     print('warning: setting config.n_eval_examples to none, use n_eval_model_samples to control how many samples')
+    assert config.sample_path.endswith('.jsonl'), f'samples are written as JSON lines, so sample_path should end in .jsonl, got {config.sample_path}'
 
     TrainerClass = getattr(trainers, config.trainer)
     print(f'Creating trainer on process {rank} with world size {world_size}')
     trainer = TrainerClass(policy, config, config.seed, config.local_run_dir, reference_model=None, rank=rank, world_size=world_size)
 
-    to_save = trainer.sample(n_per=config.samples_per_prompt, num_beams=config.num_beams, no_repeat_ngram_size=config.no_repeat_ngram_size,
-                             repetition_penalty=config.repetition_penalty, temperature=config.temperature,
-                             top_k=config.top_k, penalty_alpha=config.penalty_alpha, top_p=config.top_p)
-    with open(config.sample_path, "w+") as d:
-        json.dump(to_save, d, indent=4)
-    print(f'Saved samples on {len(to_save)} eval prompts to {config.sample_path}')
+    decoding_configs = get_decoding_configs(config)
+    if config.decoding_sweep is None:
+        save_paths = [config.sample_path]
+    else:
+        save_paths = [config.sample_path[:-len('.jsonl')] + get_sampling_params_suffix(decoding_config) + '.jsonl' for decoding_config in decoding_configs]
+    n_prompts = trainer.sample(save_paths, decoding_configs, n_per=config.samples_per_prompt)
+    for save_path, n in zip(save_paths, n_prompts):
+        print(f'Saved samples on {n} eval prompts to {save_path}')
 
 
 def worker_rewards(rank: int, world_size: int, config: DictConfig, policy: nn.Module, reference_model: nn.Module):
@@ -48,9 +73,56 @@ def worker_rewards(rank: int, world_size: int, config: DictConfig, policy: nn.Mo
     print(f'Creating trainer on process {rank} with world size {world_size}')
     trainer = TrainerClass(policy, config, config.seed, config.local_run_dir, reference_model=reference_model, rank=rank, world_size=world_size)
 
-    to_save = trainer.get_rewards()
-    to_save.to_csv(config.rewards_save_path, index=False)
-    print(f'Saved rewards on {len(to_save)} eval prompt batches to {config.rewards_save_path}')
+    n_rows = trainer.get_rewards(config.rewards_save_path)
+    print(f'Saved {n_rows} rewards on eval prompts to {config.rewards_save_path}')
+
+
+def worker_checkpoints(rank: int, world_size: int, config: DictConfig, policy: nn.Module, reference_model: Optional[nn.Module], model_name: str):
+    """Samples from (or gets rewards of) each of config.policy_archives, loading its weights into policy in place, with one trainer
+       (so the eval batches are built once). Each archive's file is written to config.checkpoints_dir, named as sampler.py names it
+       (only BasicTrainer supported)."""
+    config.n_eval_examples = None
+    print('warning: setting config.n_eval_examples to none, use n_eval_model_samples to control how many samples/rewards')
+
+    TrainerClass = getattr(trainers, config.trainer)
+    print(f'Creating trainer on process {rank} with world size {world_size}')
+    trainer = TrainerClass(policy, config, config.seed, config.local_run_dir, reference_model=reference_model, rank=rank, world_size=world_size)
+
+    os.makedirs(config.checkpoints_dir, exist_ok=True)
+    decoding_configs = get_decoding_configs(config)
+    # a sweep writes one file per decoding configuration, so its file names always encode the sampling params
+    use_sampling_params = config.sampling_params_in_path or (config.sample_only and config.decoding_sweep is not None)
+    for archive in config.policy_archives:
+        run_dir, ckpt_dir = os.path.split(os.path.dirname(os.path.abspath(archive)))
+        beta, alpha = get_loss_params(*os.path.split(run_dir))
+        save_paths = [get_sample_path(config.checkpoints_dir, model_name, config.dataset_id, beta, alpha, ckpt_dir, do_sample=config.sample_only,
+                                      sampling_params=decoding_config, use_sampling_params=use_sampling_params)
+                      for decoding_config in decoding_configs]
+
+        state_dict = torch.load(archive, map_location='cpu')
+        print(f'[policy] loading pre-trained policy weights at step {state_dict["step_idx"]} from {archive}')
+        policy.load_state_dict(state_dict['state'])
+        del state_dict
+
+        if config.sample_only:
+            n_prompts = trainer.sample(save_paths, decoding_configs, n_per=config.samples_per_prompt)
+            for save_path, n in zip(save_paths, n_prompts):
+                print(f'Saved samples on {n} eval prompts to {save_path}')
+        else:
+            save_path = save_paths[0]
+            config.policy_archive = archive  # the rewards file is keyed on it
+            n_rows = trainer.get_rewards(save_path)
+            print(f'Saved {n_rows} rewards on eval prompts to {save_path}')
+
+
+def worker_precompute_reference_logps(rank: int, world_size: int, config: DictConfig, reference_model: nn.Module):
+    """Writes the reference log probs of the train and test splits to config.reference_logps_dir (only BasicTrainer supported)."""
+    TrainerClass = getattr(trainers, config.trainer)
+    print(f'Creating trainer on process {rank} with world size {world_size}')
+    trainer = TrainerClass(reference_model, config, config.seed, config.local_run_dir, reference_model=reference_model, rank=rank, world_size=world_size)
+
+    trainer.precompute_reference_logps()
+    print(f'Saved reference log probs to {config.reference_logps_dir}')
 
 
 def worker_save(rank: int, world_size: int, config: DictConfig, policy: nn.Module, reference_model: nn.Module):
@@ -100,11 +172,28 @@ def main(config: DictConfig):
     if missing_keys:
         raise ValueError(f"Got missing keys in config:\n{missing_keys}")
 
-    if config.eval_every % config.batch_size != 0:
+    if config.max_tokens_per_batch is None and config.eval_every % config.batch_size != 0:
         print('WARNING: eval_every must be divisible by batch_size')
         print('Setting eval_every to', config.eval_every - config.eval_every % config.batch_size)
         config.eval_every = config.eval_every - config.eval_every % config.batch_size
 
+    if config.pack_sft_sequences and config.loss.name == 'sft' and version.parse(transformers.__version__) < version.parse(PACKING_MIN_TRANSFORMERS):
+        raise ValueError(f"pack_sft_sequences is experimental: it needs a model that applies 4D attention masks, and none of the models in transformers "
+                         f"{transformers.__version__} do (Llama does from {PACKING_MIN_TRANSFORMERS}); set pack_sft_sequences=false")
+
+    if config.prefetch_batches and config.tokenize_num_proc:
+        # the tokenization pool would be forked from the prefetching thread while the main thread runs CUDA/NCCL, which can deadlock
+        raise ValueError("prefetch_batches and tokenize_num_proc can't be combined; set prefetch_batches=0 or tokenize_num_proc=null")
+
+    if config.policy_archives is not None:
+        # rewards on sample files are computed per checkpoint, each on that checkpoint's samples, so they can't share one job
+        if any(os.path.exists(dataset) for dataset in config.datasets):
+            raise ValueError("policy_archives can't be used with local sample files as datasets; get their rewards with one job per checkpoint")
+        if config.dataset_id is None:
+            if len(config.datasets) != 1:
+                raise ValueError("with several datasets, set dataset_id to name the files of policy_archives")
+            config.dataset_id = config.datasets[0]
+
     if 'FSDP' in config.trainer and config.fsdp_port is None:
         free_port = get_open_port()
         print('no FSDP port specified; using open port for FSDP:', free_port)
@@ -122,6 +211,11 @@ def main(config: DictConfig):
 
     if config.reward_only:
         assert config.loss.name == "dpo", "for reward sampling, use loss = dpo"
+
+    if config.precompute_reference_logps:
+        assert config.loss.name == "dpo", "for precomputing reference log probs, use loss = dpo"
+        assert config.reference_logps_dir is not None, "specify reference_logps_dir to write the reference log probs to"
+        assert config.trainer == 'BasicTrainer', "precompute reference log probs with BasicTrainer"
  
     os.environ['XDG_CACHE_HOME'] = get_local_dir(config.local_dirs)
     print('building policy')
@@ -134,7 +228,11 @@ def main(config: DictConfig):
 
     step = 0
 
-    if config.loss.name == 'dpo' and not config.sample_only and not config.save_as_hf:
+    # with precomputed reference log probs, training never runs the reference model (reward computation still does)
+    use_reference_logps = config.reference_logps_dir is not None and not config.reward_only
+    build_reference = config.loss.name == 'dpo' and not config.sample_only and not config.save_as_hf and not use_reference_logps
+
+    if build_reference:
         print('building reference model')
         reference_model_dtype = getattr(torch, config.model.reference_dtype)
         reference_model = transformers.AutoModelForCausalLM.from_pretrained(
@@ -151,17 +249,22 @@ def main(config: DictConfig):
         if not config.reward_only or config.policy_archive is None:
             policy.load_state_dict(state_dict['state'])
             print(f'[policy] loaded weights from {config.model.archive}')
-        if config.loss.name == 'dpo' and not config.sample_only and not config.save_as_hf and config.sft_archive is None:
+        if build_reference and config.sft_archive is None:
             reference_model.load_state_dict(state_dict['state'])
             print(f'[reference] loaded weights from {config.model.archive}')
 
     if config.sft_archive is not None:
-        assert config.optimizer_archive, "use sft_archive for resuming training, so specify optimizer_archive too"
+        assert config.optimizer_archive or config.precompute_reference_logps, "use sft_archive for resuming training, so specify optimizer_archive too"
         state_dict = torch.load(config.sft_archive, map_location='cpu')
         step, metrics = state_dict['step_idx'], state_dict['metrics']
         print(f'[reference] loading pre-trained weights at step {step} from {config.sft_archive} with metrics {json.dumps(metrics, indent=2)}')
-        reference_model.load_state_dict(state_dict['state'])
-        print(f'[reference] loaded reference weights (from {config.sft_archive})')
+        if build_reference:
+            reference_model.load_state_dict(state_dict['state'])
+            print(f'[reference] loaded reference weights (from {config.sft_archive})')
+        elif config.precompute_reference_logps:
+            # the policy is run as the reference model
+            policy.load_state_dict(state_dict['state'])
+            print(f'[reference] loaded reference weights into the policy (from {config.sft_archive})')
 
     if config.save_dpo_format is not None:
         print(f"saving with custom dpo format to {config.save_dpo_format}")
@@ -178,6 +281,18 @@ def main(config: DictConfig):
         print("done saving, exiting")
         return
 
+    if config.precompute_reference_logps:
+        print(f'not training, just precomputing reference log probs (saving to {config.reference_logps_dir})')
+        worker_precompute_reference_logps(0, 1, config, policy)
+        return
+
+    if config.policy_archives is not None:
+        assert config.sample_only or config.reward_only, "policy_archives is for sampling (sample_only=true) or rewards (reward_only=true)"
+        assert config.checkpoints_dir is not None, "specify checkpoints_dir to write the samples/rewards of each archive to"
+        print(f'not training, just {"sampling" if config.sample_only else "getting rewards"} for {len(config.policy_archives)} archives (saving to {config.checkpoints_dir})')
+        worker_checkpoints(0, 1, config, policy, reference_model, HydraConfig.get().runtime.choices.model)
+        return
+
     if config.sample_only:
         print(f'not training, just sampling (saving to {config.sample_path})')
         worker_sample(0, 1, config, policy)
@@ -5,7 +5,7 @@ import torch.nn.functional as F
 import torch.nn as nn
 import transformers
 import pandas as pd
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
 
 import torch.distributed as dist
 from torch.distributed.fsdp import (
@@ -20,16 +20,20 @@ from torch.distributed.fsdp.api import FullStateDictConfig, FullOptimStateDictCo
 from torch.distributed.fsdp.wrap import transformer_auto_wrap_policy
 import tensor_parallel as tp
 import contextlib
+import copy
 
-from preference_datasets import get_batch_iterator
+from preference_datasets import get_batch_iterator, get_reference_logps_path, LazyBatches
 from utils import (
     slice_and_move_batch_for_device,
     formatted_dict,
     all_gather_if_needed,
+    MetricsAccumulator,
+    ResumableCSVWriter,
     pad_to_length,
     get_block_class_from_model,
     rank0_print,
     get_local_dir,
+    Prefetcher,
 )
 import numpy as np
 import wandb
@@ -41,7 +45,8 @@ from collections import defaultdict
 import time
 import json
 import functools
-from typing import Optional, Dict, List, Union, Tuple
+import copy
+from typing import Optional, Dict, List, Union, Tuple, Set, Callable
 
 
 def dpo_loss(policy_chosen_logps: torch.FloatTensor,
@@ -90,27 +95,75 @@ def dpo_loss(policy_chosen_logps: torch.FloatTensor,
     return losses, chosen_rewards, rejected_rewards
 
 
-def _get_batch_logps(logits: torch.FloatTensor, labels: torch.LongTensor, average_log_prob: bool = False) -> torch.FloatTensor:
+class _ChunkedTokenLogps(torch.autograd.Function):
+    """The float32 log probabilities of labels under logits, computed (and differentiated) a chunk of positions at a time,
+       so the full float32 log-softmax is never materialized."""
+
+    @staticmethod
+    def forward(ctx, logits: torch.FloatTensor, labels: torch.LongTensor, chunk_size: int) -> torch.FloatTensor:
+        logps = torch.empty(labels.shape, dtype=torch.float32, device=logits.device)
+        logsumexps = torch.empty_like(logps)
+        for start in range(0, labels.shape[1], chunk_size):
+            end = start + chunk_size
+            chunk_logits = logits[:, start:end].to(torch.float32)
+            logsumexps[:, start:end] = chunk_logits.logsumexp(-1)
+            logps[:, start:end] = torch.gather(chunk_logits, dim=2, index=labels[:, start:end].unsqueeze(2)).squeeze(2) - logsumexps[:, start:end]
+        ctx.save_for_backward(logits, labels, logsumexps)
+        ctx.chunk_size = chunk_size
+        return logps
+
+    @staticmethod
+    def backward(ctx, grad_logps: torch.FloatTensor):
+        logits, labels, logsumexps = ctx.saved_tensors
+        grad_logits = torch.empty_like(logits)
+        for start in range(0, labels.shape[1], ctx.chunk_size):
+            end = start + ctx.chunk_size
+            chunk_grad = grad_logps[:, start:end].unsqueeze(2)
+            # d log p(label) / d logits = onehot(label) - softmax(logits)
+            grad = (logits[:, start:end].to(torch.float32) - logsumexps[:, start:end].unsqueeze(2)).exp_().mul_(-chunk_grad)
+            grad.scatter_add_(2, labels[:, start:end].unsqueeze(2), chunk_grad)
+            grad_logits[:, start:end] = grad
+        return grad_logits, None, None
+
+
+def _get_batch_logps(logits: torch.FloatTensor, labels: torch.LongTensor, average_log_prob: bool = False,
+                     segment_ids: Optional[torch.LongTensor] = None, n_segments: Optional[int] = None, chunk_size: int = 128) -> torch.FloatTensor:
     """Compute the log probabilities of the given labels under the given logits.
 
     Args:
         logits: Logits of the model (unnormalized). Shape: (batch_size, sequence_length, vocab_size)
         labels: Labels for which to compute the log probabilities. Label tokens with a value of -100 are ignored. Shape: (batch_size, sequence_length)
         average_log_prob: If True, return the average log probability per (non-masked) token. Otherwise, return the sum of the log probabilities of the (non-masked) tokens.
+        segment_ids: For packed rows (see packed_inputs), the index of the example each token belongs to. If given, log probabilities are
+          summed/averaged per example rather than per row. Shape: (batch_size, sequence_length)
+        n_segments: The number of examples packed into the rows; required with segment_ids.
+        chunk_size: The number of positions to compute log probabilities for at once. The logits are cast to float32 and normalized one chunk
+          at a time (also in the backward pass), so no float32 (batch_size, sequence_length, vocab_size) tensor is created besides the gradient.
 
     Returns:
-        A tensor of shape (batch_size,) containing the average/sum log probabilities of the given labels under the given logits.
+        A tensor of shape (batch_size,) containing the average/sum log probabilities of the given labels under the given logits,
+          or of shape (n_segments,) if segment_ids is given.
     """
     assert logits.shape[:-1] == labels.shape
 
     labels = labels[:, 1:].clone()
-    logits = logits[:, :-1, :]
     loss_mask = (labels != -100)
 
     # dummy token; we'll ignore the losses on these tokens later
     labels[labels == -100] = 0
 
-    per_token_logps = torch.gather(logits.log_softmax(-1), dim=2, index=labels.unsqueeze(2)).squeeze(2)
+    # the last position predicts nothing; rather than slicing it off the logits (which would allocate a full-size gradient
+    #   in the backward pass), give it a dummy label and drop its log prob afterwards
+    per_token_logps = _ChunkedTokenLogps.apply(logits, F.pad(labels, (0, 1)), chunk_size)[:, :-1]
+
+    if segment_ids is not None:
+        segment_ids = segment_ids[:, 1:].clamp(min=0).flatten()
+        logps = torch.zeros(n_segments, dtype=per_token_logps.dtype, device=per_token_logps.device)
+        logps = logps.scatter_add(0, segment_ids, (per_token_logps * loss_mask).flatten())
+        if average_log_prob:
+            n_tokens = torch.zeros(n_segments, dtype=per_token_logps.dtype, device=per_token_logps.device)
+            return logps / n_tokens.scatter_add(0, segment_ids, loss_mask.flatten().to(n_tokens.dtype))
+        return logps
 
     if average_log_prob:
         return (per_token_logps * loss_mask).sum(-1) / loss_mask.sum(-1)
@@ -118,6 +171,92 @@ def _get_batch_logps(logits: torch.FloatTensor, labels: torch.LongTensor, averag
         return (per_token_logps * loss_mask).sum(-1)
 
 
+def _get_selected_logps(logits: torch.FloatTensor, labels: torch.LongTensor, positions: torch.BoolTensor, average_log_prob: bool = False,
+                        segment_ids: Optional[torch.LongTensor] = None, n_segments: Optional[int] = None, chunk_size: int = 128) -> torch.FloatTensor:
+    """Like _get_batch_logps, but for logits computed at the given positions only (see lm_head_at_positions).
+
+    Args:
+        logits: Logits of the model at the selected positions. Shape: (n_positions, vocab_size)
+        labels: Labels for which to compute the log probabilities. Label tokens with a value of -100 are ignored. Shape: (batch_size, sequence_length)
+        positions: Which positions the logits were computed at; must include every position followed by a label. Shape: (batch_size, sequence_length)
+        average_log_prob, segment_ids, n_segments, chunk_size: As for _get_batch_logps.
+
+    Returns:
+        A tensor of shape (batch_size,) containing the average/sum log probabilities of the given labels, or of shape (n_segments,) if segment_ids is given.
+    """
+    # the logits at each position predict the label at the next one
+    targets = F.pad(labels[:, 1:], (0, 1), value=-100)[positions]
+    loss_mask = (targets != -100)
+    per_token_logps = _ChunkedTokenLogps.apply(logits.unsqueeze(0), targets.clamp(min=0).unsqueeze(0), chunk_size)[0] * loss_mask
+
+    if segment_ids is not None:
+        rows = F.pad(segment_ids[:, 1:], (0, 1))[positions].clamp(min=0)
+    else:
+        rows, n_segments = positions.nonzero()[:, 0], labels.shape[0]
+    logps = torch.zeros(n_segments, dtype=per_token_logps.dtype, device=per_token_logps.device).index_add(0, rows, per_token_logps)
+    if average_log_prob:
+        return logps / torch.zeros_like(logps).index_add(0, rows, loss_mask.to(logps.dtype))
+    return logps
+
+
+def label_positions(labels: torch.LongTensor) -> torch.BoolTensor:
+    """Return which positions' logits are needed to score the given labels, i.e. the positions followed by a label other than -100."""
+    return F.pad(labels[:, 1:] != -100, (0, 1), value=False)
+
+
+@contextlib.contextmanager
+def lm_head_at_positions(model: nn.Module, positions: torch.BoolTensor):
+    """Within this context, the model only applies its LM head to the hidden states at the given positions, so the logits it returns
+         have shape (n_positions, vocab_size) instead of (batch_size, sequence_length, vocab_size).
+
+       The positions are selected in a forward pre-hook on the output embeddings, so this also works on a model wrapped in FSDP.
+    """
+    def select_positions(module, args):
+        return (args[0][positions],) + tuple(args[1:])
+
+    handle = model.get_output_embeddings().register_forward_pre_hook(select_positions)
+    try:
+        yield
+    finally:
+        handle.remove()
+
+
+def map_past_key_values(past_key_values, fn: Callable[[torch.Tensor], torch.Tensor]):
+    """Return a copy of a model's cached keys/values with fn applied to each key and value tensor (e.g., to select or repeat rows), in the
+       same form: tuples of tensors per layer (as in transformers 4.29), or a transformers Cache (as newer versions return)."""
+    if isinstance(past_key_values, tuple):
+        return tuple(tuple(fn(t) for t in layer) for layer in past_key_values)
+    # the model updates a Cache in place, so the copy gets its own layers
+    cache = copy.copy(past_key_values)
+    if hasattr(cache, 'layers'):
+        cache.layers = [copy.copy(layer) for layer in cache.layers]
+        for layer in cache.layers:
+            layer.keys, layer.values = fn(layer.keys), fn(layer.values)
+    else:
+        cache.key_cache = [fn(t) for t in cache.key_cache]
+        cache.value_cache = [fn(t) for t in cache.value_cache]
+    return cache
+
+
+def get_sampled_prompts(save_path: str) -> Set[str]:
+    """Return the prompts in a JSONL file of samples written by BasicTrainer.sample, ignoring its last line if it was not fully written."""
+    if not os.path.exists(save_path):
+        return set()
+    with open(save_path, 'rb') as f:
+        lines = f.read().split(b'\n')
+    # the last line is empty, unless the job was stopped while writing it
+    return set(json.loads(line)['prompt'] for line in lines[:-1])
+
+
+def repair_jsonl(path: str):
+    """Drop the last line of a JSONL file if it was not fully written (i.e., does not end with a newline), so lines can be appended to it."""
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        lines = f.read().split(b'\n')
+    os.truncate(path, sum(len(line) + 1 for line in lines[:-1]))
+
+
 def concatenated_inputs(batch: Dict[str, Union[List, torch.LongTensor]]) -> Dict[str, torch.LongTensor]:
     """Concatenate the chosen and rejected inputs into a single tensor.
     
@@ -145,6 +284,139 @@ def concatenated_inputs(batch: Dict[str, Union[List, torch.LongTensor]]) -> Dict
     return concatenated_batch
 
 
+def response_inputs(batch: Dict[str, Union[List, torch.LongTensor]]) -> Dict[str, torch.LongTensor]:
+    """Split the responses off the chosen and rejected inputs, and concatenate them into a single tensor.
+
+    Args:
+        batch: A batch of data. Must contain the prompt, chosen and rejected input ids, attention masks and labels.
+
+    Returns:
+        A dictionary containing the concatenated (right-padded) response-only inputs under the keys 'response_input_ids', 'response_attention_mask'
+          and 'response_labels', and the positions of their first tokens in the full sequences under 'response_start'.
+    """
+    prompt_lengths = batch['prompt_attention_mask'].sum(-1, keepdim=True)
+    responses = {}
+    for prefix in ('chosen', 'rejected'):
+        response_lengths = batch[f'{prefix}_attention_mask'].sum(-1, keepdim=True) - prompt_lengths
+        width = int(response_lengths.max())
+        offsets = torch.arange(width, device=prompt_lengths.device).unsqueeze(0)
+        valid = offsets < response_lengths
+        index = (prompt_lengths + offsets).clamp(max=batch[f'{prefix}_input_ids'].shape[1] - 1)
+        responses[prefix] = {
+            'input_ids': torch.gather(batch[f'{prefix}_input_ids'], 1, index).masked_fill(~valid, 0),
+            'attention_mask': valid.long(),
+            'labels': torch.gather(batch[f'{prefix}_labels'], 1, index).masked_fill(~valid, -100),
+        }
+
+    width = max(responses['chosen']['input_ids'].shape[1], responses['rejected']['input_ids'].shape[1])
+    response_batch = {}
+    for k, pad_value in (('input_ids', 0), ('attention_mask', 0), ('labels', -100)):
+        response_batch[f'response_{k}'] = torch.cat((
+            pad_to_length(responses['chosen'][k], width, pad_value=pad_value),
+            pad_to_length(responses['rejected'][k], width, pad_value=pad_value),
+        ), dim=0)
+    response_batch['response_start'] = torch.cat((prompt_lengths, prompt_lengths), dim=0)
+    return response_batch
+
+
+def packed_inputs(batch: Dict[str, Union[List, torch.LongTensor]], prefix: str = 'chosen', mask_dtype: torch.dtype = torch.float32) -> Dict[str, torch.Tensor]:
+    """Pack the (right-padded) sequences of a batch into as few rows as possible, so that short sequences share a row instead of being padded.
+
+    Rows are as long as the padded sequences, so packing never makes a batch larger. Sequences are placed first-fit, longest first. Each
+      sequence keeps its own position ids, and the attention mask stops tokens from attending to other sequences in the same row.
+
+    Args:
+        batch: A batch of data. Must contain the keys '{prefix}_input_ids', '{prefix}_attention_mask' and '{prefix}_labels'.
+        prefix: Which sequences to pack.
+        mask_dtype: The dtype of the attention mask; should match the dtype the model computes attention in.
+
+    Returns:
+        A dictionary with the packed 'packed_input_ids', 'packed_labels', 'packed_position_ids' and 'packed_segment_ids' (the index of the
+          example each token belongs to, or -1 for padding), all of shape (n_rows, sequence_length), and the additive 'packed_attention_mask'
+          of shape (n_rows, 1, sequence_length, sequence_length), which is 0 where a token may attend to another and the minimum value of
+          mask_dtype elsewhere (the format transformers takes for 4D attention masks).
+    """
+    input_ids, labels = batch[f'{prefix}_input_ids'], batch[f'{prefix}_labels']
+    width = input_ids.shape[1]
+    lengths = batch[f'{prefix}_attention_mask'].sum(-1).tolist()
+
+    rows, row_lengths = [], []
+    for idx in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        row = next((r for r, row_length in enumerate(row_lengths) if row_length + lengths[idx] <= width), None)
+        if row is None:
+            rows.append([])
+            row_lengths.append(0)
+            row = len(rows) - 1
+        rows[row].append(idx)
+        row_lengths[row] += lengths[idx]
+
+    # the row of each sequence, and the offset in it of its first token
+    sequence_rows, sequence_offsets = [0] * len(lengths), [0] * len(lengths)
+    for row, idxs in enumerate(rows):
+        offset = 0
+        for idx in idxs:
+            sequence_rows[idx], sequence_offsets[idx] = row, offset
+            offset += lengths[idx]
+    sequence_rows = torch.tensor(sequence_rows, dtype=torch.long, device=input_ids.device)
+    sequence_offsets = torch.tensor(sequence_offsets, dtype=torch.long, device=input_ids.device)
+
+    # move every token of every sequence to its place in the packed rows at once
+    positions = torch.arange(width, device=input_ids.device)
+    valid = positions[None, :] < torch.tensor(lengths, device=input_ids.device)[:, None]
+    sequence_idx, position = valid.nonzero(as_tuple=True)
+    row, column = sequence_rows[sequence_idx], sequence_offsets[sequence_idx] + position
+
+    packed_input_ids = torch.zeros((len(rows), width), dtype=input_ids.dtype, device=input_ids.device)
+    packed_labels = torch.full_like(packed_input_ids, -100)
+    packed_position_ids = torch.zeros_like(packed_input_ids)
+    packed_segment_ids = torch.full_like(packed_input_ids, -1)
+    packed_input_ids[row, column] = input_ids[sequence_idx, position]
+    # the first token of a sequence is never predicted, so it cannot be the target of the previous sequence's last token
+    packed_labels[row, column] = labels[sequence_idx, position].masked_fill(position == 0, -100)
+    packed_position_ids[row, column] = position
+    packed_segment_ids[row, column] = sequence_idx
+
+    same_segment = packed_segment_ids[:, :, None] == packed_segment_ids[:, None, :]
+    causal = torch.ones((width, width), dtype=torch.bool, device=input_ids.device).tril()
+    # padding tokens attend to themselves only, so that no row of the mask is empty
+    diagonal = torch.eye(width, dtype=torch.bool, device=input_ids.device)
+    attend = ((same_segment & (packed_segment_ids[:, None, :] >= 0) & causal) | diagonal).unsqueeze(1)
+    packed_attention_mask = torch.zeros(attend.shape, dtype=mask_dtype, device=input_ids.device).masked_fill(~attend, torch.finfo(mask_dtype).min)
+
+    return {
+        'packed_input_ids': packed_input_ids,
+        'packed_labels': packed_labels,
+        'packed_position_ids': packed_position_ids,
+        'packed_segment_ids': packed_segment_ids,
+        'packed_attention_mask': packed_attention_mask,
+    }
+
+
+def check_4d_attention_mask(model: nn.Module):
+    """Raise a ValueError unless model applies 4D attention masks as packed_inputs builds them.
+
+       Two sequences are packed into one row, and the logits of each must match those of the sequence run on its own; a model that only takes
+         2D masks (like those of transformers 4.29) either fails on the 4D mask, or lets packed sequences attend to each other.
+    """
+    embeddings = model.get_input_embeddings().weight
+    input_ids = torch.tensor([[1, 2, 3, 0, 0, 0], [4, 5, 6, 0, 0, 0]], device=embeddings.device)
+    attention_mask = (torch.arange(6, device=embeddings.device) < 3).long().expand(2, -1)
+    packed_batch = packed_inputs({'chosen_input_ids': input_ids, 'chosen_attention_mask': attention_mask, 'chosen_labels': input_ids}, mask_dtype=embeddings.dtype)
+    assert packed_batch['packed_input_ids'].shape[0] == 1, 'expected both sequences to be packed into one row'
+
+    message = f'pack_sft_sequences needs a model that accepts 4D attention masks, but {type(model).__name__}'
+    with torch.no_grad():
+        try:
+            packed_logits = model(packed_batch['packed_input_ids'], attention_mask=packed_batch['packed_attention_mask'],
+                                  position_ids=packed_batch['packed_position_ids']).logits[0].float()
+        except Exception as e:
+            raise ValueError(f'{message} fails on one ({type(e).__name__}: {e})') from e
+        logits = model(input_ids[:, :3], attention_mask=attention_mask[:, :3]).logits.float()
+    segment_ids = packed_batch['packed_segment_ids'][0]
+    if not all(torch.allclose(packed_logits[segment_ids == idx], logits[idx], rtol=1e-2, atol=1e-2) for idx in range(2)):
+        raise ValueError(f'{message} does not apply them (packed sequences would attend to each other)')
+
+
 class BasicTrainer(object):
     def __init__(self, policy: nn.Module, config: DictConfig, seed: int, run_dir: str, reference_model: Optional[nn.Module] = None, rank: int = 0, world_size: int = 1, no_train: bool = False):
         """A trainer for a language model, supporting either SFT or DPO training.
@@ -171,14 +443,31 @@ class BasicTrainer(object):
             max_length=config.max_length,
             max_prompt_length=config.max_prompt_length,
             sft_mode=config.loss.name == 'sft',
-            deduplicate=config.sample_only or config.reward_only
+            deduplicate=config.sample_only or config.reward_only,
+            tokenized_cache_dir=config.tokenized_cache_dir,
+            num_proc=config.tokenize_num_proc,
+            stream=config.stream_datasets,
+            shuffle_buffer_size=config.shuffle_buffer_size,
         )
+        self.data_iterator_kwargs = data_iterator_kwargs
+        use_reference_logps = not (config.precompute_reference_logps or config.sample_only or config.reward_only)
+        reference_logps_dir = config.reference_logps_dir if use_reference_logps else None
+        # the reference weights of DPO (see train.py); the precomputed reference log probs are keyed on them
+        self.reference_archive = config.sft_archive or config.model.archive
+
+        if config.pack_sft_sequences and config.loss.name == 'sft':
+            check_4d_attention_mask(policy)
 
         self.policy = policy
         self.reference_model = reference_model
 
+        # the position of the train iterator, updated as it yields batches (see get_batch_iterator); restored from config.data_archive
+        self.train_iterator_state = {}
         if not no_train:
-            self.train_iterator = get_batch_iterator(**data_iterator_kwargs, split='train', n_epochs=config.n_epochs, n_examples=config.n_examples, batch_size=config.batch_size, silent=rank != 0, cache_dir=get_local_dir(config.local_dirs))
+            self.train_iterator = get_batch_iterator(**data_iterator_kwargs, split='train', n_epochs=config.n_epochs, n_examples=config.n_examples, batch_size=config.batch_size, silent=rank != 0, cache_dir=get_local_dir(config.local_dirs), reference_logps_dir=reference_logps_dir,
+                                                     reference_archive=self.reference_archive, length_bucket_batches=config.length_bucket_batches, max_tokens_per_batch=config.max_tokens_per_batch,
+                                                     batch_size_multiple=config.gradient_accumulation_steps * world_size, state=self.train_iterator_state,
+                                                     rank=rank, world_size=world_size, n_microbatches=config.gradient_accumulation_steps)
             rank0_print(f'Loaded train data iterator')
         else:
             self.train_iterator = None
@@ -190,23 +479,50 @@ class BasicTrainer(object):
         else:
             n_epochs = None
             n_examples = config.n_eval_examples
-        self.eval_iterator = get_batch_iterator(**data_iterator_kwargs, split='test', n_examples=n_examples, n_epochs=n_epochs, batch_size=config.eval_batch_size, silent=rank != 0, cache_dir=get_local_dir(config.local_dirs))
-        self.eval_batches = list(self.eval_iterator)
-        rank0_print(f'Loaded {len(self.eval_batches)} eval batches of size {config.eval_batch_size}')
+        # eval batches are only built when first used (e.g., sampling only builds those of the n_eval_model_samples prompts), and cached with the tokenized datasets
+        eval_iterator_kwargs = dict(data_iterator_kwargs, split='test', n_examples=n_examples, n_epochs=n_epochs, batch_size=config.eval_batch_size, silent=rank != 0,
+                                    cache_dir=get_local_dir(config.local_dirs), reference_logps_dir=reference_logps_dir, reference_archive=self.reference_archive)
+        self.eval_batches = LazyBatches(eval_iterator_kwargs, cache_dir=config.tokenized_cache_dir)
+        rank0_print(f'Loaded eval data iterator (batches of size {config.eval_batch_size})')
+
+    def get_prompt_cache(self, batch: Dict[str, torch.LongTensor]) -> Optional[Tuple]:
+        """Run the policy over every prompt token but the last, and return their cached keys/values, which get_batch_samples can continue
+           from (generate then only runs the last prompt token), so several decoding configurations share one forward pass over the prompts.
+        """
+        if batch['prompt_input_ids'].shape[1] < 2:
+            return None
+        prompt_attention_mask = batch['prompt_attention_mask'][:, :-1]
+        # the prompt is left-padded, so count positions from its first real token
+        prompt_position_ids = (prompt_attention_mask.cumsum(-1) - 1).clamp(min=0)
+        ctx = lambda: (FSDP.summon_full_params(self.policy, writeback=False, recurse=False) if 'FSDP' in self.config.trainer else contextlib.nullcontext())
+        # none of the logits are used
+        with torch.no_grad(), ctx(), lm_head_at_positions(self.policy, torch.zeros_like(prompt_attention_mask, dtype=torch.bool)):
+            outputs = self.policy(batch['prompt_input_ids'][:, :-1], attention_mask=prompt_attention_mask, position_ids=prompt_position_ids, use_cache=True)
+        return outputs.past_key_values
 
     def get_batch_samples(self, batch: Dict[str, torch.LongTensor], use_reference: bool = False, num_beams: int = None, repetition_penalty: float = 1.0,
                           top_k: int = 50, penalty_alpha: float = 0.0, temperature: float = 1.0,
-                          top_p: float = 1.0, no_repeat_ngram_size: int = 0) -> Tuple[str, str]:
-        """Generate samples from the policy (and reference model, if doing DPO training) for the given batch of inputs."""
+                          top_p: float = 1.0, no_repeat_ngram_size: int = 0, prompt_cache: Optional[Tuple] = None) -> Tuple[str, str]:
+        """Generate samples from the policy (and reference model, if doing DPO training) for the given batch of inputs.
+
+           If given, prompt_cache is the policy's get_prompt_cache of the batch (not supported for contrastive search).
+        """
         do_sample = temperature != 0
 
+        cache_kwargs = {}
+        if prompt_cache is not None:
+            assert not (penalty_alpha > 0 and top_k > 1), "contrastive search runs the whole prompt itself, so it can't continue from prompt_cache"
+            # generate repeats the inputs once per beam, but not the cached keys/values
+            expand_size = num_beams if num_beams is not None and num_beams > 1 else 1
+            cache_kwargs['past_key_values'] = map_past_key_values(prompt_cache, lambda t: t.repeat_interleave(expand_size, dim=0))
+
         # FSDP generation according to https://github.com/pytorch/pytorch/issues/100069
         ctx = lambda: (FSDP.summon_full_params(self.policy, writeback=False, recurse=False) if 'FSDP' in self.config.trainer else contextlib.nullcontext())
         with ctx():
             policy_output = self.policy.generate(
                 batch['prompt_input_ids'], attention_mask=batch['prompt_attention_mask'], max_length=self.config.max_length, do_sample=do_sample, pad_token_id=self.tokenizer.pad_token_id,
                 num_beams=num_beams, repetition_penalty=repetition_penalty, top_k=top_k, penalty_alpha=penalty_alpha, temperature=temperature,
-                no_repeat_ngram_size=no_repeat_ngram_size, top_p=top_p)
+                no_repeat_ngram_size=no_repeat_ngram_size, top_p=top_p, **cache_kwargs)
 
         if use_reference:
             ctx = lambda: (FSDP.summon_full_params(self.reference_model, writeback=False, recurse=False) if 'FSDP' in self.config.trainer else contextlib.nullcontext())
@@ -258,19 +574,23 @@ class BasicTrainer(object):
         
            We do this to avoid doing two forward passes, because it's faster for FSDP.
         """
+        if self.config.share_prompt_prefix:
+            return self.shared_prefix_forward(model, batch, return_z=return_z)
+
         concatenated_batch = concatenated_inputs(batch)
-        all_logits = model(concatenated_batch['concatenated_input_ids'], attention_mask=concatenated_batch['concatenated_attention_mask']).logits.to(torch.float32)
         batch_size = batch['chosen_input_ids'].shape[0]
+        z_positions = None
+        if return_z:
+            # the chosen rows start with the prompt, so the logits after its last token are already here
+            prompt_lengths = batch['prompt_attention_mask'].sum(-1)
+            z_positions = (torch.arange(batch_size, device=prompt_lengths.device), prompt_lengths - 1)
 
+        all_logps, prompt_logits = self.forward_logps(model, concatenated_batch['concatenated_input_ids'], concatenated_batch['concatenated_labels'],
+                                                      z_positions=z_positions, attention_mask=concatenated_batch['concatenated_attention_mask'])
         if return_z:
-            with torch.no_grad():
-                prompt_logits = model(
-                    batch['prompt_input_ids'],
-                    attention_mask=batch['prompt_attention_mask'],
-                ).logits.to(torch.float32)[:, -1, :]
-                z = self.config.loss.beta * torch.logsumexp(prompt_logits / self.config.loss.beta, dim=1)
-
-        all_logps = _get_batch_logps(all_logits, concatenated_batch['concatenated_labels'], average_log_prob=False)
+            prompt_logits = prompt_logits.detach().to(torch.float32)
+            z = self.config.loss.beta * torch.logsumexp(prompt_logits / self.config.loss.beta, dim=1)
+
         chosen_logps = all_logps[:batch_size]
         rejected_logps = all_logps[batch_size:]
 
@@ -278,16 +598,96 @@ class BasicTrainer(object):
             return chosen_logps, rejected_logps, z
         return chosen_logps, rejected_logps
 
+    def shared_prefix_forward(self, model: nn.Module, batch: Dict[str, Union[List, torch.LongTensor]], return_z: bool = False) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+        """Like concatenated_forward, but run the prompt only once, and continue both the chosen and rejected responses from its cached keys/values.
+
+           The last prompt position predicts the first response token, and also gives z, so no extra forward pass is needed for it.
+        """
+        prompt_attention_mask = batch['prompt_attention_mask']
+        # the prompt is left-padded, so count positions from its first real token
+        prompt_position_ids = (prompt_attention_mask.cumsum(-1) - 1).clamp(min=0)
+        if self.config.response_only_lm_head:
+            last_position = torch.zeros_like(prompt_attention_mask, dtype=torch.bool)
+            last_position[:, -1] = True
+            with lm_head_at_positions(model, last_position):
+                prompt_outputs = model(batch['prompt_input_ids'], attention_mask=prompt_attention_mask, position_ids=prompt_position_ids, use_cache=True)
+            prompt_logits = prompt_outputs.logits.to(torch.float32)
+        else:
+            prompt_outputs = model(batch['prompt_input_ids'], attention_mask=prompt_attention_mask, position_ids=prompt_position_ids, use_cache=True)
+            prompt_logits = prompt_outputs.logits[:, -1, :].to(torch.float32)
+        batch_size = batch['chosen_input_ids'].shape[0]
+
+        # the chosen and rejected responses both continue the same prompt, so duplicate its cache
+        response_batch = response_inputs(batch)
+        past_key_values = map_past_key_values(prompt_outputs.past_key_values, lambda t: torch.cat((t, t), dim=0))
+        attention_mask = torch.cat((torch.cat((prompt_attention_mask, prompt_attention_mask), dim=0), response_batch['response_attention_mask']), dim=1)
+        position_ids = response_batch['response_start'] + torch.arange(response_batch['response_input_ids'].shape[1], device=attention_mask.device)
+        response_labels = response_batch['response_labels']
+        response_logps, _ = self.forward_logps(model, response_batch['response_input_ids'], response_labels, attention_mask=attention_mask,
+                                               position_ids=position_ids, past_key_values=past_key_values)
+
+        first_labels = response_labels[:, 0]
+        first_logps = torch.gather(torch.cat((prompt_logits, prompt_logits), dim=0).log_softmax(-1), dim=1, index=first_labels.clamp(min=0).unsqueeze(1)).squeeze(1)
+        all_logps = first_logps * (first_labels != -100) + response_logps
+        chosen_logps = all_logps[:batch_size]
+        rejected_logps = all_logps[batch_size:]
+
+        if return_z:
+            z = self.config.loss.beta * torch.logsumexp(prompt_logits.detach() / self.config.loss.beta, dim=1)
+            return chosen_logps, rejected_logps, z
+        return chosen_logps, rejected_logps
+
+    def single_forward(self, model: nn.Module, batch: Dict[str, Union[List, torch.LongTensor]], return_z: bool = False) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+        """Run the given model on the chosen inputs only, for batches without rejected responses (e.g., samples to compute rewards on)."""
+        batch_size = batch['chosen_input_ids'].shape[0]
+        prompt_lengths = batch['prompt_attention_mask'].sum(-1)
+        z_positions = (torch.arange(batch_size, device=prompt_lengths.device), prompt_lengths - 1) if return_z else None
+        logps, prompt_logits = self.forward_logps(model, batch['chosen_input_ids'], batch['chosen_labels'], z_positions=z_positions,
+                                                  attention_mask=batch['chosen_attention_mask'])
+        if return_z:
+            z = self.config.loss.beta * torch.logsumexp(prompt_logits.detach().to(torch.float32) / self.config.loss.beta, dim=1)
+            return logps, z
+        return logps
+
+    def forward_logps(self, model: nn.Module, input_ids: torch.LongTensor, labels: torch.LongTensor, z_positions: Optional[Tuple[torch.LongTensor, torch.LongTensor]] = None,
+                      segment_ids: Optional[torch.LongTensor] = None, n_segments: Optional[int] = None, **model_kwargs) -> Tuple[torch.FloatTensor, Optional[torch.FloatTensor]]:
+        """Run the given model on input_ids, and return the summed log probs of labels (per row, or per segment if segment_ids is given),
+           and the logits at z_positions (a tuple of row and column indices), if given.
+
+           With config.response_only_lm_head, the LM head is only applied at the positions these need, not at every prompt and padding position.
+        """
+        if not self.config.response_only_lm_head:
+            logits = model(input_ids, **model_kwargs).logits
+            logps = _get_batch_logps(logits, labels, average_log_prob=False, segment_ids=segment_ids, n_segments=n_segments)
+            return logps, (logits[z_positions] if z_positions is not None else None)
+
+        positions = label_positions(labels)
+        if z_positions is not None:
+            positions[z_positions] = True
+        with lm_head_at_positions(model, positions):
+            logits = model(input_ids, **model_kwargs).logits
+        logps = _get_selected_logps(logits, labels, positions, average_log_prob=False, segment_ids=segment_ids, n_segments=n_segments)
+        if z_positions is None:
+            return logps, None
+        logits_index = positions.flatten().cumsum(0).view(positions.shape) - 1
+        return logps, logits[logits_index[z_positions]]
+
     def get_batch_metrics(self, batch: Dict[str, Union[List, torch.LongTensor]], loss_config: DictConfig, train=True):
-        """Compute the SFT or DPO loss and other metrics for the given batch of inputs."""
+        """Compute the SFT or DPO loss and other metrics for the given batch of inputs.
+
+           The metrics are tensors of per-example values of this process's batch, left on its device (see MetricsAccumulator).
+        """
 
         metrics = {}
         train_test = 'train' if train else 'eval'
 
         if loss_config.name == 'dpo':
             policy_chosen_logps, policy_rejected_logps, policy_z = self.concatenated_forward(self.policy, batch, return_z=True)
-            with torch.no_grad():
-                reference_chosen_logps, reference_rejected_logps = self.concatenated_forward(self.reference_model, batch)
+            if 'reference_chosen_logps' in batch:
+                reference_chosen_logps, reference_rejected_logps = batch['reference_chosen_logps'], batch['reference_rejected_logps']
+            else:
+                with torch.no_grad():
+                    reference_chosen_logps, reference_rejected_logps = self.concatenated_forward(self.reference_model, batch)
 
             losses, chosen_rewards, rejected_rewards = dpo_loss(
                 policy_chosen_logps, policy_rejected_logps, reference_chosen_logps, reference_rejected_logps,
@@ -299,120 +699,210 @@ class BasicTrainer(object):
             )
             reward_accuracies = (chosen_rewards > rejected_rewards).float()
 
-            chosen_rewards = all_gather_if_needed(chosen_rewards, self.rank, self.world_size)
-            rejected_rewards = all_gather_if_needed(rejected_rewards, self.rank, self.world_size)
-            reward_accuracies = all_gather_if_needed(reward_accuracies, self.rank, self.world_size)
-            policy_z = all_gather_if_needed(policy_z, self.rank, self.world_size)
-
-            metrics[f'rewards_{train_test}/chosen'] = chosen_rewards.cpu().numpy().tolist()
-            metrics[f'rewards_{train_test}/rejected'] = rejected_rewards.cpu().numpy().tolist()
-            metrics[f'rewards_{train_test}/accuracies'] = reward_accuracies.cpu().numpy().tolist()
-            metrics[f'rewards_{train_test}/margins'] = (chosen_rewards - rejected_rewards).cpu().numpy().tolist()
-            metrics[f'rewards_{train_test}/z'] = policy_z.cpu().numpy().tolist()
-
-            policy_rejected_logps = all_gather_if_needed(policy_rejected_logps.detach(), self.rank, self.world_size)
-            metrics[f'logps_{train_test}/rejected'] = policy_rejected_logps.cpu().numpy().tolist()
+            metrics[f'rewards_{train_test}/chosen'] = chosen_rewards.detach()
+            metrics[f'rewards_{train_test}/rejected'] = rejected_rewards.detach()
+            metrics[f'rewards_{train_test}/accuracies'] = reward_accuracies
+            metrics[f'rewards_{train_test}/margins'] = (chosen_rewards - rejected_rewards).detach()
+            metrics[f'rewards_{train_test}/z'] = policy_z.detach()
+            metrics[f'logps_{train_test}/rejected'] = policy_rejected_logps.detach()
 
         elif loss_config.name == 'sft':
-            policy_chosen_logits = self.policy(batch['chosen_input_ids'], attention_mask=batch['chosen_attention_mask']).logits.to(torch.float32)
-            policy_chosen_logps = _get_batch_logps(policy_chosen_logits, batch['chosen_labels'], average_log_prob=False)
+            if self.config.pack_sft_sequences:
+                compute_dtype = getattr(torch, self.config.model.fsdp_policy_mp or self.config.model.policy_dtype)
+                packed_batch = packed_inputs(batch, mask_dtype=compute_dtype)
+                policy_chosen_logps, _ = self.forward_logps(self.policy, packed_batch['packed_input_ids'], packed_batch['packed_labels'],
+                                                            segment_ids=packed_batch['packed_segment_ids'], n_segments=batch['chosen_input_ids'].shape[0],
+                                                            attention_mask=packed_batch['packed_attention_mask'], position_ids=packed_batch['packed_position_ids'])
+            else:
+                policy_chosen_logps, _ = self.forward_logps(self.policy, batch['chosen_input_ids'], batch['chosen_labels'], attention_mask=batch['chosen_attention_mask'])
 
             losses = -policy_chosen_logps
 
-        policy_chosen_logps = all_gather_if_needed(policy_chosen_logps.detach(), self.rank, self.world_size)
-        metrics[f'logps_{train_test}/chosen'] = policy_chosen_logps.cpu().numpy().tolist()
-
-        all_devices_losses = all_gather_if_needed(losses.detach(), self.rank, self.world_size)
-        metrics[f'loss/{train_test}'] = all_devices_losses.cpu().numpy().tolist()
+        metrics[f'logps_{train_test}/chosen'] = policy_chosen_logps.detach()
+        metrics[f'loss/{train_test}'] = losses.detach()
 
         return losses.mean(), metrics
     
-    def get_rewards(self):
-        """Gets rewards under the policy and reference model for eval set. Only works with BasicTrainer."""
+    def get_batch_rewards(self, batch: Dict[str, Union[List, torch.LongTensor]]) -> Dict[str, List]:
+        """Compute the rewards under the policy and reference model of the examples of a batch, as a list of values per column (see get_rewards)."""
+        beta = self.config.loss.beta
+        with torch.no_grad():
+            if 'rejected_input_ids' not in batch:
+                # no rejected responses (e.g., sampled outputs), so score each sample on its own
+                policy_logps, policy_z = self.single_forward(self.policy, batch, return_z=True)
+                reference_logps, reference_z = self.single_forward(self.reference_model, batch, return_z=True)
+                rewards = beta * (policy_logps - reference_logps)
+                return {
+                    "type": ["sample"] * len(batch['prompt']),
+                    "policy_logps": policy_logps.cpu().tolist(),
+                    "reference_logps": reference_logps.cpu().tolist(),
+                    "policy_z": policy_z.cpu().tolist(),
+                    "reference_z": reference_z.cpu().tolist(),
+                    "rewards": rewards.cpu().tolist(),
+                    "lengths": list(batch["chosen_len_real"]),
+                    "completion": list(batch["chosen_response_only"]),
+                    "prompt": list(batch["prompt"]),
+                }
+
+            policy_chosen_logps, policy_rejected_logps, policy_z = self.concatenated_forward(self.policy, batch, return_z=True)
+            reference_chosen_logps, reference_rejected_logps, reference_z = self.concatenated_forward(self.reference_model, batch, return_z=True)
+            _, chosen_rewards, rejected_rewards = dpo_loss(
+                policy_chosen_logps, policy_rejected_logps, reference_chosen_logps, reference_rejected_logps,
+                beta=beta,
+                alpha=self.config.loss.alpha,
+                reference_free=self.config.loss.reference_free,
+                chosen_len=batch["chosen_len"],
+                rejected_len=batch["rejected_len"]
+            )
+
+        policy_z, reference_z = policy_z.cpu().tolist(), reference_z.cpu().tolist()
+        columns = {}
+        for k in ('chosen', 'rejected'):
+            columns[k] = {
+                "type": [k] * len(batch['prompt']),
+                "policy_logps": (policy_chosen_logps if k == 'chosen' else policy_rejected_logps).cpu().tolist(),
+                "reference_logps": (reference_chosen_logps if k == 'chosen' else reference_rejected_logps).cpu().tolist(),
+                "policy_z": policy_z,
+                "reference_z": reference_z,
+                "rewards": (chosen_rewards if k == 'chosen' else rejected_rewards).cpu().tolist(),
+                "lengths": list(batch[f"{k}_len_real"]),
+                "completion": list(batch[f"{k}_response_only"]),
+                "prompt": list(batch["prompt"]),
+            }
+        # a chosen row and then a rejected row per example
+        return {column: [v for pair in zip(columns['chosen'][column], columns['rejected'][column]) for v in pair] for column in columns['chosen']}
+
+    def get_rewards(self, save_path: str) -> int:
+        """Gets rewards under the policy and reference model for eval set, appending them to the CSV at save_path as each batch is scored.
+
+           If a job with the same settings was stopped while writing save_path, its scored batches are kept, and scoring continues
+             after them. Returns the number of rows in save_path. Only works with BasicTrainer.
+        """
         torch.manual_seed(self.seed)
         np.random.seed(self.seed)
         random.seed(self.seed)
 
-        results = []
+        key = {k: OmegaConf.to_container(v) if OmegaConf.is_config(v) else v for k, v in self.config.items()
+               if k in ('policy_archive', 'datasets', 'seed', 'eval_batch_size', 'n_eval_examples', 'n_eval_model_samples', 'max_length', 'max_prompt_length', 'loss')}
+        key['reference_archive'] = self.config.model.archive
+        writer = ResumableCSVWriter(save_path, key=key)
+        if writer.n_chunks > 0:
+            rank0_print(f'Resuming rewards after the {writer.n_chunks} batches ({writer.n_rows} rows) already written to {save_path}')
+
+        n_scored = 0
         self.policy.eval()
         self.reference_model.eval()
 
         with tqdm.tqdm(desc="Computing rewards", total=self.config.n_eval_model_samples) as pbar:
-            for eval_batch in self.eval_batches:
-                if len(results) >= self.config.n_eval_model_samples * 2:
+            for batch_idx, eval_batch in enumerate(self.eval_batches):
+                if n_scored >= self.config.n_eval_model_samples:
                     break
                 local_eval_batch = slice_and_move_batch_for_device(eval_batch, self.rank, self.world_size, self.rank)
+                n_scored += len(local_eval_batch['prompt'])
+                if batch_idx >= writer.n_chunks:  # not written before resuming
+                    writer.write(self.get_batch_rewards(local_eval_batch))
+                pbar.update(len(local_eval_batch['prompt']))
+
+        return writer.n_rows
 
+    def precompute_reference_logps(self):
+        """Computes the reference log probs of every train/test preference pair and writes them to config.reference_logps_dir.
+
+           The reference model (with the weights of self.reference_archive) is only run once here; see get_reference_logps_path for the format.
+           Only works with BasicTrainer.
+        """
+        self.reference_model.eval()
+        os.makedirs(self.config.reference_logps_dir, exist_ok=True)
+
+        for split in ('train', 'test'):
+            iterator_kwargs = dict(self.data_iterator_kwargs, shuffle=False, deduplicate=False)
+            iterator = get_batch_iterator(**iterator_kwargs, split=split, n_epochs=1, batch_size=self.config.eval_batch_size,
+                                          cache_dir=get_local_dir(self.config.local_dirs), drop_last=False)
+
+            results = defaultdict(list)
+            for batch in tqdm.tqdm(iterator, desc=f'Computing reference log probs ({split} split)'):
+                local_batch = slice_and_move_batch_for_device(batch, self.rank, self.world_size, self.rank)
                 with torch.no_grad():
-                    policy_chosen_logps, policy_rejected_logps, policy_z = self.concatenated_forward(
-                        self.policy, local_eval_batch, return_z=True
-                    )
-                    reference_chosen_logps, reference_rejected_logps, reference_z = self.concatenated_forward(
-                        self.reference_model, local_eval_batch, return_z=True
-                    )
-
-                    _, chosen_rewards, rejected_rewards = dpo_loss(
-                        policy_chosen_logps, policy_rejected_logps, reference_chosen_logps, reference_rejected_logps,
-                        beta=self.config.loss.beta,
-                        alpha=self.config.loss.alpha,
-                        reference_free=self.config.loss.reference_free,
-                        chosen_len=local_eval_batch["chosen_len"],
-                        rejected_len=local_eval_batch["rejected_len"]
-                    )
-                    for i in range(self.config.eval_batch_size):
-                        results.append({
-                            "type": "chosen",
-                            "policy_logps": policy_chosen_logps.cpu().numpy().tolist()[i],
-                            "reference_logps": reference_chosen_logps.cpu().numpy().tolist()[i],
-                            "policy_z": policy_z.cpu().numpy().tolist()[i],
-                            "reference_z": reference_z.cpu().numpy().tolist()[i],
-                            "rewards": chosen_rewards.cpu().numpy().tolist()[i],
-                            "lengths": local_eval_batch["chosen_len_real"][i],
-                            "completion": local_eval_batch["chosen_response_only"][i],
-                            "prompt": local_eval_batch["prompt"][i],
-                        })
-                        results.append({
-                            "type": "rejected",
-                            "policy_logps": policy_rejected_logps.cpu().numpy().tolist()[i],
-                            "reference_logps": reference_rejected_logps.cpu().numpy().tolist()[i],
-                            "policy_z": policy_z.cpu().numpy().tolist()[i],
-                            "reference_z": reference_z.cpu().numpy().tolist()[i],
-                            "rewards": rejected_rewards.cpu().numpy().tolist()[i],
-                            "lengths": local_eval_batch["rejected_len_real"][i],
-                            "completion": local_eval_batch["rejected_response_only"][i],
-                            "prompt": local_eval_batch["prompt"][i],
-                        })
-                        pbar.update(2)
-
-        return pd.DataFrame(results)
-
-    def sample(self, n_per=1, num_beams=None, repetition_penalty=1, top_k=50, penalty_alpha=0.0, temperature=1.0,
-               top_p=1, no_repeat_ngram_size=0):
-        """Samples from self.policy over the evaluation set."""
+                    reference_chosen_logps, reference_rejected_logps = self.concatenated_forward(self.reference_model, local_batch)
+
+                for name, example_id, chosen, rejected in zip(local_batch['dataset'], local_batch['example_id'],
+                                                              reference_chosen_logps.cpu().numpy().tolist(),
+                                                              reference_rejected_logps.cpu().numpy().tolist()):
+                    results[name].append((example_id, chosen, rejected))
+
+            for name, rows in results.items():
+                example_ids, chosen, rejected = zip(*rows)
+                store = np.full((max(example_ids) + 1, 2), np.nan, dtype=np.float32)
+                store[list(example_ids), 0] = chosen
+                store[list(example_ids), 1] = rejected
+                path = get_reference_logps_path(self.config.reference_logps_dir, name, split, self.tokenizer, self.config.max_length, self.config.max_prompt_length,
+                                                self.reference_archive)
+                np.save(path, store)
+                rank0_print(f'Saved reference log probs for {len(rows)} {name} pairs ({split} split) to {path}')
+
+    def sample(self, save_paths: List[str], decoding_configs: List[Dict], n_per=1) -> List[int]:
+        """Samples from self.policy over the evaluation set with each decoding configuration (the get_batch_samples kwargs, e.g. num_beams
+           and temperature), appending a line {"prompt": ..., "sample": ...} to the JSONL file save_paths[i] of configuration i as each batch
+           finishes. Prompts already in a file (e.g., from a job that was stopped) are not sampled again, and count towards n_eval_model_samples.
+
+           With several configurations, each batch of prompts is run through the policy once, and every configuration (except contrastive
+             search) continues from the cached keys/values. Returns the number of prompts in each file.
+        """
         if n_per != 1:
             print("warning: ignoring n_per sample argument")
+        assert len(save_paths) == len(decoding_configs), "give one save path per decoding configuration"
+
+        done = [get_sampled_prompts(save_path) for save_path in save_paths]
+        for save_path, prompts in zip(save_paths, done):
+            if prompts:
+                print(f'found samples on {len(prompts)} eval prompts in {save_path}, continuing after them')
 
-        torch.manual_seed(self.seed)
         np.random.seed(self.seed)
         random.seed(self.seed)
-
-        result = {}
         self.policy.eval()
 
-        with tqdm.tqdm(desc="Sampling", total=self.config.n_eval_model_samples) as pbar:
-            for eval_batch in self.eval_batches:
-                if len(result) >= self.config.n_eval_model_samples:
+        n_samples = self.config.n_eval_model_samples
+        with contextlib.ExitStack() as stack:
+            for save_path in save_paths:
+                repair_jsonl(save_path)
+            files = [stack.enter_context(open(save_path, 'a')) for save_path in save_paths]
+            pbar = stack.enter_context(tqdm.tqdm(desc="Sampling", total=n_samples * len(save_paths), initial=sum(min(len(prompts), n_samples) for prompts in done)))
+            for batch_idx, eval_batch in enumerate(self.eval_batches):
+                todo = [i for i in range(len(save_paths)) if len(done[i]) < n_samples]
+                if not todo:
                     break
-            
-                local_eval_batch = slice_and_move_batch_for_device(eval_batch, self.rank, self.world_size, self.rank)
-                samples, _ = self.get_batch_samples(local_eval_batch, use_reference=False, num_beams=num_beams, temperature=temperature,
-                                                    repetition_penalty=repetition_penalty, top_k=top_k, penalty_alpha=penalty_alpha,
-                                                    top_p=top_p, no_repeat_ngram_size=no_repeat_ngram_size)
-                for prompt, sample in zip(local_eval_batch['prompt'], samples):
-                    result[prompt] = sample
-                    pbar.update(1)
 
-        return result
+                local_eval_batch = slice_and_move_batch_for_device(eval_batch, self.rank, self.world_size, self.rank)
+                n_prompts = len(local_eval_batch['prompt'])
+                prompt_cache = None
+                for i in todo:
+                    keep = [j for j, prompt in enumerate(local_eval_batch['prompt']) if prompt not in done[i]]
+                    if not keep:
+                        continue
+                    config_batch, config_cache = local_eval_batch, None
+                    if len(keep) < n_prompts:
+                        config_batch = {k: (v[keep] if isinstance(v, torch.Tensor) else [v[j] for j in keep]) for k, v in local_eval_batch.items()}
+
+                    decoding_config = decoding_configs[i]
+                    contrastive = decoding_config.get('penalty_alpha', 0.0) > 0 and decoding_config.get('top_k', 50) > 1
+                    if len(save_paths) > 1 and not contrastive:
+                        if prompt_cache is None:
+                            prompt_cache = self.get_prompt_cache(local_eval_batch)
+                        config_cache = prompt_cache
+                        if prompt_cache is not None and len(keep) < n_prompts:
+                            config_cache = map_past_key_values(prompt_cache, lambda t: t[keep])
+
+                    # seeded per batch, so a batch samples the same whether or not the batches before it were skipped
+                    torch.manual_seed(self.seed + batch_idx)
+                    samples, _ = self.get_batch_samples(config_batch, use_reference=False, prompt_cache=config_cache, **decoding_config)
+                    for prompt, sample in zip(config_batch['prompt'], samples):
+                        files[i].write(json.dumps({'prompt': prompt, 'sample': sample}) + '\n')
+                        done[i].add(prompt)
+                        pbar.update(1)
+                    files[i].flush()
+                    os.fsync(files[i].fileno())
+
+        return [len(prompts) for prompts in done]
 
     def train(self, example_counter_start=0, batch_counter_start=0):
         """Begin either SFT or DPO training, with periodic evaluation."""
@@ -427,30 +917,53 @@ class BasicTrainer(object):
         if self.config.scheduler_archive:
             self.load_scheduler_checkpoint(self.config.scheduler_archive)
             print('loaded scheduler from archive')
+        if self.config.data_archive:
+            self.load_data_checkpoint(self.config.data_archive)
+            print('loaded train data position from archive')
+        # the iterator state after the last batch trained on (the prefetcher may have read further), which is saved with checkpoints
+        self.train_data_state = copy.deepcopy(self.train_iterator_state)
 
         torch.manual_seed(self.seed)
         np.random.seed(self.seed)
         random.seed(self.seed)
         
-        if self.config.loss.name == 'dpo':
+        if self.config.loss.name == 'dpo' and self.reference_model is not None:
             self.reference_model.eval()
 
         self.example_counter = example_counter_start
         self.batch_counter = batch_counter_start
         last_log = None
+        train_metrics = MetricsAccumulator()
+
+        # batches may vary in size (max_tokens_per_batch), so evaluate whenever the example counter reaches the next multiple of eval_every
+        eval_every = self.config.eval_every
+        if self.example_counter == 0 and not self.config.do_first_eval:
+            next_eval_example = eval_every
+        else:
+            next_eval_example = -(-self.example_counter // eval_every) * eval_every
 
         print(f"starting from example = {self.example_counter}, batch = {self.batch_counter}")
 
         if self.train_iterator is None:
             raise ValueError("No train iterator loaded, cannot train")
 
-        for batch in self.train_iterator:
+        def prepare(batch):
+            """Split this process's part of a batch (the train iterator only collates that part) into its microbatches, already moved to its device."""
+            local_microbatches = []
+            for microbatch_idx in range(self.config.gradient_accumulation_steps):
+                local_microbatches.append(slice_and_move_batch_for_device(batch, microbatch_idx, self.config.gradient_accumulation_steps, self.rank))
+            return len(batch['prompt']) * self.world_size, local_microbatches
+
+        train_batches = Prefetcher(self.train_iterator, prepare, n_prefetch=self.config.prefetch_batches,
+                                   snapshot=lambda: copy.deepcopy(self.train_iterator_state))
+        for batch_size, local_microbatches in train_batches:
             #### BEGIN EVALUATION ####
-            if self.example_counter % self.config.eval_every == 0 and (self.example_counter > 0 or self.config.do_first_eval):
+            if self.example_counter >= next_eval_example:
+                next_eval_example = (self.example_counter // eval_every + 1) * eval_every
                 rank0_print(f'Running evaluation after {self.example_counter} train examples')
                 self.policy.eval()
 
-                all_eval_metrics = defaultdict(list)
+                all_eval_metrics = MetricsAccumulator()
                 if self.config.sample_during_eval:
                     all_policy_samples, all_reference_samples = [], []
                     policy_text_table = wandb.Table(columns=["step", "prompt", "sample"])
@@ -461,9 +974,7 @@ class BasicTrainer(object):
                     local_eval_batch = slice_and_move_batch_for_device(eval_batch, self.rank, self.world_size, self.rank)
                     with torch.no_grad():
                         _, eval_metrics = self.get_batch_metrics(local_eval_batch, self.config.loss, train=False)
-
-                    for k, v in eval_metrics.items():
-                        all_eval_metrics[k].extend(v)
+                    all_eval_metrics.add(eval_metrics)
 
                 if self.config.sample_during_eval:
                     if self.config.n_eval_model_samples < self.config.eval_batch_size:
@@ -476,7 +987,7 @@ class BasicTrainer(object):
                         local_eval_batch = slice_and_move_batch_for_device(eval_batch, self.rank, self.world_size, self.rank)
                         policy_samples, reference_samples = self.get_batch_samples(
                             local_eval_batch,
-                            use_reference=self.config.loss.name == 'dpo'
+                            use_reference=self.config.loss.name == 'dpo' and self.reference_model is not None
                         )
 
                         all_policy_samples.extend(policy_samples)
@@ -488,7 +999,7 @@ class BasicTrainer(object):
                             for prompt, sample in zip(eval_batch['prompt'], reference_samples):
                                 reference_text_table.add_data(self.example_counter, prompt, sample)
 
-                mean_eval_metrics = {k: sum(v) / len(v) for k, v in all_eval_metrics.items()}
+                mean_eval_metrics = all_eval_metrics.pop_means(self.world_size)
                 rank0_print(f'eval after {self.example_counter}: {formatted_dict(mean_eval_metrics)}')
                 if self.config.sample_during_eval:                    
                     rank0_print(json.dumps(all_policy_samples[:10], indent=2))
@@ -516,31 +1027,33 @@ class BasicTrainer(object):
             self.policy.train()
 
             start_time = time.time()
-            batch_metrics = defaultdict(list)
-            for microbatch_idx in range(self.config.gradient_accumulation_steps):
-                global_microbatch = slice_and_move_batch_for_device(batch, microbatch_idx, self.config.gradient_accumulation_steps, self.rank)
-                local_microbatch = slice_and_move_batch_for_device(global_microbatch, self.rank, self.world_size, self.rank)
+            for local_microbatch in local_microbatches:
                 loss, metrics = self.get_batch_metrics(local_microbatch, self.config.loss, train=True)
-                (loss / self.config.gradient_accumulation_steps).backward()
-
-                for k, v in metrics.items():
-                    batch_metrics[k].extend(v)
+                # weight by the microbatch's share of the examples, so the gradient is the mean over the whole batch
+                (loss * len(local_microbatch['prompt']) * self.world_size / batch_size).backward()
+                train_metrics.add(metrics)
 
             grad_norm = self.clip_gradient()
             self.optimizer.step()
             self.scheduler.step()
             self.optimizer.zero_grad()
+            self.train_data_state = train_batches.state
 
             step_time = time.time() - start_time
-            examples_per_second = self.config.batch_size / step_time
-            batch_metrics['examples_per_second'].append(examples_per_second)
-            batch_metrics['grad_norm'].append(grad_norm)
+            examples_per_second = batch_size / step_time
+            train_metrics.add({'examples_per_second': examples_per_second, 'data_wait_seconds': train_batches.wait_time, 'grad_norm': grad_norm})
 
             self.batch_counter += 1
-            self.example_counter += self.config.batch_size
-
-            if last_log is None or time.time() - last_log > self.config.minimum_log_interval_secs:
-                mean_train_metrics = {k: sum(v) / len(v) for k, v in batch_metrics.items()}
+            self.example_counter += batch_size
+
+            log_now = last_log is None or time.time() - last_log > self.config.minimum_log_interval_secs
+            if self.world_size > 1:  # every process takes part in reading the metrics, so they all follow rank 0's clock
+                log_flag = torch.tensor(float(log_now), device=self.rank)
+                dist.broadcast(log_flag, src=0)
+                log_now = bool(log_flag.item())
+            if log_now:
+                # the means over all the batches since the last log
+                mean_train_metrics = train_metrics.pop_means(self.world_size)
                 mean_train_metrics['counters/examples'] = self.example_counter
                 mean_train_metrics['counters/updates'] = self.batch_counter
                 rank0_print(f'train stats after {self.example_counter} examples: {formatted_dict(mean_train_metrics)}')
@@ -565,6 +1078,14 @@ class BasicTrainer(object):
         print(f'loading lr scheduler at step {step} from {scheduler_ckpt_path} with metrics {json.dumps(metrics, indent=2)}')
         self.scheduler.load_state_dict(state_dict["state"])
 
+    def load_data_checkpoint(self, data_ckpt_path):
+        """Restore the train iterator's position, so it continues right after the last batch trained on before the checkpoint."""
+        state_dict = torch.load(data_ckpt_path, map_location='cpu')
+        step, metrics = state_dict['step_idx'], state_dict['metrics']
+        print(f'loading train data position at step {step} from {data_ckpt_path} with metrics {json.dumps(metrics, indent=2)}')
+        self.train_iterator_state.clear()
+        self.train_iterator_state.update(state_dict["state"])
+
     def clip_gradient(self):
         """Clip the gradient norm of the parameters of a non-FSDP policy."""
         return torch.nn.utils.clip_grad_norm_(self.policy.parameters(), self.config.max_grad_norm).item()
@@ -603,6 +1124,8 @@ class BasicTrainer(object):
 
                 scheduler_state_dict = self.scheduler.state_dict()
                 self.write_state_dict(n_examples, scheduler_state_dict, metrics, 'scheduler.pt', output_dir)
+
+                self.write_state_dict(n_examples, self.train_data_state, metrics, 'data.pt', output_dir)
             except:
                 pass
 
@@ -663,7 +1186,7 @@ class FSDPTrainer(BasicTrainer):
                 apply_activation_checkpointing(self.policy, checkpoint_wrapper_fn=non_reentrant_wrapper, check_fn=check_fn)
                 rank0_print('FSDP activation checkpointing enabled!')
 
-        if config.loss.name == 'dpo':
+        if config.loss.name == 'dpo' and reference_model is not None:
             rank0_print('Sharding reference model...')
             self.reference_model = FSDP(reference_model, **shared_fsdp_kwargs)
         
@@ -705,6 +1228,7 @@ class FSDPTrainer(BasicTrainer):
         if self.rank == 0:
             scheduler_state_dict = self.scheduler.state_dict()
             self.write_state_dict(self.example_counter, scheduler_state_dict, metrics, 'scheduler.pt', output_dir)
+            self.write_state_dict(self.example_counter, self.train_data_state, metrics, 'data.pt', output_dir)
         dist.barrier()
         
 
@@ -719,7 +1243,7 @@ class TensorParallelTrainer(BasicTrainer):
         
         rank0_print('Sharding policy...')
         self.policy = tp.tensor_parallel(policy, sharded=True)
-        if config.loss.name == 'dpo':
+        if config.loss.name == 'dpo' and reference_model is not None:
             rank0_print('Sharding reference model...')
             self.reference_model = tp.tensor_parallel(reference_model, sharded=False)
 
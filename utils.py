@@ -9,7 +9,12 @@ import inspect
 import importlib.util
 import socket
 import os
-from typing import Dict, Union, Type, List
+import queue
+import threading
+import time
+import json
+import pandas as pd
+from typing import Dict, Union, Type, List, Callable, Iterable, Iterator, Any, Optional
 
 
 def get_open_port():
@@ -91,6 +96,45 @@ def all_gather_if_needed(values: torch.Tensor, rank: int, world_size: int) -> to
     return cat_function(all_values, dim=0)
 
 
+class MetricsAccumulator:
+    def __init__(self):
+        """Running sums and counts of metrics, added without copying anything to the host (tensor values are summed on their device).
+
+           pop_means packs the sums and counts of every metric into one buffer, sums it across processes with a single all-reduce,
+             and copies it to the host once, instead of gathering and copying each metric of each batch.
+        """
+        self.sums = {}
+        self.counts = {}
+
+    def add(self, metrics: Dict[str, Union[torch.Tensor, float]]):
+        """Add the values of each metric: a tensor (e.g., one value per example of this process), or a single float."""
+        for k, v in metrics.items():
+            if isinstance(v, torch.Tensor):
+                total, count = v.detach().float().sum(), v.numel()
+            else:
+                total, count = float(v), 1
+            self.sums[k] = self.sums[k] + total if k in self.sums else total
+            self.counts[k] = self.counts.get(k, 0) + count
+
+    def pop_means(self, world_size: int = 1) -> Dict[str, float]:
+        """Return the mean of each metric over the values added on all processes since the last call, and reset the sums.
+
+           With world_size > 1, every process must call this at the same point, having added the same metrics.
+        """
+        names = sorted(self.sums)
+        if not names:
+            return {}
+        device = next((v.device for v in self.sums.values() if isinstance(v, torch.Tensor)), torch.device('cpu'))
+        sums = torch.stack([torch.as_tensor(self.sums[k], dtype=torch.float32, device=device) for k in names])
+        counts = torch.tensor([float(self.counts[k]) for k in names], device=device)
+        packed = torch.cat([sums, counts])
+        if world_size > 1:
+            dist.all_reduce(packed)
+        packed = packed.cpu().tolist()
+        self.sums, self.counts = {}, {}
+        return {k: packed[idx] / packed[len(names) + idx] for idx, k in enumerate(names)}
+
+
 def formatted_dict(d: Dict) -> Dict:
     """Format a dictionary for printing."""
     return {k: (f"{v:.5g}" if type(v) == float else v) for k, v in d.items()}
@@ -153,6 +197,43 @@ def init_distributed(rank: int, world_size: int, master_addr: str = 'localhost',
     torch.cuda.set_device(rank)
 
 
+class ResumableCSVWriter:
+    def __init__(self, path: str, key: Optional[Dict] = None):
+        """Append rows to a CSV file in chunks (e.g., one per batch), flushing each to disk and recording how many chunks were written in
+           path + '.progress', so a job that is stopped can continue after the last chunk written instead of starting over.
+
+           If the progress file records the same key (e.g., the settings the rows are computed with), the file is resumed: n_chunks and
+             n_rows are those already written, and anything written after the last recorded chunk is dropped. Otherwise it is overwritten.
+        """
+        self.path = path
+        self.progress_path = f'{path}.progress'
+        self.key = json.loads(json.dumps(key))  # as it is read back from the progress file
+        self.n_chunks, self.n_rows, self.n_bytes = 0, 0, 0
+        if os.path.exists(path) and os.path.exists(self.progress_path):
+            with open(self.progress_path) as f:
+                progress = json.load(f)
+            if progress['key'] == self.key:
+                self.n_chunks, self.n_rows, self.n_bytes = progress['n_chunks'], progress['n_rows'], progress['n_bytes']
+        with open(path, 'a'):
+            pass
+        os.truncate(path, self.n_bytes)
+
+    def write(self, columns: Dict[str, List]):
+        """Append a chunk of rows, given as a list of values per column."""
+        chunk = pd.DataFrame(columns)
+        with open(self.path, 'a', newline='') as f:
+            chunk.to_csv(f, header=self.n_bytes == 0, index=False)
+            f.flush()
+            os.fsync(f.fileno())
+            self.n_bytes = f.tell()
+        self.n_chunks += 1
+        self.n_rows += len(chunk)
+        tmp_path = f'{self.progress_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'key': self.key, 'n_chunks': self.n_chunks, 'n_rows': self.n_rows, 'n_bytes': self.n_bytes}, f)
+        os.replace(tmp_path, self.progress_path)
+
+
 class TemporarilySeededRandom:
     def __init__(self, seed):
         """Temporarily set the random seed, and then restore it when exiting the context."""
@@ -173,3 +254,57 @@ class TemporarilySeededRandom:
         # Restore the random state
         random.setstate(self.stored_state)
         np.random.set_state(self.stored_np_state)
+
+
+class Prefetcher:
+    def __init__(self, iterable: Iterable, prepare: Callable[[Any], Any] = lambda item: item, n_prefetch: int = 1,
+                 snapshot: Optional[Callable[[], Any]] = None):
+        """Iterate over prepare(item) for each item of iterable, preparing up to n_prefetch items ahead in a background thread.
+
+           After each item, wait_time is the time the consumer spent waiting for it. With n_prefetch=0, items are prepared
+             inline (no thread), and wait_time is the time it took to prepare them. If given, snapshot is called right after
+             each item is taken from iterable (e.g., to copy the iterable's state), and state is the snapshot of the last item
+             yielded, since the iterable itself may already be further ahead.
+        """
+        self.iterable = iterable
+        self.prepare = prepare
+        self.n_prefetch = n_prefetch
+        self.snapshot = snapshot if snapshot is not None else lambda: None
+        self.wait_time = 0.0
+        self.state = None
+
+    def _worker(self, items: queue.Queue):
+        try:
+            for item in self.iterable:
+                state = self.snapshot()
+                items.put((True, (self.prepare(item), state)))
+            items.put((False, None))
+        except BaseException as e:  # re-raised in the consumer
+            items.put((False, e))
+
+    def __iter__(self) -> Iterator:
+        if self.n_prefetch == 0:
+            iterator = iter(self.iterable)
+            while True:
+                start = time.time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                self.state = self.snapshot()
+                prepared = self.prepare(item)
+                self.wait_time = time.time() - start
+                yield prepared
+
+        items = queue.Queue(maxsize=self.n_prefetch)
+        threading.Thread(target=self._worker, args=(items,), daemon=True).start()
+        while True:
+            start = time.time()
+            ok, prepared = items.get()
+            self.wait_time = time.time() - start
+            if not ok:
+                if prepared is not None:
+                    raise prepared
+                return
+            prepared, self.state = prepared
+            yield prepared